@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/6.0/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 import logging
 from logging import handlers
 import copy as _copy
@@ -143,6 +144,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'store.security.ThreatScanMiddleware',
     'store.response_logger_middleware.ResponseLoggerMiddleware',
 ]
 
@@ -237,6 +239,22 @@ if not DEBUG:
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Watermarked image variants are looked up in this manifest (media storage),
+# re-read at most every WATERMARK_MANIFEST_RELOAD seconds per process
+WATERMARK_MANIFEST_NAME = 'watermarks/manifest.json'
+WATERMARK_MANIFEST_RELOAD = int(os.environ.get('WATERMARK_MANIFEST_RELOAD', 300))
+# Responsive variants built by `manage.py process_product_images`
+WATERMARK_VARIANT_WIDTHS = [300, 600, 1200]
+WATERMARK_VARIANT_FORMATS = ['webp', 'jpeg']
+
+# Every login path (store, contrib.auth views, admin) authenticates through
+# the lockout-aware backend; see store.security.LoginProtection
+AUTHENTICATION_BACKENDS = ['store.security.LoginProtectionBackend']
+
+# Reverse proxies in front of the app that append to X-Forwarded-For. 0
+# means clients connect directly and only REMOTE_ADDR is trusted.
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+
 # Auth redirects
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'store:profile'
@@ -368,6 +386,85 @@ else:
         }
     }
 
+# --- Response capture (debugging aid) ---
+# Samples responses for matching paths (regexes; empty = all) into a rotating
+# file via a background queue. Off unless explicitly enabled.
+RESPONSE_CAPTURE_ENABLED = env_bool("RESPONSE_CAPTURE_ENABLED", False)
+RESPONSE_CAPTURE_SAMPLE_RATE = float(os.environ.get("RESPONSE_CAPTURE_SAMPLE_RATE", 0.01))
+RESPONSE_CAPTURE_PATHS = [p for p in os.environ.get("RESPONSE_CAPTURE_PATHS", "").split(",") if p]
+RESPONSE_CAPTURE_MAX_BYTES = int(os.environ.get("RESPONSE_CAPTURE_MAX_BYTES", 2048))
+RESPONSE_CAPTURE_FILE = LOG_DIR / 'responses.log'
+
+# --- Background tasks ---
+# Deferred jobs (e.g. notification fan-out) run on a small in-process thread
+# pool once the request's transaction commits. TASKS_ALWAYS_EAGER runs them
+# inline on commit instead, which is what tests and one-off scripts want.
+TASKS_ALWAYS_EAGER = env_bool("TASKS_ALWAYS_EAGER", False)
+TASKS_MAX_WORKERS = int(os.environ.get("TASKS_MAX_WORKERS", 2))
+# In-process write buffers (search log, trending, visitor sketches, audit
+# log) also flush a stale batch from a timer, so a quiet process still
+# writes within the flush window, and flush what is left at exit. Off under
+# `manage.py test`, where writes must stay on the test's thread and database.
+BUFFER_AUTO_FLUSH = env_bool("BUFFER_AUTO_FLUSH", sys.argv[1:2] != ["test"])
+
+# --- Search telemetry ---
+# Search requests are buffered in-process and written in batches (rows plus
+# hourly rollups) once SEARCH_LOG_BATCH_SIZE entries are queued or the
+# oldest has waited SEARCH_LOG_FLUSH_SECONDS.
+SEARCH_LOG_BATCH_SIZE = int(os.environ.get("SEARCH_LOG_BATCH_SIZE", 100))
+SEARCH_LOG_FLUSH_SECONDS = int(os.environ.get("SEARCH_LOG_FLUSH_SECONDS", 30))
+
+# --- Trending ---
+# Searches and product views feed exponentially decayed scores (an event
+# counts half as much after TRENDING_HALF_LIFE_HOURS). Product views are
+# buffered like search logs; top-K lists are cached TRENDING_CACHE_SECONDS.
+TRENDING_HALF_LIFE_HOURS = float(os.environ.get("TRENDING_HALF_LIFE_HOURS", 24))
+TRENDING_BATCH_SIZE = int(os.environ.get("TRENDING_BATCH_SIZE", 200))
+TRENDING_FLUSH_SECONDS = int(os.environ.get("TRENDING_FLUSH_SECONDS", 30))
+TRENDING_CACHE_SECONDS = int(os.environ.get("TRENDING_CACHE_SECONDS", 60))
+# Product pages show recommendations drawn from other shoppers' views; a
+# browser's cached copy is re-rendered at least this often.
+RECOMMENDATIONS_REFRESH_SECONDS = int(os.environ.get("RECOMMENDATIONS_REFRESH_SECONDS", 300))
+
+# --- Event retention ---
+# `manage.py archive_events` rolls product views older than
+# EVENT_RETENTION_DAYS into daily aggregates, then moves raw ProductView and
+# SearchQuery rows into gzip JSONL files under EVENT_ARCHIVE_DIR.
+EVENT_RETENTION_DAYS = int(os.environ.get("EVENT_RETENTION_DAYS", 90))
+EVENT_ARCHIVE_DIR = Path(os.environ.get("EVENT_ARCHIVE_DIR", BASE_DIR / "archive"))
+
+# --- Visitor sketches ---
+# Distinct visitors per day and product are HyperLogLog sketches (about 1.6%
+# standard error); views are merged into them in batches.
+VISITOR_SKETCH_BATCH_SIZE = int(os.environ.get("VISITOR_SKETCH_BATCH_SIZE", 500))
+VISITOR_SKETCH_FLUSH_SECONDS = int(os.environ.get("VISITOR_SKETCH_FLUSH_SECONDS", 60))
+
+# --- Security audit log ---
+# LoginAttempt and SuspiciousActivity rows are queued in process and
+# bulk-inserted once AUDIT_LOG_BATCH_SIZE are waiting or the oldest is
+# AUDIT_LOG_FLUSH_SECONDS old. ThreatScanMiddleware scans at most
+# THREAT_SCAN_MAX_CHARS of each request's query string and form fields.
+AUDIT_LOG_BATCH_SIZE = int(os.environ.get("AUDIT_LOG_BATCH_SIZE", 200))
+AUDIT_LOG_FLUSH_SECONDS = int(os.environ.get("AUDIT_LOG_FLUSH_SECONDS", 10))
+THREAT_SCAN_MAX_CHARS = int(os.environ.get("THREAT_SCAN_MAX_CHARS", 8192))
+
+# --- Coupons ---
+# Compiled coupon rules are cached this long; any coupon edit invalidates
+# them at once (store.coupons).
+COUPON_CACHE_SECONDS = int(os.environ.get("COUPON_CACHE_SECONDS", 300))
+
+# --- Inventory ---
+# Minutes a checkout's stock reservation is held while online payment is
+# pending; `manage.py release_expired_reservations` returns expired holds.
+STOCK_RESERVATION_TTL_MINUTES = int(os.environ.get("STOCK_RESERVATION_TTL_MINUTES", 30))
+
+# --- Catalog delta sync ---
+# Rows stamped more recently than this are held back from the product
+# changes feed (/api/products/changes/) because their transaction may not
+# have committed yet. Keep it well above the longest transaction that
+# writes Product.updated_at (stock imports commit per chunk of products).
+CATALOG_SYNC_SETTLE_SECONDS = int(os.environ.get("CATALOG_SYNC_SETTLE_SECONDS", 30))
+
 # --- Email ---
 EMAIL_BACKEND = os.environ.get("EMAIL_BACKEND", "django.core.mail.backends.console.EmailBackend" if DEBUG else "django.core.mail.backends.smtp.EmailBackend")
 EMAIL_HOST = os.environ.get("EMAIL_HOST", "localhost")
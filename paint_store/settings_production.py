@@ -85,6 +85,9 @@ EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'noreply@lephat.com')
 
+# Response capture is a debugging aid; never sample production traffic by default
+RESPONSE_CAPTURE_ENABLED = False
+
 # Logging Configuration
 LOGGING = {
     'version': 1,
@@ -6,15 +6,58 @@ from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
 from django.utils.formats import number_format
+from django.core.paginator import Paginator
+from django.http import StreamingHttpResponse
+from django.db import connections
+from django.utils.functional import cached_property
 from .models import (
     Brand, Category, Product, Order, OrderItem,
     ProductView, ProductViewAnalytics,
-    StockLevel, StockAlert, PreOrder, BackInStockNotification,
+    StockLevel, StockAlert, StockReservation, PreOrder, BackInStockNotification,
     OrderAnalytics, UserAnalytics, ProductPerformance,
     Coupon, AppliedCoupon,
-    EmailTemplate, EmailQueue, NewsletterSubscription
+    EmailTemplate, EmailQueue, NewsletterSubscription, WebhookEvent
 )
 from django.db import models
+from . import bulk_orders
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for very large tables: an unfiltered changelist takes the
+    planner's row estimate instead of running COUNT(*) over the whole table.
+    Filtered lists, small tables and backends without statistics (SQLite)
+    are counted exactly.
+    """
+    exact_count_below = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= self.exact_count_below:
+                return estimate
+        return super().count
+
+
+def estimated_row_count(model, using='default'):
+    """Row count from the database statistics, or None if it keeps none"""
+    connection = connections[using]
+    table = model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)"
+    elif connection.vendor == 'mysql':
+        sql = "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    # reltuples is -1 until the table has been analyzed
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
 
 
 class ProductAdminForm(forms.ModelForm):
@@ -130,7 +173,8 @@ class ProductAdmin(admin.ModelAdmin):
     # Gọn danh sách: chỉ giữ các cột chính
     list_display = ('id', 'name', 'brand', 'category', 'price_vnd', 'sale_price_vnd', 'volume_with_unit', 'stock_quantity', 'is_active')
     list_filter = ('brand', 'category', ProductTypeFilter, 'unit_type', 'is_active')
-    search_fields = ('name', 'brand__name')
+    list_select_related = ('brand', 'category')
+    search_fields = ('name', 'sku', 'brand__name')
     readonly_fields = ('thumbnail', 'view_count', 'rating', 'is_on_sale')
     ordering = ('-id',)
     list_editable = ('is_active',)
@@ -142,7 +186,7 @@ class ProductAdmin(admin.ModelAdmin):
             'fields': (('price', 'sale_price'), ('unit_type', 'volume')),
         }),
         ('Kho & hiển thị', {
-            'fields': ('quantity', 'stock_quantity', 'is_active', 'is_new', 'is_on_sale', 'image')
+            'fields': ('sku', 'quantity', 'stock_quantity', 'is_active', 'is_new', 'is_on_sale', 'image')
         }),
         ('Thống kê', {
             'classes': ('collapse',),
@@ -187,31 +231,30 @@ class ProductAdmin(admin.ModelAdmin):
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ('id', 'full_name', 'phone', 'status', 'payment_method', 'payment_status', 'is_paid', 'paid_at', 'created_at')
+    list_display = ('id', 'full_name', 'phone', 'item_count', 'total_vnd', 'status', 'payment_method', 'payment_status', 'is_paid', 'paid_at', 'created_at')
     readonly_fields = ('created_at', 'paid_at')
     list_filter = ('status', 'payment_status', 'payment_method', 'is_paid')
     search_fields = ('full_name', 'phone', 'payment_reference')
     list_editable = ('status', 'is_paid')
     actions = ['export_orders_csv', 'mark_as_paid', 'cancel_orders']
 
-    def export_orders_csv(self, request, queryset):
-        import csv
-        from django.http import HttpResponse
+    def get_queryset(self, request):
+        # item count in the same query as the page; the total is the stored order_total
+        return super().get_queryset(request).annotate(item_count=models.Count('items'))
+
+    @admin.display(ordering='item_count', description='Số SP')
+    def item_count(self, obj):
+        return obj.item_count
 
-        meta = self.model._meta
-        field_names = ['id', 'full_name', 'phone', 'address', 'created_at']
+    @admin.display(ordering='order_total', description='Tổng (VND)')
+    def total_vnd(self, obj):
+        return f"{number_format(obj.order_total, decimal_pos=0, force_grouping=True)} ₫"
 
-        response = HttpResponse(content_type='text/csv')
+    @admin.action(description='Export selected orders to CSV')
+    def export_orders_csv(self, request, queryset):
+        response = StreamingHttpResponse(bulk_orders.export_rows(queryset), content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename=orders.csv'
-        writer = csv.writer(response)
-        writer.writerow(field_names + ['items'])
-        for obj in queryset:
-            items = []
-            for it in obj.items.all():
-                items.append(f"{it.product.name} x{it.quantity} @{it.price}")
-            writer.writerow([getattr(obj, f) for f in field_names] + ["; ".join(items)])
         return response
-    export_orders_csv.short_description = 'Export selected orders to CSV'
 
     def save_model(self, request, obj, form, change):
         # If staff marks is_paid true, set payment_status to paid
@@ -219,25 +262,14 @@ class OrderAdmin(admin.ModelAdmin):
             obj.payment_status = Order.PAYMENT_STATUS_PAID
         super().save_model(request, obj, form, change)
 
+    @admin.action(description='Mark selected orders as paid')
     def mark_as_paid(self, request, queryset):
-        updated = 0
-        for order in queryset:
-            if not order.is_paid:
-                order.is_paid = True
-                order.payment_status = Order.PAYMENT_STATUS_PAID
-                order.save()
-                updated += 1
+        updated = bulk_orders.mark_paid(queryset)
         self.message_user(request, f"Marked {updated} order(s) as paid.")
-    mark_as_paid.short_description = 'Mark selected orders as paid'
 
     @admin.action(description="Cancel selected orders")
     def cancel_orders(self, request, queryset):
-        canceled = 0
-        for order in queryset:
-            if order.status != Order.STATUS_CANCELED:
-                order.status = Order.STATUS_CANCELED
-                order.save()
-                canceled += 1
+        canceled = bulk_orders.cancel(queryset)
         if canceled:
             self.message_user(request, f"Canceled {canceled} order(s).")
         else:
@@ -247,6 +279,7 @@ class OrderAdmin(admin.ModelAdmin):
 @admin.register(OrderItem)
 class OrderItemAdmin(admin.ModelAdmin):
     list_display = ('id', 'order', 'product', 'quantity', 'price')
+    list_select_related = ('order', 'product')
 
 
 # Recommendation Models
@@ -255,7 +288,10 @@ class ProductViewAdmin(admin.ModelAdmin):
     list_display = ('product', 'user', 'session_key', 'viewed_at', 'ip_address')
     list_filter = ('viewed_at',)
     search_fields = ('product__name', 'user__username')
-    date_hierarchy = 'viewed_at'
+    list_select_related = ('product', 'user')
+    # no date_hierarchy: its year links need a scan of the whole table
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(ProductViewAnalytics)
@@ -263,6 +299,7 @@ class ProductViewAnalyticsAdmin(admin.ModelAdmin):
     list_display = ('product', 'total_views', 'unique_views', 'total_purchases', 'last_viewed')
     readonly_fields = ('total_views', 'unique_views', 'total_purchases', 'last_viewed', 'last_purchased')
     search_fields = ('product__name',)
+    list_select_related = ('product',)
 
 
 # Inventory Models
@@ -271,6 +308,7 @@ class StockLevelAdmin(admin.ModelAdmin):
     list_display = ('product', 'quantity', 'low_stock_threshold', 'is_low_stock', 'is_out_of_stock', 'last_restocked')
     list_filter = ('last_restocked',)
     search_fields = ('product__name',)
+    list_select_related = ('product',)
 
 
 @admin.register(StockAlert)
@@ -278,6 +316,15 @@ class StockAlertAdmin(admin.ModelAdmin):
     list_display = ('product', 'alert_type', 'created_at', 'resolved', 'resolved_at')
     list_filter = ('alert_type', 'resolved', 'created_at')
     search_fields = ('product__name',)
+    list_select_related = ('product',)
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ('order', 'product', 'quantity', 'status', 'expires_at', 'created_at', 'released_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('product__name', 'order__id')
+    list_select_related = ('order', 'product')
 
 
 @admin.register(PreOrder)
@@ -285,6 +332,7 @@ class PreOrderAdmin(admin.ModelAdmin):
     list_display = ('product', 'customer_name', 'customer_email', 'quantity', 'created_at', 'notified', 'fulfilled')
     list_filter = ('notified', 'fulfilled', 'created_at')
     search_fields = ('product__name', 'customer_name', 'customer_email')
+    list_select_related = ('product',)
 
 
 @admin.register(BackInStockNotification)
@@ -292,6 +340,7 @@ class BackInStockNotificationAdmin(admin.ModelAdmin):
     list_display = ('product', 'email', 'created_at', 'notified', 'notified_at')
     list_filter = ('notified', 'created_at')
     search_fields = ('product__name', 'email')
+    list_select_related = ('product',)
 
 
 # Analytics Models
@@ -313,6 +362,7 @@ class ProductPerformanceAdmin(admin.ModelAdmin):
     list_filter = ('date',)
     search_fields = ('product__name',)
     date_hierarchy = 'date'
+    list_select_related = ('product',)
 
 
 # Coupon Models
@@ -329,6 +379,7 @@ class AppliedCouponAdmin(admin.ModelAdmin):
     list_display = ('coupon', 'user', 'discount_amount', 'applied_at')
     list_filter = ('applied_at',)
     search_fields = ('coupon__code', 'user__username')
+    list_select_related = ('coupon', 'user')
 
 
 # Email Models
@@ -352,6 +403,15 @@ class NewsletterSubscriptionAdmin(admin.ModelAdmin):
     list_display = ('email', 'user', 'is_active', 'subscribed_at', 'unsubscribed_at')
     list_filter = ('is_active', 'subscribed_at')
     search_fields = ('email', 'user__username')
+    list_select_related = ('user',)
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'provider', 'event_type', 'status', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('provider', 'status', 'event_type')
+    search_fields = ('event_id',)
+    readonly_fields = ('received_at', 'processed_at')
 
 # Tiêu đề admin tiếng Việt, gọn gàng
 admin.site.site_header = "Quản trị Đại lý Sơn Phát Tấn"
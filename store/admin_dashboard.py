@@ -19,8 +19,9 @@ from django.utils import timezone
 from django.views.decorators.http import require_http_methods
 from .models import (
     Order, OrderItem, Product, User,
-    ProductView, OrderAnalytics, UserAnalytics, ProductPerformance
+    OrderAnalytics, UserAnalytics, ProductPerformance
 )
+from . import visitors
 
 
 def _paid_orders_queryset(request, params=None):
@@ -425,10 +426,9 @@ def get_kpi_metrics(start_date):
     # New users in period
     new_users = User.objects.filter(date_joined__date__gte=start_date).count()
     
-    # Conversion rate (orders / unique visitors)
-    unique_visitors = ProductView.objects.filter(
-        viewed_at__date__gte=start_date
-    ).values('session_key').distinct().count()
+    # Conversion rate (orders / unique visitors), merged from the daily
+    # HyperLogLog sketches
+    unique_visitors = visitors.unique_visitors(start_date)
     
     conversion_rate = (period_orders / unique_visitors * 100) if unique_visitors > 0 else 0
     
@@ -6,7 +6,9 @@ from django.db.models import Count, Sum, Avg, F
 from django.utils import timezone
 from datetime import timedelta
 from django.contrib.auth.models import User
-from .models import Order, OrderItem, Product, ProductView, OrderAnalytics, UserAnalytics
+from .models import Order, OrderItem, Product, OrderAnalytics, UserAnalytics
+from .retention import view_counts
+from .visitors import product_unique_visitors
 
 
 @staff_member_required
@@ -149,13 +151,14 @@ def product_performance(request):
     end_date = timezone.now().date()
     start_date = end_date - timedelta(days=days)
     
+    products = list(products[:20])  # Limit to 20 products
+    views_by_product = view_counts(start_date, [product.pk for product in products])
+    visitors_by_product = product_unique_visitors([product.pk for product in products], start_date)
+    
     performance_data = []
-    for product in products[:20]:  # Limit to 20 products
+    for product in products:
         # Views
-        views = ProductView.objects.filter(
-            product=product,
-            viewed_at__date__gte=start_date
-        ).count()
+        views = views_by_product.get(product.pk, 0)
         
         # Sales
         sales = OrderItem.objects.filter(
@@ -173,6 +176,7 @@ def product_performance(request):
             'product_id': product.id,
             'product_name': product.name,
             'views': views,
+            'unique_visitors': visitors_by_product.get(product.id, 0),
             'sales': sales['count'] or 0,
             'revenue': float(sales['revenue'] or 0),
             'conversion_rate': round(conversion_rate, 2),
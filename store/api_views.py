@@ -5,38 +5,66 @@ from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticate
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from decimal import Decimal
-from .models import Product, Order, ProductView, Brand, Category, Cart, CartItem, Coupon
+from .models import Product, Order, ProductView, Brand, Category
 from .serializers import (
     ProductSerializer, OrderSerializer, ProductViewSerializer,
     CartSerializer, CouponSerializer, BrandSerializer, CategorySerializer
 )
+from . import coupons
+from .cart import get_cart
+from .catalog_sync import SYNC_PAGE_SIZE, InvalidCursor, catalog_changes
+from .conditional import ConditionalGetMixin
+from .pagination import CatalogPagination
 from .recommendation_views import (
     get_also_viewed, get_also_bought, get_similar_products
 )
 
 
-class ProductViewSet(viewsets.ReadOnlyModelViewSet):
+class SparseFieldsetViewMixin:
+    """
+    `?fields=id,name,price` limits the serialized fields (see
+    serializers.SparseFieldsetMixin)
+    """
+    
+    def requested_fields(self):
+        request = getattr(self, 'request', None)
+        raw = request.query_params.get('fields', '') if request is not None else ''
+        return [name.strip() for name in raw.split(',') if name.strip()] or None
+    
+    def get_serializer(self, *args, **kwargs):
+        fields = self.requested_fields()
+        if fields:
+            kwargs.setdefault('fields', fields)
+        return super().get_serializer(*args, **kwargs)
+
+
+class ProductViewSet(ConditionalGetMixin, SparseFieldsetViewMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for products
     GET /api/products/ - List all products
     GET /api/products/<id>/ - Get product details
+    
+    Page numbers by default; `?pagination=cursor` (then follow `next`) pages
+    by keyset on (created_at, id). `?fields=` selects a sparse fieldset.
     """
-    queryset = Product.objects.filter(is_active=True)
+    queryset = ProductSerializer.setup_eager_loading(Product.objects.filter(is_active=True))
     serializer_class = ProductSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     filter_backends = [filters.SearchFilter, filters.OrderingFilter]
     search_fields = ['name', 'brand__name', 'category__name']
     ordering_fields = ['price', 'created_at', 'name']
     ordering = ['-created_at']
+    pagination_class = CatalogPagination
     
     @action(detail=True, methods=['get'])
     def recommendations(self, request, pk=None):
         """Get recommendations for a product"""
         product = self.get_object()
         
-        also_viewed = get_also_viewed(product)[:5]
-        also_bought = get_also_bought(product)[:5]
-        similar = get_similar_products(product)[:5]
+        eager = ProductSerializer.setup_eager_loading
+        also_viewed = eager(get_also_viewed(product))[:5]
+        also_bought = eager(get_also_bought(product))[:5]
+        similar = eager(get_similar_products(product))[:5]
         
         return Response({
             'also_viewed': ProductSerializer(also_viewed, many=True).data,
@@ -44,6 +72,21 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
             'similar': ProductSerializer(similar, many=True).data,
         })
     
+    @action(detail=False, methods=['get'])
+    def changes(self, request):
+        """
+        Delta sync: GET /api/products/changes/?since=<cursor>&limit=500
+        Poll again with the returned `cursor` (immediately while `has_more`).
+        """
+        try:
+            page = catalog_changes(
+                cursor=request.query_params.get('since'),
+                limit=request.query_params.get('limit', SYNC_PAGE_SIZE),
+            )
+        except (InvalidCursor, ValueError):
+            return Response({'error': 'Invalid since cursor or limit'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(page)
+    
     @action(detail=True, methods=['post'], permission_classes=[AllowAny])
     def track_view(self, request, pk=None):
         """Track product view"""
@@ -59,43 +102,47 @@ class ProductViewSet(viewsets.ReadOnlyModelViewSet):
         return Response({'success': True})
 
 
-class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
+class CategoryViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for categories
     GET /api/categories/ - List all categories
     GET /api/categories/<id>/ - Get category details
     """
-    queryset = Category.objects.all()
+    queryset = Category.objects.order_by('name')
     serializer_class = CategorySerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
 
 
-class BrandViewSet(viewsets.ReadOnlyModelViewSet):
+class BrandViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for brands
     GET /api/brands/ - List all brands
     GET /api/brands/<id>/ - Get brand details
     """
-    queryset = Brand.objects.all()
+    queryset = Brand.objects.order_by('name')
     serializer_class = BrandSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
 
 
-class OrderViewSet(viewsets.ReadOnlyModelViewSet):
+class OrderViewSet(SparseFieldsetViewMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for orders
     GET /api/orders/ - List user's orders
     GET /api/orders/<id>/ - Get order details
+    
+    Supports the same `?pagination=cursor` and `?fields=` options as products.
     """
     queryset = Order.objects.all().order_by('-created_at')
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = CatalogPagination
     
     def get_queryset(self):
         # In a real app, filter by user's email or user relationship
-        if self.request.user.is_staff:
-            return self.queryset
-        return Order.objects.filter(user=self.request.user).order_by('-created_at')
+        queryset = self.queryset
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(user=self.request.user)
+        return OrderSerializer.setup_eager_loading(queryset, self.requested_fields())
 
 
 @api_view(['GET'])
@@ -103,26 +150,16 @@ class OrderViewSet(viewsets.ReadOnlyModelViewSet):
 @permission_classes([AllowAny])
 def cart_view_api(request):
     """Get current cart contents"""
-    cart = request.session.get('cart', {})
-    items = []
-    total = 0
-    
-    for product_id, quantity in cart.items():
-        try:
-            product = Product.objects.get(pk=int(product_id), is_active=True)
-            item_total = product.price * quantity
-            total += item_total
-            items.append({
-                'product': ProductSerializer(product).data,
-                'quantity': quantity,
-                'item_total': str(item_total)
-            })
-        except Product.DoesNotExist:
-            continue
+    lines = get_cart(request).lines()
+    items = [{
+        'product': ProductSerializer(line.product).data,
+        'quantity': line.quantity,
+        'item_total': str(line.subtotal),
+    } for line in lines]
     
     return Response({
         'items': items,
-        'total': str(total)
+        'total': str(sum((line.subtotal for line in lines), Decimal('0')))
     })
 
 
@@ -130,8 +167,7 @@ def cart_view_api(request):
 @authentication_classes([])
 @permission_classes([AllowAny])
 def cart_add_api(request):
-    """Add item to cart"""
-    """Add item to cart (session-backed, public)."""
+    """Add item to the visitor's cart"""
     product_id = request.data.get('product_id')
     quantity = int(request.data.get('quantity', 1))
     
@@ -147,25 +183,16 @@ def cart_add_api(request):
     if not request.session.session_key:
         request.session.create()
     
-    cart = request.session.get('cart', {})
-    product_key = str(product_id)
-    
-    if product_key in cart:
-        cart[product_key] += quantity
-    else:
-        cart[product_key] = quantity
-    
-    request.session['cart'] = cart
-    request.session.modified = True
-    total_items = sum(cart.values())
+    cart = get_cart(request)
+    new_quantity = cart.add(product, quantity)
+    total_items, _subtotal = cart.totals()
     
     return Response({
         'success': True,
         'product': ProductSerializer(product).data,
-        'quantity': cart[product_key],
+        'quantity': new_quantity,
         'total_items': total_items
     })
-    
 
 
 @api_view(['DELETE'])
@@ -173,13 +200,7 @@ def cart_add_api(request):
 @permission_classes([AllowAny])
 def cart_remove_api(request, product_id):
     """Remove item from cart"""
-    cart = request.session.get('cart', {})
-    product_key = str(product_id)
-    
-    if product_key in cart:
-        del cart[product_key]
-        request.session['cart'] = cart
-        request.session.modified = True
+    if get_cart(request).remove(product_id):
         return Response({'success': True})
     
     return Response({'error': 'Item not in cart'}, status=status.HTTP_404_NOT_FOUND)
@@ -209,11 +230,11 @@ def recommendations_api(request):
     })
 
 
-# Cart API endpoints for testing
+# Cart API endpoints for token-authenticated clients
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def cart_add_item_api(request):
-    """Add item to cart (API for tests)"""
+    """Add item to cart"""
     product_id = request.data.get('product_id')
     quantity = int(request.data.get('quantity', 1))
     
@@ -225,28 +246,14 @@ def cart_add_item_api(request):
     except Product.DoesNotExist:
         return Response({'error': 'Product not found'}, status=status.HTTP_404_NOT_FOUND)
     
-    # Get or create cart for user
-    cart, created = Cart.objects.get_or_create(user=request.user)
-    
-    # Get or create cart item
-    cart_item, created = CartItem.objects.get_or_create(
-        cart=cart,
-        product=product,
-        defaults={'quantity': quantity, 'price': product.get_price()}
-    )
-    
-    if not created:
-        cart_item.quantity += quantity
-        cart_item.save()
-    
-    # Calculate totals
-    total_items = sum(item.quantity for item in cart.items.all())
-    subtotal = sum(item.get_total_price() for item in cart.items.all())
+    cart = get_cart(request)
+    new_quantity = cart.add(product, quantity)
+    total_items, subtotal = cart.totals()
     
     return Response({
         'success': True,
         'product': ProductSerializer(product).data,
-        'quantity': cart_item.quantity,
+        'quantity': new_quantity,
         'total_items': total_items,
         'subtotal': subtotal
     }, status=status.HTTP_200_OK)
@@ -255,34 +262,25 @@ def cart_add_item_api(request):
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def cart_update_item_api(request):
-    """Update cart item quantity (API for tests)"""
+    """Update cart item quantity"""
     product_id = request.data.get('product_id')
     quantity = int(request.data.get('quantity', 1))
     
     if not product_id:
         return Response({'error': 'product_id is required'}, status=status.HTTP_400_BAD_REQUEST)
     
-    try:
-        product = Product.objects.get(pk=product_id, is_active=True)
-    except Product.DoesNotExist:
+    if not Product.objects.filter(pk=product_id, is_active=True).exists():
         return Response({'error': 'Product not found'}, status=status.HTTP_404_NOT_FOUND)
     
-    # Get cart
-    try:
-        cart = Cart.objects.get(user=request.user)
-        cart_item = CartItem.objects.get(cart=cart, product=product)
-        cart_item.quantity = quantity
-        cart_item.save()
-    except (Cart.DoesNotExist, CartItem.DoesNotExist):
+    cart = get_cart(request)
+    if not cart.quantity_of(product_id):
         return Response({'error': 'Item not in cart'}, status=status.HTTP_404_NOT_FOUND)
-    
-    # Calculate totals
-    total_items = sum(item.quantity for item in cart.items.all())
-    subtotal = sum(item.get_total_price() for item in cart.items.all())
+    new_quantity = cart.set(product_id, quantity)
+    total_items, subtotal = cart.totals()
     
     return Response({
         'success': True,
-        'quantity': cart_item.quantity,
+        'quantity': new_quantity,
         'total_items': total_items,
         'subtotal': subtotal
     }, status=status.HTTP_200_OK)
@@ -291,23 +289,16 @@ def cart_update_item_api(request):
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def cart_remove_item_api(request):
-    """Remove item from cart (API for tests)"""
+    """Remove item from cart"""
     product_id = request.data.get('product_id')
     
     if not product_id:
         return Response({'error': 'product_id is required'}, status=status.HTTP_400_BAD_REQUEST)
     
-    try:
-        product = Product.objects.get(pk=product_id)
-        cart = Cart.objects.get(user=request.user)
-        cart_item = CartItem.objects.get(cart=cart, product=product)
-        cart_item.delete()
-    except (Product.DoesNotExist, Cart.DoesNotExist, CartItem.DoesNotExist):
+    cart = get_cart(request)
+    if not cart.remove(product_id):
         return Response({'error': 'Item not in cart'}, status=status.HTTP_404_NOT_FOUND)
-    
-    # Calculate totals
-    total_items = sum(item.quantity for item in cart.items.all())
-    subtotal = sum(item.get_total_price() for item in cart.items.all())
+    total_items, subtotal = cart.totals()
     
     return Response({
         'success': True,
@@ -319,12 +310,8 @@ def cart_remove_item_api(request):
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def cart_clear_api(request):
-    """Clear all items from cart (API for tests)"""
-    try:
-        cart = Cart.objects.get(user=request.user)
-        cart.items.all().delete()
-    except Cart.DoesNotExist:
-        pass
+    """Clear all items from cart"""
+    get_cart(request).clear()
     
     return Response({
         'success': True,
@@ -336,45 +323,21 @@ def cart_clear_api(request):
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def cart_apply_coupon_api(request):
-    """Apply coupon to cart (API for tests)"""
+    """Apply coupon to cart"""
     code = request.data.get('code')
     
     if not code:
         return Response({'error': 'code is required'}, status=status.HTTP_400_BAD_REQUEST)
     
     try:
-        coupon = Coupon.objects.get(code=code, is_active=True)
-    except Coupon.DoesNotExist:
-        return Response({'error': 'Invalid coupon code'}, status=status.HTTP_404_NOT_FOUND)
-    
-    # Check if coupon is valid
-    if not coupon.is_valid():
-        return Response({'error': 'Coupon has expired or reached maximum uses'}, 
-                       status=status.HTTP_400_BAD_REQUEST)
-    
-    # Get cart
-    try:
-        cart = Cart.objects.get(user=request.user)
-    except Cart.DoesNotExist:
-        return Response({'error': 'Cart is empty'}, status=status.HTTP_400_BAD_REQUEST)
-    
-    # Calculate totals
-    subtotal = sum(item.get_total_price() for item in cart.items.all())
-    
-    # Check minimum purchase amount
-    if subtotal < coupon.min_purchase_amount:
-        return Response({
-            'error': f'Minimum purchase amount is {coupon.min_purchase_amount}'
-        }, status=status.HTTP_400_BAD_REQUEST)
-    
-    # Calculate discount
-    discount_amount = coupon.calculate_discount(subtotal)
-    final_total = subtotal - discount_amount
+        quote = coupons.check(code, request.user, get_cart(request))
+    except coupons.CouponError as e:
+        return Response({'error': e.message}, status=e.status)
     
     return Response({
         'success': True,
         'code': code,
-        'discount_amount': discount_amount,
-        'subtotal': subtotal,
-        'final_total': final_total
+        'discount_amount': quote.discount,
+        'subtotal': quote.subtotal,
+        'final_total': quote.subtotal - quote.discount
     }, status=status.HTTP_200_OK)
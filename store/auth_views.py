@@ -2,6 +2,8 @@
 Authentication Views
 Handles user registration, login, logout, and profile management
 """
+import math
+
 from django.shortcuts import render, redirect
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required
@@ -69,6 +71,14 @@ def register_view(request):
     return render(request, 'auth/register.html')
 
 
+def _locked_out(request, status):
+    minutes = max(1, math.ceil(status.retry_after / 60))
+    messages.error(request, f'Too many failed login attempts. Please try again in {minutes} minute(s).')
+    response = render(request, 'auth/login.html', status=429)
+    response['Retry-After'] = str(status.retry_after)
+    return response
+
+
 def login_view(request):
     """
     User login view
@@ -85,7 +95,8 @@ def login_view(request):
             messages.error(request, 'Username and password are required.')
             return render(request, 'auth/login.html')
         
-        # Authenticate user
+        # Authenticate user; LoginProtectionBackend refuses locked-out
+        # usernames/IPs and the auth signals count and audit the attempt
         user = authenticate(request, username=username, password=password)
         
         if user is not None:
@@ -96,6 +107,9 @@ def login_view(request):
             next_url = request.GET.get('next', request.POST.get('next', 'store:home'))
             return redirect(next_url)
         else:
+            status = getattr(request, 'login_check', None)
+            if status is not None and status.locked:
+                return _locked_out(request, status)
             messages.error(request, 'Invalid username or password.')
             return render(request, 'auth/login.html')
     
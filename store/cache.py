@@ -4,10 +4,12 @@ Implements caching strategy with automatic invalidation
 """
 from django.core.cache import cache
 from django.conf import settings
+from django.db import transaction
 from functools import wraps
 import hashlib
 import json
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +22,7 @@ CACHE_TIMEOUTS = {
     'search_results': 3600,  # 1 hour
     'top_products': 43200,  # 12 hours
     'recommendations': 86400,  # 24 hours
+    'checkout_session': 86400,  # 24 hours
 }
 
 
@@ -266,6 +269,32 @@ def get_product_recommendations(product_id, limit=5):
         return []
 
 
+CATALOG_VERSION_KEY = 'catalog:version'
+
+
+def get_catalog_version():
+    """
+    Timestamp of the last committed catalog change (products, brands,
+    categories, stock). Used as the validator for conditional GETs, so it
+    must live in a cache shared by all workers (Redis in production).
+    """
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, time.time(), None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    cache.set(CATALOG_VERSION_KEY, time.time(), None)
+
+
+def bump_catalog_version_on_commit():
+    """Bump once the current transaction commits, so readers never pair the
+    new version with uncommitted (or rolled back) data"""
+    transaction.on_commit(bump_catalog_version)
+
+
 def cache_user_session(user_id, data, timeout=None):
     """
     Cache user session data
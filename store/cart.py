@@ -0,0 +1,284 @@
+"""
+Cart Service - One cart API behind every cart page and endpoint
+Signed-in shoppers get a database cart whose item_count/subtotal columns are
+shifted with F() updates on every change, so badges and totals are a single
+row read; guests keep the session dict, which is folded into the database
+cart when they log in.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.contrib.auth import SESSION_KEY as AUTH_SESSION_KEY, get_user
+from django.core.exceptions import PermissionDenied
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from rest_framework.authentication import CSRFCheck
+
+from .models import Cart, CartItem, Product
+
+SESSION_CART_KEY = 'cart'
+ZERO = Decimal('0')
+
+CartLine = namedtuple('CartLine', 'product quantity unit_price subtotal')
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SessionCart:
+    """Guest cart: {"<product id>": quantity} in the session"""
+
+    def __init__(self, session):
+        self.session = session
+
+    def _raw(self):
+        return self.session.get(SESSION_CART_KEY, {})
+
+    def _store(self, items):
+        self.session[SESSION_CART_KEY] = items
+        self.session.modified = True
+
+    def quantities(self):
+        quantities = {}
+        for key, quantity in self._raw().items():
+            pid, quantity = _to_int(key), _to_int(quantity)
+            if pid is not None and quantity and quantity > 0:
+                quantities[pid] = quantities.get(pid, 0) + quantity
+        return quantities
+
+    def quantity_of(self, product_id):
+        return self.quantities().get(_to_int(product_id), 0)
+
+    def is_empty(self):
+        return not self.quantities()
+
+    def add(self, product, quantity=1):
+        if quantity < 1:
+            return self.quantity_of(product.pk)
+        items = dict(self._raw())
+        key = str(product.pk)
+        items[key] = items.get(key, 0) + quantity
+        self._store(items)
+        return items[key]
+
+    def set(self, product_id, quantity):
+        if quantity <= 0:
+            self.remove(product_id)
+            return 0
+        items = dict(self._raw())
+        items[str(product_id)] = quantity
+        self._store(items)
+        return quantity
+
+    def remove(self, product_id):
+        items = dict(self._raw())
+        if items.pop(str(product_id), None) is None:
+            return False
+        self._store(items)
+        return True
+
+    def clear(self):
+        self.session.pop(SESSION_CART_KEY, None)
+        self.session.modified = True
+
+    def lines(self):
+        quantities = self.quantities()
+        products = Product.objects.in_bulk(list(quantities))
+        lines = []
+        for pid, quantity in quantities.items():
+            product = products.get(pid)
+            if product is None:
+                continue
+            price = product.get_price()
+            lines.append(CartLine(product, quantity, price, price * quantity))
+        return lines
+
+    def line(self, product_id):
+        quantity = self.quantity_of(product_id)
+        product = Product.objects.filter(pk=_to_int(product_id)).first() if quantity else None
+        if product is None:
+            return None
+        price = product.get_price()
+        return CartLine(product, quantity, price, price * quantity)
+
+    def totals(self):
+        """(item count, subtotal)"""
+        lines = self.lines()
+        return sum(line.quantity for line in lines), sum((line.subtotal for line in lines), ZERO)
+
+    def fingerprint(self):
+        return sorted(self._raw().items())
+
+
+class DatabaseCart:
+    """Signed-in shopper's Cart row and its CartItems"""
+
+    def __init__(self, user):
+        self.user = user
+        self._cart = None
+
+    def _get_cart(self):
+        if self._cart is None:
+            self._cart, _ = Cart.objects.get_or_create(user=self.user)
+        return self._cart
+
+    def _items(self):
+        return CartItem.objects.filter(cart__user=self.user)
+
+    def _increment(self, cart_id, product_id, quantity):
+        """Bump an existing line in place; returns its new quantity or None"""
+        items = CartItem.objects.filter(cart_id=cart_id, product_id=product_id)
+        if not items.update(quantity=F('quantity') + quantity):
+            return None
+        price, new_quantity = items.values_list('price', 'quantity').get()
+        Cart.adjust_totals(cart_id, quantity, quantity * price)
+        return new_quantity
+
+    def quantities(self):
+        return dict(self._items().values_list('product_id', 'quantity'))
+
+    def quantity_of(self, product_id):
+        return self._items().filter(product_id=product_id).values_list('quantity', flat=True).first() or 0
+
+    def is_empty(self):
+        return self.totals()[0] == 0
+
+    @transaction.atomic
+    def add(self, product, quantity=1):
+        if quantity < 1:
+            return self.quantity_of(product.pk)
+        cart = self._get_cart()
+        new_quantity = self._increment(cart.pk, product.pk, quantity)
+        if new_quantity is not None:
+            return new_quantity
+        try:
+            with transaction.atomic():
+                # the CartItem post_save signal adds the new line to the totals
+                CartItem.objects.create(cart=cart, product=product, quantity=quantity, price=product.get_price())
+        except IntegrityError:
+            # a concurrent request created the line first
+            return self._increment(cart.pk, product.pk, quantity)
+        return quantity
+
+    @transaction.atomic
+    def set(self, product_id, quantity):
+        if quantity <= 0:
+            self.remove(product_id)
+            return 0
+        current = (
+            self._items().select_for_update().filter(product_id=product_id)
+            .values_list('pk', 'cart_id', 'quantity', 'price').first()
+        )
+        if current is None:
+            product = Product.objects.filter(pk=product_id).first()
+            return self.add(product, quantity) if product is not None else 0
+        pk, cart_id, old_quantity, price = current
+        CartItem.objects.filter(pk=pk).update(quantity=quantity)
+        delta = quantity - old_quantity
+        Cart.adjust_totals(cart_id, delta, delta * price)
+        return quantity
+
+    def remove(self, product_id):
+        item = self._items().filter(product_id=product_id).first()
+        if item is None:
+            return False
+        item.delete()  # CartItem post_delete takes it off the totals
+        return True
+
+    @transaction.atomic
+    def clear(self):
+        self._items().delete()
+
+    def lines(self):
+        """
+        Every line with its product; lines whose captured price no longer
+        matches the product are re-priced (and the totals shifted) here, so
+        the full cart view is where cached totals catch up with price changes
+        """
+        lines = []
+        repriced = ZERO
+        cart_id = None
+        for item in self._items().select_related('product').order_by('pk'):
+            price = item.product.get_price()
+            if item.price != price:
+                CartItem.objects.filter(pk=item.pk).update(price=price)
+                repriced += (price - item.price) * item.quantity
+                cart_id = item.cart_id
+            lines.append(CartLine(item.product, item.quantity, price, price * item.quantity))
+        if repriced:
+            Cart.adjust_totals(cart_id, 0, repriced)
+        return lines
+
+    def line(self, product_id):
+        item = self._items().filter(product_id=product_id).select_related('product').first()
+        if item is None:
+            return None
+        # the captured price is only for the cached totals; lines() re-prices them
+        price = item.product.get_price()
+        return CartLine(item.product, item.quantity, price, price * item.quantity)
+
+    def totals(self):
+        """(item count, subtotal) straight from the cart row"""
+        row = Cart.objects.filter(user=self.user).values_list('item_count', 'subtotal').first()
+        return row or (0, ZERO)
+
+    def fingerprint(self):
+        return list(Cart.objects.filter(user=self.user).values_list('item_count', 'subtotal', 'updated_at').first() or [])
+
+
+def _shopper(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user
+    # Public DRF endpoints run without authenticators, which replaces the
+    # session login with AnonymousUser; read the login from the session
+    session = getattr(request, 'session', None)
+    if session is not None and AUTH_SESSION_KEY in session:
+        django_request = getattr(request, '_request', request)
+        user = get_user(django_request)
+        if user.is_authenticated:
+            # those endpoints are csrf-exempt for guests; a signed-in
+            # shopper's persistent cart still needs the CSRF check
+            _enforce_csrf(django_request)
+            return user
+    return None
+
+
+def _enforce_csrf(request):
+    check = CSRFCheck(lambda _request: None)
+    check.process_request(request)
+    reason = check.process_view(request, None, (), {})
+    if reason:
+        raise PermissionDenied(f'CSRF Failed: {reason}')
+
+
+def merge_session_cart(session, user):
+    """Fold a guest session cart into the user's database cart"""
+    guest = SessionCart(session)
+    quantities = guest.quantities()
+    if quantities:
+        cart = DatabaseCart(user)
+        products = Product.objects.in_bulk(list(quantities))
+        with transaction.atomic():
+            for pid, quantity in quantities.items():
+                product = products.get(pid)
+                if product is not None:
+                    cart.add(product, quantity)
+    if SESSION_CART_KEY in session:
+        guest.clear()
+
+
+def get_cart(request):
+    """The cart for this request: database-backed when signed in, else session"""
+    user = _shopper(request)
+    session = getattr(request, 'session', None)
+    if user is None:
+        return SessionCart(session)
+    if session is not None and session.get(SESSION_CART_KEY):
+        # a guest cart left over from before login (or set by an older view)
+        merge_session_cart(session, user)
+    return DatabaseCart(user)
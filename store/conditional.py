@@ -0,0 +1,159 @@
+"""
+Conditional GET - ETag / Last-Modified validators and Cache-Control policies
+Catalog responses are validated against the catalog version (see
+store.cache.get_catalog_version) and Product.updated_at, so a revalidation
+that hits answers 304 before any catalog query or rendering happens.
+"""
+from datetime import datetime, timezone as dt_timezone
+from functools import partial, wraps
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.contrib import messages
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from rest_framework import status
+from rest_framework.response import Response
+
+from .cache import get_catalog_version
+from .cart import get_cart
+
+# Cache-Control per kind of response. Storefront pages carry per-visitor
+# bits (cart badge, login state), so shared caches must not store them.
+CACHE_POLICIES = {
+    'catalog_page': {'private': True, 'max_age': 0, 'must_revalidate': True},
+    'catalog_api': {'public': True, 'max_age': 60, 'stale_while_revalidate': 300},
+}
+
+
+def make_etag(*parts):
+    digest = hashlib.md5(json.dumps(parts, default=str, sort_keys=True).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def version_datetime(version):
+    return datetime.fromtimestamp(version, tz=dt_timezone.utc)
+
+
+def recommendations_epoch():
+    """
+    Start of the current recommendations window
+
+    Recommendations follow other shoppers' views, not the catalog, so pages
+    showing them add this to their validators and re-render at least once
+    every RECOMMENDATIONS_REFRESH_SECONDS.
+    """
+    period = max(int(getattr(settings, 'RECOMMENDATIONS_REFRESH_SECONDS', 300)), 1)
+    return version_datetime(int(time.time()) // period * period)
+
+
+def visitor_fingerprint(request):
+    """What makes an HTML page differ between visitors: login and cart"""
+    user = getattr(request, 'user', None)
+    user_id = user.pk if user is not None and user.is_authenticated else None
+    if getattr(request, 'session', None) is None:
+        return [user_id, []]
+    return [user_id, get_cart(request).fingerprint()]
+
+
+def not_modified(request, etag, last_modified=None):
+    """Return a 304 response when the request's validators match, else None"""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    response = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=int(last_modified.timestamp()) if last_modified else None,
+    )
+    if response is not None and response.status_code != 304:
+        # precondition failures (412) only apply to unsafe methods here
+        return None
+    return response
+
+
+def set_validators(response, etag, last_modified=None, policy=None):
+    if response.status_code not in (200, 304):
+        return response
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    if policy:
+        patch_cache_control(response, **CACHE_POLICIES[policy])
+    return response
+
+
+def conditional_catalog_page(view=None, on_not_modified=None):
+    """
+    Decorator for storefront catalog pages whose content depends only on the
+    catalog, the URL and the visitor fingerprint
+
+    `on_not_modified(request, *args, **kwargs)` runs for requests answered
+    with 304, for the side effects (e.g. search telemetry) the skipped view
+    would have had.
+    """
+    if view is None:
+        return partial(conditional_catalog_page, on_not_modified=on_not_modified)
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if len(messages.get_messages(request)):
+            # flash messages are rendered once; never answer 304 over them
+            return view(request, *args, **kwargs)
+        version = get_catalog_version()
+        etag = make_etag('page', version, request.get_full_path(), visitor_fingerprint(request))
+        last_modified = version_datetime(version)
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = view(request, *args, **kwargs)
+        elif on_not_modified is not None:
+            on_not_modified(request, *args, **kwargs)
+        return set_validators(response, etag, last_modified, 'catalog_page')
+    return wrapper
+
+
+class ConditionalGetMixin:
+    """
+    DRF viewset mixin: ETag/Last-Modified for list and retrieve, keyed on
+    the catalog version (plus the object's updated_at when it has one)
+    """
+    cache_policy = 'catalog_api'
+
+    def get_list_validators(self, request):
+        version = get_catalog_version()
+        etag = make_etag(
+            'list', type(self).__name__, version, request.get_full_path(), request.META.get('HTTP_ACCEPT', '')
+        )
+        return etag, version_datetime(version)
+
+    def get_object_validators(self, request):
+        version = get_catalog_version()
+        lookup = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        updated_at = None
+        model = self.get_queryset().model
+        if any(f.name == 'updated_at' for f in model._meta.fields):
+            updated_at = (
+                self.get_queryset().filter(**{self.lookup_field: lookup})
+                .values_list('updated_at', flat=True).first()
+            )
+        etag = make_etag(
+            'detail', type(self).__name__, version, lookup, updated_at,
+            request.get_full_path(), request.META.get('HTTP_ACCEPT', ''),
+        )
+        return etag, updated_at or version_datetime(version)
+
+    def _conditional(self, request, validators, handler, *args, **kwargs):
+        etag, last_modified = validators
+        cached = not_modified(request, etag, last_modified)
+        if cached is not None:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = handler(request, *args, **kwargs)
+        return set_validators(response, etag, last_modified, self.cache_policy)
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional(request, self.get_list_validators(request), super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional(request, self.get_object_validators(request), super().retrieve, *args, **kwargs)
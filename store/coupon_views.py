@@ -4,7 +4,9 @@ from django.views.decorators.http import require_POST, require_GET
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.utils import timezone
-from .models import Coupon, AppliedCoupon
+from . import coupons
+from .cart import get_cart
+from .models import Coupon
 
 
 @require_POST
@@ -16,65 +18,27 @@ def apply_coupon(request):
         return JsonResponse({'error': 'Coupon code is required'}, status=400)
     
     try:
-        coupon = Coupon.objects.get(code=coupon_code)
-    except Coupon.DoesNotExist:
-        return JsonResponse({'error': 'Invalid coupon code'}, status=404)
-    
-    # Validate coupon
-    if not coupon.is_valid():
-        return JsonResponse({'error': 'This coupon is not valid or has expired'}, status=400)
-    
-    # Calculate cart total
-    cart = request.session.get('cart', {})
-    cart_total = 0
-    
-    from .models import Product
-    for product_id, quantity in cart.items():
-        try:
-            product = Product.objects.get(pk=int(product_id), is_active=True)
-            cart_total += product.price * quantity
-        except Product.DoesNotExist:
-            continue
-    
-    # Check minimum purchase amount
-    if cart_total < coupon.min_purchase_amount:
-        return JsonResponse({
-            'error': f'Minimum purchase amount is ${coupon.min_purchase_amount}'
-        }, status=400)
-    
-    # Check user-specific coupons
-    if request.user.is_authenticated and coupon.allowed_users.exists():
-        if request.user not in coupon.allowed_users.all():
-            return JsonResponse({'error': 'This coupon is not available for your account'}, status=403)
-    
-    # Check per-user usage limit
-    if request.user.is_authenticated:
-        user_usage = AppliedCoupon.objects.filter(
-            coupon=coupon,
-            user=request.user
-        ).count()
-        if user_usage >= coupon.max_uses_per_user:
-            return JsonResponse({'error': 'You have already used this coupon'}, status=400)
+        quote = coupons.check(coupon_code, request.user, get_cart(request))
+    except coupons.CouponError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
     
-    # Calculate discount
-    discount = coupon.calculate_discount(cart_total)
-    final_total = max(cart_total - discount, 0)
+    final_total = max(quote.subtotal - quote.discount, 0)
     
-    # Store coupon in session
+    # Store coupon in session; checkout checks it again and redeems it
     request.session['applied_coupon'] = {
-        'code': coupon.code,
-        'discount': str(discount),
-        'discount_type': coupon.discount_type,
+        'code': quote.rules.code,
+        'discount': str(quote.discount),
+        'discount_type': quote.rules.discount_type,
     }
     request.session.modified = True
     
     return JsonResponse({
         'success': True,
-        'coupon_code': coupon.code,
-        'discount': str(discount),
-        'cart_total': str(cart_total),
+        'coupon_code': quote.rules.code,
+        'discount': str(quote.discount),
+        'cart_total': str(quote.subtotal),
         'final_total': str(final_total),
-        'discount_type': coupon.get_discount_type_display(),
+        'discount_type': dict(Coupon.DISCOUNT_CHOICES).get(quote.rules.discount_type, quote.rules.discount_type),
     })
 
 
@@ -0,0 +1,223 @@
+"""
+Coupon Engine - Cached coupon rules, eligibility and redemption
+A coupon's static rules (validity window, limits, allowed users and products
+as id sets) are compiled once and cached under the coupon version, which
+any coupon edit bumps. Checking a cart against them costs one query for the
+live usage counters, and redemption claims a use with a conditional UPDATE,
+so max_uses holds however many checkouts race for the last one.
+"""
+from collections import namedtuple
+from decimal import Decimal
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import AppliedCoupon, Coupon
+
+logger = logging.getLogger(__name__)
+
+COUPON_VERSION_KEY = 'coupon:version'
+CENT = Decimal('0.01')
+_MISSING = 'missing'  # cached for codes that do not exist
+
+
+class CouponError(Exception):
+    """A coupon that cannot be used; `status` is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        self.message = message
+        self.status = status
+        super().__init__(message)
+
+
+class CouponRules(namedtuple('CouponRules', [
+    'id', 'code', 'is_active', 'starts', 'ends', 'min_purchase_amount', 'max_uses', 'max_uses_per_user',
+    'discount_type', 'discount_value', 'discount_percentage', 'discount_amount',
+    'allowed_users', 'allowed_products',
+])):
+    """Everything about a coupon that only changes when staff edit it"""
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, coupon):
+        starts = [moment for moment in (coupon.start_date, coupon.valid_from) if moment]
+        ends = [moment for moment in (coupon.end_date, coupon.valid_to) if moment]
+        return cls(
+            id=coupon.pk,
+            code=coupon.code,
+            is_active=coupon.is_active,
+            starts=max(starts) if starts else None,
+            ends=min(ends) if ends else None,
+            min_purchase_amount=coupon.min_purchase_amount,
+            max_uses=coupon.max_uses,
+            max_uses_per_user=coupon.max_uses_per_user,
+            discount_type=coupon.discount_type,
+            discount_value=coupon.discount_value,
+            discount_percentage=coupon.discount_percentage,
+            discount_amount=coupon.discount_amount,
+            allowed_users=frozenset(coupon.allowed_users.values_list('pk', flat=True)),
+            allowed_products=frozenset(coupon.allowed_products.values_list('pk', flat=True)),
+        )
+
+    def is_open(self, now):
+        if not self.is_active:
+            return False
+        if self.starts and now < self.starts:
+            return False
+        return not (self.ends and now > self.ends)
+
+    def discount(self, total):
+        """Discount on `total`, as Coupon.calculate_discount computes it"""
+        if self.discount_value:
+            if self.discount_type == Coupon.DISCOUNT_PERCENTAGE:
+                return total * self.discount_value / Decimal('100')
+            if self.discount_type == Coupon.DISCOUNT_FIXED:
+                return min(self.discount_value, total)
+        if self.discount_percentage:
+            return total * self.discount_percentage / Decimal('100')
+        if self.discount_amount:
+            return min(self.discount_amount, total)
+        return Decimal('0')
+
+
+Quote = namedtuple('Quote', ['rules', 'subtotal', 'discount'])
+
+
+def get_coupon_version():
+    version = cache.get(COUPON_VERSION_KEY)
+    if version is None:
+        version = 1
+        cache.add(COUPON_VERSION_KEY, version, None)
+    return version
+
+
+def bump_coupon_version():
+    try:
+        cache.incr(COUPON_VERSION_KEY)
+    except ValueError:
+        cache.set(COUPON_VERSION_KEY, 2, None)
+
+
+def get_rules(code):
+    """Compiled rules for `code`, or None if there is no such coupon"""
+    key = f'coupon:rules:{get_coupon_version()}:{code}'
+    rules = cache.get(key)
+    if rules is None:
+        coupon = Coupon.objects.filter(code=code).first()
+        rules = CouponRules.compile(coupon) if coupon else _MISSING
+        cache.set(key, rules, getattr(settings, 'COUPON_CACHE_SECONDS', 300))
+    return None if rules == _MISSING else rules
+
+
+def _usage(rules, user):
+    """(used_count, uses by `user`) in one query"""
+    mine = Value(0)
+    if user is not None:
+        mine = Coalesce(Subquery(
+            AppliedCoupon.objects.filter(coupon=OuterRef('pk'), user=user)
+            .values('coupon').annotate(uses=Count('pk')).values('uses')
+        ), 0)
+    row = Coupon.objects.filter(pk=rules.id).annotate(mine=mine).values_list('used_count', 'mine').first()
+    if row is None:
+        raise CouponError('Invalid coupon code', status=404)
+    return row
+
+
+def _user(user):
+    return user if user is not None and user.is_authenticated else None
+
+
+def check(code, user, cart, now=None):
+    """
+    Quote `code` against a cart; raises CouponError if it cannot be used
+
+    The discount applies to the whole subtotal, or only to the allowed
+    products' lines when the coupon is limited to some products.
+    """
+    rules = get_rules(code)
+    if rules is None:
+        raise CouponError('Invalid coupon code', status=404)
+    if not rules.is_open(now or timezone.now()):
+        raise CouponError('This coupon is not valid or has expired')
+
+    count, subtotal = cart.totals()
+    if not count:
+        raise CouponError('Cart is empty')
+    if subtotal < rules.min_purchase_amount:
+        raise CouponError(f'Minimum purchase amount is {rules.min_purchase_amount}')
+
+    user = _user(user)
+    if rules.allowed_users and (user is None or user.pk not in rules.allowed_users):
+        raise CouponError('This coupon is not available for your account', status=403)
+
+    eligible = subtotal
+    if rules.allowed_products:
+        eligible = sum(
+            (line.subtotal for line in cart.lines() if line.product.pk in rules.allowed_products), Decimal('0')
+        )
+        if not eligible:
+            raise CouponError('This coupon does not apply to the products in your cart')
+
+    used, mine = _usage(rules, user)
+    if rules.max_uses and used >= rules.max_uses:
+        raise CouponError('This coupon has reached its usage limit')
+    if user is not None and mine >= rules.max_uses_per_user:
+        raise CouponError('You have already used this coupon')
+
+    return Quote(rules, subtotal, rules.discount(eligible).quantize(CENT))
+
+
+def redeem(quote, user, session_key=None, order=None):
+    """
+    Claim one use of a checked coupon and record it (against `order`, when
+    given); raises CouponError if the last use went to someone else in the
+    meantime
+    """
+    rules, user = quote.rules, _user(user)
+    with transaction.atomic():
+        claimed = Coupon.objects.filter(pk=rules.id, is_active=True).filter(
+            Q(max_uses__isnull=True) | Q(max_uses=0) | Q(used_count__lt=F('max_uses'))
+        ).update(used_count=F('used_count') + 1)
+        if not claimed:
+            raise CouponError('This coupon has reached its usage limit')
+        # the UPDATE above holds the coupon row until commit, so redemptions
+        # of one coupon are serialized and this count cannot go stale
+        if user is not None:
+            uses = AppliedCoupon.objects.filter(coupon_id=rules.id, user=user).count()
+            if uses >= rules.max_uses_per_user:
+                raise CouponError('You have already used this coupon')
+        applied = AppliedCoupon.objects.create(
+            coupon_id=rules.id, user=user, session_key=session_key, order=order, discount_amount=quote.discount,
+        )
+    logger.info(f"Coupon {rules.code} redeemed ({quote.discount} off)")
+    return applied
+
+
+def release(order):
+    """Give back the coupon uses of an order that will never be paid; returns how many"""
+    return release_orders([order.pk])
+
+
+def release_orders(order_ids):
+    """
+    Give back the coupon uses of many canceled orders
+
+    One UPDATE lowers each coupon's used_count by its uses among the orders
+    and one DELETE drops their AppliedCoupon rows. Returns how many uses
+    were given back.
+    """
+    applied = AppliedCoupon.objects.filter(order_id__in=order_ids)
+    uses = Subquery(
+        applied.filter(coupon=OuterRef('pk')).order_by().values('coupon').annotate(uses=Count('pk')).values('uses')
+    )
+    with transaction.atomic():
+        Coupon.objects.filter(pk__in=applied.values('coupon_id')).update(
+            used_count=Greatest(F('used_count') - Coalesce(uses, 0), Value(0))
+        )
+        released, _ = applied.delete()
+    return released
@@ -1,9 +1,14 @@
-from django.core.mail import send_mail
+from django.core.mail import send_mail, send_mass_mail
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.utils import timezone
+from django.db import transaction
+from django.db.models import Max
 from .models import EmailQueue, EmailTemplate
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def queue_email(to_email, subject, html_content, text_content=''):
@@ -112,27 +117,151 @@ def send_welcome_email(user):
     queue_email(user.email, subject, html_content)
 
 
-def send_back_in_stock_notifications(product):
-    """Send notifications when product is back in stock"""
-    from .models import BackInStockNotification
-    
-    notifications = BackInStockNotification.objects.filter(
-        product=product,
-        notified=False
+def order_recipient(order):
+    """Email of the account that placed the order, or None"""
+    if order.user and getattr(order.user, "email", None):
+        return order.user.email
+    return None
+
+
+def order_created_message(order):
+    subject = f"Đơn hàng #{order.id} đã được tạo"
+    body = (
+        f"Xin chào {order.full_name},\n\n"
+        f"Đơn hàng #{order.id} của bạn đã được tạo và đang chờ xử lý.\n"
+        f"Trạng thái hiện tại: {order.get_status_display()}.\n\n"
+        "Cảm ơn bạn đã mua hàng!"
     )
-    
-    subject = f'{product.name} is Back in Stock!'
-    html_content = f"""
+    return subject, body
+
+
+def order_status_message(order, old_status):
+    from .models import Order
+
+    subject = f"Đơn hàng #{order.id} cập nhật trạng thái"
+    body = (
+        f"Xin chào {order.full_name},\n\n"
+        f"Đơn hàng #{order.id} đã chuyển từ '{dict(Order.STATUS_CHOICES).get(old_status, old_status)}' "
+        f"sang '{order.get_status_display()}'.\n\n"
+        "Cảm ơn bạn đã mua hàng!"
+    )
+    return subject, body
+
+
+def order_paid_message(order):
+    subject = f"Đơn hàng #{order.id} đã được thanh toán"
+    body = (
+        f"Xin chào {order.full_name},\n\n"
+        f"Đơn hàng #{order.id} đã được xác nhận thanh toán thành công.\n"
+        f"Phương thức: {order.get_payment_method_display()}.\n"
+        f"Trạng thái hiện tại: {order.get_status_display()}.\n\n"
+        "Cảm ơn bạn đã mua hàng!"
+    )
+    return subject, body
+
+
+def send_order_messages(messages):
+    """Send [(subject, body, recipient)] over one mail connection"""
+    from_email = getattr(settings, "DEFAULT_FROM_EMAIL", None) or None
+    try:
+        return send_mass_mail(
+            [(subject, body, from_email, [recipient]) for subject, body, recipient in messages],
+            fail_silently=True,
+        )
+    except Exception as e:
+        logger.error(f"Failed to send {len(messages)} order emails: {e}")
+        return 0
+
+
+BACK_IN_STOCK_CHUNK_SIZE = 1000
+
+
+def render_back_in_stock_email(product):
+    """Render the back-in-stock email once; returns (template, subject, html_content)"""
+    try:
+        template = EmailTemplate.objects.get(
+            email_type=EmailTemplate.EMAIL_BACK_IN_STOCK,
+            is_active=True
+        )
+        subject = template.subject.format(product_name=product.name)
+        html_content = template.html_content.format(
+            user_name='Customer',
+            product_name=product.name,
+            product_url=f"{settings.SITE_URL}/products/{product.id}/",
+            site_url=settings.SITE_URL
+        )
+    except EmailTemplate.DoesNotExist:
+        template = None
+        subject = f'{product.name} is Back in Stock!'
+        html_content = f"""
     <h2>{product.name} is Back in Stock!</h2>
     <p>The product you were waiting for is now available.</p>
-    <p>Click here to view: <a href="#">View Product</a></p>
+    <p>Click here to view: <a href="{settings.SITE_URL}/products/{product.id}/">View Product</a></p>
     """
-    
-    for notification in notifications:
-        queue_email(notification.email, subject, html_content)
-        notification.notified = True
-        notification.notified_at = timezone.now()
-        notification.save()
+    return template, subject, html_content
+
+
+def send_back_in_stock_notifications(product, chunk_size=BACK_IN_STOCK_CHUNK_SIZE):
+    """Queue back-in-stock emails for every waiting subscriber of a product
+
+    The email is rendered once, EmailQueue rows are bulk-inserted chunk by
+    chunk and subscribers are marked notified with a single UPDATE. Returns
+    the number of emails queued.
+    """
+    from .models import BackInStockNotification
+
+    pending = BackInStockNotification.objects.filter(product=product, notified=False)
+    # Snapshot the subscriber set so people signing up mid-run are left for
+    # the next restock instead of being marked notified without an email.
+    last_id = pending.aggregate(last_id=Max('id'))['last_id']
+    if last_id is None:
+        return 0
+    pending = pending.filter(id__lte=last_id)
+
+    template, subject, html_content = render_back_in_stock_email(product)
+    text_content = strip_tags(html_content)
+
+    queued = 0
+    with transaction.atomic():
+        emails = pending.order_by('id').values_list('email', flat=True)
+        for chunk in _chunked(emails.iterator(chunk_size=chunk_size), chunk_size):
+            EmailQueue.objects.bulk_create([
+                EmailQueue(
+                    template=template,
+                    to_email=email,
+                    subject=subject,
+                    html_content=html_content,
+                    text_content=text_content,
+                    context_data={'product_id': product.id},
+                )
+                for email in chunk
+            ])
+            queued += len(chunk)
+        pending.update(notified=True, notified_at=timezone.now())
+
+    logger.info(f"Queued {queued} back-in-stock emails for product {product.id}")
+    return queued
+
+
+def fan_out_back_in_stock(product_id):
+    """Background job entry point for send_back_in_stock_notifications"""
+    from .models import Product
+
+    product = Product.objects.filter(pk=product_id).first()
+    if product is None:
+        return 0
+    return send_back_in_stock_notifications(product)
+
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 def send_cart_abandonment_emails():
@@ -0,0 +1,94 @@
+"""
+HyperLogLog - Mergeable approximate distinct counting
+A sketch keeps 2**precision one-byte registers; the count has a relative
+standard error of 1.04/sqrt(2**precision), about 1.6% at the default
+precision of 12 (so within 3.3% for ~95% of counts). Sketches over the
+same precision merge by taking the register-wise maximum, which gives the
+sketch of the union: daily sketches combine into any date range.
+"""
+import hashlib
+import math
+import struct
+
+DEFAULT_PRECISION = 12
+
+_DENSE = 0
+_SPARSE = 1
+_SPARSE_ENTRY = struct.Struct('>HB')
+
+
+class HyperLogLog:
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        if not 4 <= precision <= 16:
+            raise ValueError(f"precision must be between 4 and 16, not {precision}")
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    @property
+    def relative_error(self):
+        """Standard error of count() as a fraction of the true count"""
+        return 1.04 / math.sqrt(self.size)
+
+    @staticmethod
+    def _hash(value):
+        digest = hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+
+    def add(self, value):
+        hashed = self._hash(value)
+        tail_bits = 64 - self.precision
+        index = hashed >> tail_bits
+        tail = hashed & ((1 << tail_bits) - 1)
+        rank = tail_bits - tail.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other):
+        """Fold `other` into this sketch (union of both sets)"""
+        if other.precision != self.precision:
+            raise ValueError("cannot merge sketches of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        size = self.size
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(size, 0.7213 / (1 + 1.079 / size))
+        estimate = alpha * size * size / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if zeros and estimate <= 2.5 * size:
+            # linear counting is more accurate while many registers are empty
+            return round(size * math.log(size / zeros))
+        return round(estimate)
+
+    def __len__(self):
+        return self.count()
+
+    def to_bytes(self):
+        """Serialize; sketches with few set registers are stored sparsely"""
+        used = [(index, rank) for index, rank in enumerate(self.registers) if rank]
+        if len(used) * _SPARSE_ENTRY.size < self.size:
+            body = b''.join(_SPARSE_ENTRY.pack(index, rank) for index, rank in used)
+            return bytes([self.precision, _SPARSE]) + body
+        return bytes([self.precision, _DENSE]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data:
+            return cls()
+        data = bytes(data)
+        sketch = cls(data[0])
+        if data[1] == _SPARSE:
+            for index, rank in _SPARSE_ENTRY.iter_unpack(data[2:]):
+                sketch.registers[index] = rank
+        elif len(data) - 2 == sketch.size:
+            sketch.registers[:] = data[2:]
+        else:
+            raise ValueError("corrupt HyperLogLog sketch")
+        return sketch
@@ -0,0 +1,172 @@
+"""
+Image Pipeline - Batch watermarking and responsive variants
+Watermarks every catalog image in a process pool, emits downscaled
+WebP/JPEG variants next to the full-size PNG and records everything in
+the watermark manifest. Images whose content hash is unchanged are skipped.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import hashlib
+import logging
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from .models import Product
+from .watermark import default_logo_path, encode_variants, file_sha1, render_watermark
+from .watermark_manifest import get_manifest
+
+logger = logging.getLogger(__name__)
+
+
+def variant_spec(widths, formats):
+    return {'widths': sorted(set(widths)), 'formats': list(formats)}
+
+
+def process_image(job):
+    """
+    Worker: watermark one image and encode its variants
+
+    `job` carries everything the worker needs (no ORM or storage access), so
+    it runs the same in a child process as inline. Returns a result dict
+    with 'status' of 'processed', 'skipped' or 'error'.
+    """
+    name = job['name']
+    try:
+        if job.get('path'):
+            sha1 = file_sha1(job['path'])
+            source = job['path']
+        else:
+            sha1 = hashlib.sha1(job['content']).hexdigest()
+            source = BytesIO(job['content'])
+
+        previous = job.get('previous') or {}
+        if (not job.get('force') and previous.get('sha1') == sha1
+                and previous.get('spec') == job['spec']):
+            return {'name': name, 'status': 'skipped'}
+
+        image = render_watermark(source, name, job.get('logo_path'))
+        if image is None:
+            return {'name': name, 'status': 'error', 'error': 'unreadable image'}
+
+        base_name, _ext = os.path.splitext(name)
+        buf = BytesIO()
+        image.save(buf, format='PNG')
+        png_name = f"{base_name}_wm.png"
+        variants, files = encode_variants(
+            image, base_name, job['spec']['widths'], job['spec']['formats']
+        )
+        files[png_name] = buf.getvalue()
+        return {
+            'name': name,
+            'status': 'processed',
+            'entry': {
+                'name': png_name,
+                'width': image.width,
+                'height': image.height,
+                'sha1': sha1,
+                'spec': job['spec'],
+                'variants': variants,
+            },
+            'files': files,
+        }
+    except Exception as e:
+        return {'name': name, 'status': 'error', 'error': repr(e)}
+
+
+def _save(name, data):
+    # overwrite in place so variant URLs stay stable across runs
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    saved = default_storage.save(name, ContentFile(data))
+    if saved != name:
+        logger.warning(f"Image pipeline: {name} stored as {saved}")
+    return saved
+
+
+def _entry_files(entry):
+    names = {entry['name']}
+    for variant in entry.get('variants', {}).values():
+        names.update(v for k, v in variant.items() if k != 'height')
+    return names
+
+
+def build_jobs(names, entries, spec, force=False):
+    logo_path = default_logo_path()
+    for name in names:
+        job = {
+            'name': name,
+            'spec': spec,
+            'previous': entries.get(name),
+            'force': force,
+            'logo_path': logo_path,
+        }
+        try:
+            job['path'] = default_storage.path(name)
+        except NotImplementedError:
+            # remote storage: ship the bytes to the worker instead
+            with default_storage.open(name, 'rb') as fh:
+                job['content'] = fh.read()
+        yield job
+
+
+def run_pipeline(names=None, workers=None, force=False, widths=None, formats=None):
+    """
+    Process catalog images (all product images by default)
+
+    Returns a report dict: processed, skipped, errors (list of (name, error)).
+    The entries this run produced are merged into the manifest once at the end.
+    """
+    widths = widths or getattr(settings, 'WATERMARK_VARIANT_WIDTHS', [300, 600, 1200])
+    formats = formats or getattr(settings, 'WATERMARK_VARIANT_FORMATS', ['webp', 'jpeg'])
+    spec = variant_spec(widths, formats)
+    if names is None:
+        names = list(
+            Product.objects.exclude(image='').exclude(image__isnull=True)
+            .order_by().values_list('image', flat=True).distinct()
+        )
+
+    manifest = get_manifest()
+    manifest.invalidate()
+    entries = dict(manifest.entries())
+    jobs = build_jobs(names, entries, spec, force=force)
+    workers = workers or os.cpu_count() or 1
+
+    produced = {}
+    report = {'processed': 0, 'skipped': 0, 'errors': []}
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(process_image, jobs, chunksize=4)
+    else:
+        executor = None
+        results = map(process_image, jobs)
+    try:
+        for result in results:
+            name = result['name']
+            if result['status'] == 'skipped':
+                report['skipped'] += 1
+                continue
+            if result['status'] == 'error':
+                logger.error(f"Image pipeline failed for {name}: {result['error']}")
+                report['errors'].append((name, result['error']))
+                continue
+
+            for file_name, data in result['files'].items():
+                _save(file_name, data)
+            previous = entries.get(name)
+            if previous:
+                for stale in _entry_files(previous) - set(result['files']):
+                    default_storage.delete(stale)
+            produced[name] = result['entry']
+            report['processed'] += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if produced:
+        # merge only this run's entries into the latest manifest, so records
+        # made by product saves during the run survive
+        manifest.update(produced)
+    return report
@@ -0,0 +1,458 @@
+"""
+Bulk Inventory Engine - Warehouse sync and stock reconciliation
+Applies thousands of stock changes with a handful of set-based queries
+"""
+import csv
+import io
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from django.utils import timezone
+
+from .cache import bump_catalog_version_on_commit
+from .email_utils import fan_out_back_in_stock
+from .models import Product, StockLevel, StockAlert, StockReservation
+from .tasks import enqueue
+
+logger = logging.getLogger(__name__)
+
+# Keep IN (...) lists well under database parameter limits
+LOOKUP_CHUNK_SIZE = 500
+BULK_BATCH_SIZE = 500
+
+
+def _chunked(items, size=LOOKUP_CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def parse_stock_file(data, fmt=None):
+    """
+    Parse a warehouse export into (quantities, invalid)
+
+    `data` is text or bytes in CSV (columns `sku,quantity`) or JSON (either
+    {"SKU": qty, ...} or [{"sku": ..., "quantity": ...}, ...]). `fmt` is
+    'csv' or 'json'; when omitted it is guessed from the first character.
+    `quantities` maps SKU -> int; `invalid` lists rows that were skipped.
+    Raises ValueError when the payload cannot be read at all.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+    text = data.strip()
+    if fmt is None:
+        fmt = 'json' if text[:1] in ('{', '[') else 'csv'
+
+    if fmt == 'json':
+        try:
+            payload = json.loads(text or '{}')
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {e}")
+        if isinstance(payload, dict):
+            rows = payload.items()
+        elif isinstance(payload, list):
+            try:
+                rows = [(row['sku'], row['quantity']) for row in payload]
+            except (TypeError, KeyError):
+                raise ValueError("JSON rows must be objects with 'sku' and 'quantity'")
+        else:
+            raise ValueError("JSON payload must be an object or a list")
+    elif fmt == 'csv':
+        reader = csv.DictReader(io.StringIO(text))
+        fieldnames = [(name or '').strip().lower() for name in reader.fieldnames or []]
+        if not {'sku', 'quantity'} <= set(fieldnames):
+            raise ValueError("CSV must have 'sku' and 'quantity' columns")
+        reader.fieldnames = fieldnames
+        rows = ((row.get('sku'), row.get('quantity')) for row in reader)
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+
+    quantities = {}
+    invalid = []
+    for sku, quantity in rows:
+        sku = str(sku or '').strip()
+        try:
+            quantity = int(str(quantity).strip())
+        except (TypeError, ValueError):
+            quantity = -1
+        if not sku or quantity < 0:
+            invalid.append({'sku': sku, 'quantity': quantity})
+            continue
+        quantities[sku] = quantity
+    return quantities, invalid
+
+
+def resolve_skus(skus):
+    """
+    Map SKUs to product ids; products without a SKU are matched by slug
+    Returns (sku -> product_id, unknown_skus)
+    """
+    skus = set(skus)
+    resolved = {}
+    for chunk in _chunked(skus):
+        resolved.update(Product.objects.filter(sku__in=chunk).values_list('sku', 'id'))
+    missing = skus - resolved.keys()
+    for chunk in _chunked(missing):
+        for slug, product_id in Product.objects.filter(
+            sku__isnull=True, slug__in=chunk
+        ).values_list('slug', 'id'):
+            resolved.setdefault(slug, product_id)
+    return resolved, sorted(skus - resolved.keys())
+
+
+def import_stock(quantities, dry_run=False):
+    """
+    Apply a SKU -> quantity mapping (e.g. the nightly warehouse sync)
+    Returns the apply_stock_levels report plus the unknown SKUs
+    """
+    sku_to_id, unknown = resolve_skus(quantities)
+    id_to_sku = {product_id: sku for sku, product_id in sku_to_id.items()}
+    report = apply_stock_levels(
+        {product_id: quantities[sku] for sku, product_id in sku_to_id.items()},
+        dry_run=dry_run,
+    )
+    for change in report['changes']:
+        change['sku'] = id_to_sku.get(change['product_id'])
+    report['unknown'] = unknown
+    return report
+
+
+def apply_stock_levels(quantities, dry_run=False, chunk_size=LOOKUP_CHUNK_SIZE):
+    """
+    Set stock for many products at once
+
+    `quantities` maps product_id -> new quantity. Missing StockLevel rows are
+    bulk-created, changed ones are bulk-updated (mirrored to
+    Product.stock_quantity), alerts are reconciled set-wise and products that
+    come back from zero get their back-in-stock fan-out queued.
+
+    Each chunk of products is applied in its own short transaction stamped
+    with its own time, so catalog delta sync cursors (which hold back rows
+    newer than CATALOG_SYNC_SETTLE_SECONDS) never skip rows of a long import
+    that commit late. A failure leaves the earlier chunks applied.
+    """
+    report = {
+        'created': 0,
+        'updated': 0,
+        'unchanged': 0,
+        'restocked': [],
+        'alerts_created': 0,
+        'alerts_resolved': 0,
+        'changes': [],
+        'dry_run': dry_run,
+    }
+    if not quantities:
+        return report
+
+    for chunk in _chunked(quantities, chunk_size):
+        _apply_stock_chunk({product_id: quantities[product_id] for product_id in chunk}, report, dry_run)
+
+    logger.info(
+        f"Stock sync: {report['created']} created, {report['updated']} updated, "
+        f"{report['unchanged']} unchanged, {report['alerts_created']} alerts opened, "
+        f"{report['alerts_resolved']} alerts resolved"
+    )
+    return report
+
+
+def _apply_stock_chunk(quantities, report, dry_run):
+    """Apply one chunk of apply_stock_levels in one transaction, adding to `report`"""
+    with transaction.atomic():
+        now = timezone.now()
+        stocks = {
+            stock.product_id: stock
+            for stock in StockLevel.objects.select_for_update().filter(product_id__in=list(quantities))
+        }
+
+        to_create = []
+        to_update = []
+        restocked = []
+        for product_id, quantity in quantities.items():
+            stock = stocks.get(product_id)
+            if stock is None:
+                stock = StockLevel(product_id=product_id, quantity=quantity, last_restocked=now, updated_at=now)
+                stocks[product_id] = stock
+                to_create.append(stock)
+                old_quantity = 0
+            elif stock.quantity == quantity:
+                report['unchanged'] += 1
+                continue
+            else:
+                old_quantity = stock.quantity
+                if quantity > old_quantity:
+                    stock.last_restocked = now
+                stock.quantity = quantity
+                stock.updated_at = now
+                to_update.append(stock)
+            if old_quantity == 0 and quantity > 0:
+                restocked.append(product_id)
+            report['changes'].append({'product_id': product_id, 'old': old_quantity, 'new': quantity})
+
+        report['created'] += len(to_create)
+        report['updated'] += len(to_update)
+        report['restocked'].extend(restocked)
+
+        if dry_run:
+            transaction.set_rollback(True)
+            return
+
+        StockLevel.objects.bulk_create(to_create, batch_size=BULK_BATCH_SIZE)
+        StockLevel.objects.bulk_update(
+            to_update, ['quantity', 'last_restocked', 'updated_at'], batch_size=BULK_BATCH_SIZE
+        )
+        changed = to_create + to_update
+        products = [
+            Product(pk=stock.product_id, stock_quantity=stock.quantity, updated_at=now)
+            for stock in changed
+        ]
+        Product.objects.bulk_update(products, ['stock_quantity', 'updated_at'], batch_size=BULK_BATCH_SIZE)
+        if changed:
+            bump_catalog_version_on_commit()
+
+        created, resolved = sync_stock_alerts(changed, now=now)
+        report['alerts_created'] += created
+        report['alerts_resolved'] += resolved
+
+        for product_id in restocked:
+            enqueue(fan_out_back_in_stock, product_id)
+
+
+def sync_stock_alerts(stocks, now=None):
+    """
+    Reconcile open StockAlerts against the given StockLevel rows
+
+    Opens missing 'out'/'low' alerts with one bulk insert and resolves
+    alerts that no longer match the stock state with one UPDATE per chunk.
+    Returns (alerts_created, alerts_resolved).
+    """
+    now = now or timezone.now()
+    state = {}
+    for stock in stocks:
+        if stock.is_out_of_stock:
+            state[stock.product_id] = StockAlert.ALERT_OUT
+        elif stock.is_low_stock:
+            state[stock.product_id] = StockAlert.ALERT_LOW
+        else:
+            state[stock.product_id] = None
+
+    created = 0
+    resolved = 0
+    for chunk in _chunked(state):
+        open_alerts = set(
+            StockAlert.objects.filter(product_id__in=chunk, resolved=False)
+            .values_list('product_id', 'alert_type')
+        )
+        new_alerts = [
+            StockAlert(product_id=product_id, alert_type=state[product_id])
+            for product_id in chunk
+            if state[product_id] and (product_id, state[product_id]) not in open_alerts
+        ]
+        StockAlert.objects.bulk_create(new_alerts, batch_size=BULK_BATCH_SIZE)
+        created += len(new_alerts)
+
+        stale = Q()
+        for alert_type in (StockAlert.ALERT_OUT, StockAlert.ALERT_LOW):
+            ids = [pid for pid in chunk if state[pid] != alert_type and (pid, alert_type) in open_alerts]
+            if ids:
+                stale |= Q(product_id__in=ids, alert_type=alert_type)
+        if stale:
+            resolved += StockAlert.objects.filter(stale, resolved=False).update(resolved=True, resolved_at=now)
+    return created, resolved
+
+
+# ============= Checkout Reservations =============
+
+class InsufficientStock(Exception):
+    """Raised when a checkout line asks for more units than are in stock"""
+
+    def __init__(self, product_id, requested, available):
+        self.product_id = product_id
+        self.requested = requested
+        self.available = available
+        super().__init__(f"Product {product_id}: requested {requested}, available {available}")
+
+
+def _sync_product_stock(product_ids):
+    """Mirror StockLevel.quantity onto Product.stock_quantity with one UPDATE"""
+    Product.objects.filter(pk__in=product_ids, stock__isnull=False).update(
+        stock_quantity=Subquery(
+            StockLevel.objects.filter(product_id=OuterRef('pk')).values('quantity')[:1]
+        ),
+        updated_at=timezone.now(),
+    )
+    bump_catalog_version_on_commit()
+
+
+def _tracked(product_ids):
+    """The products among `product_ids` whose stock lives in a StockLevel row"""
+    return set(StockLevel.objects.filter(product_id__in=product_ids).values_list('product_id', flat=True))
+
+
+def _take(product_id, quantity, tracked, now):
+    """
+    Decrement one product's stock with a conditional UPDATE ... WHERE stock >= n
+
+    Tracked products are taken from StockLevel, the rest from
+    Product.stock_quantity. Returns whether the stock was there.
+    """
+    if product_id in tracked:
+        return StockLevel.objects.filter(product_id=product_id, quantity__gte=quantity).update(
+            quantity=F('quantity') - quantity, updated_at=now
+        )
+    return Product.objects.filter(pk=product_id, stock_quantity__gte=quantity).update(
+        stock_quantity=F('stock_quantity') - quantity, updated_at=now
+    )
+
+
+def _restock(product_id, quantity, tracked, now):
+    if product_id in tracked:
+        StockLevel.objects.filter(product_id=product_id).update(quantity=F('quantity') + quantity, updated_at=now)
+    else:
+        Product.objects.filter(pk=product_id).update(stock_quantity=F('stock_quantity') + quantity, updated_at=now)
+
+
+def _stock_changed(product_ids, tracked, now):
+    """Mirror tracked products onto Product and let catalog caches see the change"""
+    product_ids = set(product_ids)
+    if product_ids & tracked:
+        _sync_product_stock(product_ids & tracked)
+        sync_stock_alerts(StockLevel.objects.filter(product_id__in=product_ids & tracked), now=now)
+    if product_ids - tracked:
+        bump_catalog_version_on_commit()
+
+
+def reserve_stock(order, quantities, ttl=None):
+    """
+    Take stock for an order's lines, atomically and without oversell
+
+    `quantities` maps product_id -> units. Each line is decremented with a
+    conditional UPDATE ... SET quantity = quantity - n WHERE quantity >= n,
+    on the product's StockLevel row when it has one and on
+    Product.stock_quantity otherwise, so two checkouts racing for the last
+    unit cannot both win. Raises InsufficientStock and rolls back every
+    decrement if any line cannot be satisfied.
+    Returns the created (held) StockReservation rows.
+    """
+    if ttl is None:
+        ttl = timedelta(minutes=getattr(settings, 'STOCK_RESERVATION_TTL_MINUTES', 30))
+    now = timezone.now()
+
+    with transaction.atomic():
+        tracked = _tracked(quantities)
+        # Fixed lock order keeps concurrent multi-line checkouts from deadlocking
+        for product_id in sorted(quantities):
+            requested = quantities[product_id]
+            if not _take(product_id, requested, tracked, now):
+                if product_id in tracked:
+                    available = StockLevel.objects.filter(product_id=product_id).values_list('quantity', flat=True)
+                else:
+                    available = Product.objects.filter(pk=product_id).values_list('stock_quantity', flat=True)
+                raise InsufficientStock(product_id, requested, available.first() or 0)
+
+        reservations = StockReservation.objects.bulk_create([
+            StockReservation(
+                order=order,
+                product_id=product_id,
+                quantity=quantities[product_id],
+                expires_at=now + ttl,
+            )
+            for product_id in sorted(quantities)
+        ])
+        _stock_changed(quantities, tracked, now)
+    return reservations
+
+
+def commit_reservations(order):
+    """
+    Make an order's reservations permanent once payment is confirmed
+
+    See commit_order_reservations. Returns the number committed.
+    """
+    return commit_order_reservations([order.pk])
+
+
+def commit_order_reservations(order_ids):
+    """
+    Make the reservations of many paid orders permanent
+
+    Held reservations are committed with one UPDATE. Reservations the sweeper
+    already released are re-taken if stock allows; a shortfall is logged for
+    staff instead of failing the payment. Returns the number committed.
+    """
+    now = timezone.now()
+    reservations = StockReservation.objects.filter(order_id__in=order_ids)
+    with transaction.atomic():
+        committed = reservations.filter(status=StockReservation.STATUS_HELD).update(
+            status=StockReservation.STATUS_COMMITTED
+        )
+        retaken = []
+        released = list(reservations.filter(status=StockReservation.STATUS_RELEASED).order_by('product_id', 'pk'))
+        tracked = _tracked({reservation.product_id for reservation in released})
+        for reservation in released:
+            if not _take(reservation.product_id, reservation.quantity, tracked, now):
+                logger.error(
+                    f"Order {reservation.order_id} paid after its reservation expired; "
+                    f"product {reservation.product_id} is oversold by up to {reservation.quantity}"
+                )
+                continue
+            retaken.append(reservation)
+        if retaken:
+            StockReservation.objects.filter(pk__in=[reservation.pk for reservation in retaken]).update(
+                status=StockReservation.STATUS_COMMITTED, released_at=None
+            )
+            _stock_changed({reservation.product_id for reservation in retaken}, tracked, now)
+    return committed + len(retaken)
+
+
+def release_reservations(reservations, include_committed=False):
+    """
+    Return reserved stock to inventory
+
+    Held reservations are released (payment failed, order canceled or the
+    hold expired); with include_committed=True committed ones are too (refund
+    or cancellation after payment). Each row flips status with a conditional
+    UPDATE first, so a reservation is never restocked twice even when the
+    sweeper and a webhook race. Returns the number released.
+    """
+    statuses = [StockReservation.STATUS_HELD]
+    if include_committed:
+        statuses.append(StockReservation.STATUS_COMMITTED)
+    now = timezone.now()
+
+    released = []
+    with transaction.atomic():
+        candidates = list(reservations.filter(status__in=statuses).only('pk', 'product_id', 'quantity', 'status'))
+        tracked = _tracked({reservation.product_id for reservation in candidates})
+        for reservation in candidates:
+            flipped = StockReservation.objects.filter(pk=reservation.pk, status=reservation.status).update(
+                status=StockReservation.STATUS_RELEASED, released_at=now
+            )
+            if not flipped:
+                continue
+            _restock(reservation.product_id, reservation.quantity, tracked, now)
+            released.append(reservation.product_id)
+        if released:
+            _stock_changed(released, tracked, now)
+    return len(released)
+
+
+def release_expired_reservations(now=None, batch_size=LOOKUP_CHUNK_SIZE):
+    """Sweeper: release held reservations whose hold has expired"""
+    now = now or timezone.now()
+    total = 0
+    while True:
+        ids = list(
+            StockReservation.objects.filter(
+                status=StockReservation.STATUS_HELD, expires_at__lte=now
+            ).values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        total += release_reservations(StockReservation.objects.filter(pk__in=ids))
+    if total:
+        logger.info(f"Released {total} expired stock reservations")
+    return total
@@ -2,8 +2,8 @@ from django.shortcuts import get_object_or_404
 from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods, require_GET, require_POST
 from django.contrib.admin.views.decorators import staff_member_required
-from django.utils import timezone
 from .models import Product, StockLevel, StockAlert, PreOrder, BackInStockNotification
+from .inventory import apply_stock_levels, import_stock, parse_stock_file
 
 
 @staff_member_required
@@ -13,39 +13,10 @@ def update_stock(request, product_id):
     product = get_object_or_404(Product, pk=product_id)
     quantity = int(request.POST.get('quantity', 0))
     
-    stock, created = StockLevel.objects.get_or_create(product=product)
-    old_quantity = stock.quantity
-    stock.quantity = quantity
-    
-    # Check if restocked
-    if quantity > old_quantity:
-        stock.last_restocked = timezone.now()
-        
-        # Notify people waiting for back in stock
-        if old_quantity == 0 and quantity > 0:
-            notify_back_in_stock(product)
-    
-    stock.save()
-    
-    # Create alerts if needed
-    if stock.is_out_of_stock:
-        StockAlert.objects.get_or_create(
-            product=product,
-            alert_type='out',
-            resolved=False
-        )
-    elif stock.is_low_stock:
-        StockAlert.objects.get_or_create(
-            product=product,
-            alert_type='low',
-            resolved=False
-        )
-    else:
-        # Resolve existing alerts
-        StockAlert.objects.filter(
-            product=product,
-            resolved=False
-        ).update(resolved=True, resolved_at=timezone.now())
+    # Same code path as the bulk warehouse sync: alerts are reconciled and
+    # back-in-stock subscribers are notified when stock comes back from zero
+    apply_stock_levels({product.id: quantity})
+    stock = StockLevel.objects.get(product=product)
     
     return JsonResponse({
         'success': True,
@@ -56,6 +27,28 @@ def update_stock(request, product_id):
     })
 
 
+@staff_member_required
+@require_POST
+def bulk_import_stock(request):
+    """Bulk stock import: CSV/JSON upload (`file`) or raw JSON/CSV body of SKU -> quantity"""
+    upload = request.FILES.get('file')
+    data = upload.read() if upload else request.body
+    fmt = request.POST.get('format') or request.GET.get('format')
+    if upload and not fmt and upload.name.lower().endswith(('.csv', '.json')):
+        fmt = upload.name.rsplit('.', 1)[-1].lower()
+    
+    try:
+        quantities, invalid = parse_stock_file(data, fmt=fmt)
+    except (ValueError, UnicodeDecodeError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    dry_run = request.POST.get('dry_run', request.GET.get('dry_run', '')).lower() in ('1', 'true', 'yes')
+    report = import_stock(quantities, dry_run=dry_run)
+    report['invalid'] = invalid
+    
+    return JsonResponse({'success': True, **report})
+
+
 @require_GET
 def check_stock(request, product_id):
     """Check stock availability for a product"""
@@ -150,20 +143,3 @@ def back_in_stock_notification(request, product_id):
         'success': True,
         'message': message
     })
-
-
-def notify_back_in_stock(product):
-    """Notify users waiting for product to be back in stock"""
-    notifications = BackInStockNotification.objects.filter(
-        product=product,
-        notified=False
-    )
-    
-    for notification in notifications:
-        # In production, send actual email
-        # For now, just mark as notified
-        notification.notified = True
-        notification.notified_at = timezone.now()
-        notification.save()
-    
-    return notifications.count()
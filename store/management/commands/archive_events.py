@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from store.retention import ARCHIVE_CHUNK_SIZE, apply_retention
+
+
+class Command(BaseCommand):
+    help = 'Roll up old product views and move raw view/search events into compressed archive files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Keep raw events this many days (default EVENT_RETENTION_DAYS)')
+        parser.add_argument('--chunk-size', type=int, default=ARCHIVE_CHUNK_SIZE, help='Rows per archive file and delete batch')
+        parser.add_argument('--archive-dir', help='Directory for the archive files (default EVENT_ARCHIVE_DIR)')
+
+    def handle(self, *args, **options):
+        result = apply_retention(
+            days=options['days'], directory=options['archive_dir'], chunk_size=options['chunk_size'],
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Events before {result['cutoff']}: rolled up {result['days_rolled_up']} days, "
+                f"archived {result['views_archived']} product views and {result['searches_archived']} searches"
+            )
+        )
@@ -0,0 +1,37 @@
+import os
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from store.models import Product
+from store.watermark import file_sha1
+from store.watermark_manifest import get_manifest
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the watermark manifest from existing *_wm.png files in media storage'
+
+    def handle(self, *args, **options):
+        entries = {}
+        names = (
+            Product.objects.exclude(image='').exclude(image__isnull=True)
+            .values_list('image', flat=True).distinct()
+        )
+        for name in names:
+            base, _ext = os.path.splitext(name)
+            wm_name = f"{base}_wm.png"
+            if not default_storage.exists(wm_name):
+                continue
+            with default_storage.open(wm_name, 'rb') as fh:
+                width, height = Image.open(fh).size
+            try:
+                sha1 = file_sha1(default_storage.path(name))
+            except (NotImplementedError, FileNotFoundError):
+                sha1 = ''
+            entries[name] = {'name': wm_name, 'width': width, 'height': height, 'sha1': sha1}
+
+        get_manifest().replace(entries)
+        self.stdout.write(
+            self.style.SUCCESS(f'Recorded {len(entries)} watermarked images in the manifest')
+        )
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from store.models import StockLevel, StockAlert
+from store.inventory import LOOKUP_CHUNK_SIZE, sync_stock_alerts
+from store.models import StockLevel
 
 
 class Command(BaseCommand):
@@ -8,38 +8,24 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         alerts_created = 0
-        
-        # Check all stock levels
-        for stock in StockLevel.objects.all():
-            if stock.is_low_stock() and not stock.is_out_of_stock():
-                # Check if alert already exists
-                existing_alert = StockAlert.objects.filter(
-                    product=stock.product,
-                    is_resolved=False
-                ).exists()
-                
-                if not existing_alert:
-                    StockAlert.objects.create(
-                        product=stock.product,
-                        message=f'Low stock: Only {stock.available_quantity()} items left'
-                    )
-                    alerts_created += 1
-            
-            elif stock.is_out_of_stock():
-                # Check if alert already exists
-                existing_alert = StockAlert.objects.filter(
-                    product=stock.product,
-                    is_resolved=False,
-                    message__contains='Out of stock'
-                ).exists()
-                
-                if not existing_alert:
-                    StockAlert.objects.create(
-                        product=stock.product,
-                        message='Out of stock'
-                    )
-                    alerts_created += 1
-        
+        alerts_resolved = 0
+
+        # Reconcile alerts chunk by chunk: a few queries per chunk instead of
+        # several per StockLevel row
+        stocks = StockLevel.objects.only('product_id', 'quantity', 'low_stock_threshold').order_by('pk')
+        chunk = []
+        for stock in stocks.iterator(chunk_size=LOOKUP_CHUNK_SIZE):
+            chunk.append(stock)
+            if len(chunk) >= LOOKUP_CHUNK_SIZE:
+                created, resolved = sync_stock_alerts(chunk)
+                alerts_created += created
+                alerts_resolved += resolved
+                chunk = []
+        if chunk:
+            created, resolved = sync_stock_alerts(chunk)
+            alerts_created += created
+            alerts_resolved += resolved
+
         self.stdout.write(
-            self.style.SUCCESS(f'Created {alerts_created} stock alerts')
+            self.style.SUCCESS(f'Created {alerts_created} stock alerts, resolved {alerts_resolved}')
         )
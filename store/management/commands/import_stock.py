@@ -0,0 +1,61 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from store.inventory import import_stock, parse_stock_file
+
+
+class Command(BaseCommand):
+    help = 'Bulk import stock levels from a CSV (sku,quantity) or JSON warehouse export'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path to the CSV/JSON file, or - for stdin')
+        parser.add_argument(
+            '--format',
+            choices=['csv', 'json'],
+            help='File format (defaults to the file extension or content sniffing)'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report the diff without writing anything'
+        )
+        parser.add_argument(
+            '--show-changes',
+            action='store_true',
+            help='Print one line per changed SKU'
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format']
+        try:
+            if path == '-':
+                data = sys.stdin.read()
+            else:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if not fmt and path.lower().endswith(('.csv', '.json')):
+                    fmt = path.rsplit('.', 1)[-1].lower()
+            quantities, invalid = parse_stock_file(data, fmt=fmt)
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            raise CommandError(f'Could not read {path}: {e}')
+
+        report = import_stock(quantities, dry_run=options['dry_run'])
+
+        if options['show_changes']:
+            for change in report['changes']:
+                self.stdout.write(f"{change['sku']}: {change['old']} -> {change['new']}")
+        for sku in report['unknown']:
+            self.stderr.write(f'Unknown SKU: {sku}')
+        for row in invalid:
+            self.stderr.write(f"Invalid row: {row['sku'] or '<empty>'} = {row['quantity']}")
+
+        prefix = '[dry run] ' if options['dry_run'] else ''
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{prefix}{report['created']} created, {report['updated']} updated, "
+                f"{report['unchanged']} unchanged, {len(report['unknown'])} unknown, "
+                f"{len(invalid)} invalid; {len(report['restocked'])} restocked, "
+                f"{report['alerts_created']} alerts opened, {report['alerts_resolved']} alerts resolved"
+            )
+        )
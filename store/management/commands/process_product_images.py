@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from store.image_pipeline import run_pipeline
+
+
+class Command(BaseCommand):
+    help = 'Watermark catalog images and build responsive WebP/JPEG variants'
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='*', help='Storage names to process (default: all product images)')
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: CPU count)')
+        parser.add_argument('--force', action='store_true', help='Reprocess images whose content is unchanged')
+        parser.add_argument('--widths', type=str, default=None, help='Comma-separated variant widths, e.g. 300,600')
+
+    def handle(self, *args, **options):
+        widths = None
+        if options['widths']:
+            widths = [int(w) for w in options['widths'].split(',') if w.strip()]
+        report = run_pipeline(
+            names=options['images'] or None,
+            workers=options['workers'],
+            force=options['force'],
+            widths=widths,
+        )
+        for name, error in report['errors']:
+            self.stderr.write(f'{name}: {error}')
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Processed {report['processed']} images, skipped {report['skipped']} unchanged, "
+                f"{len(report['errors'])} failed"
+            )
+        )
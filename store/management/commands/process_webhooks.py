@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from store.payment_webhooks import process_due_webhook_events
+
+
+class Command(BaseCommand):
+    help = 'Retry stored payment webhook events whose backoff has elapsed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=100, help='Maximum events to process')
+
+    def handle(self, *args, **options):
+        processed, failed = process_due_webhook_events(limit=options['limit'])
+        self.stdout.write(
+            self.style.SUCCESS(f'Processed {processed} webhook events, {failed} failed')
+        )
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from store.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Recompute product rating, review count and star histogram from the approved reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', type=int, action='append', dest='products', help='Only this product id (repeatable)')
+
+    def handle(self, *args, **options):
+        updated = Product.refresh_review_aggregates(options['products'])
+        self.stdout.write(
+            self.style.SUCCESS(f'Rebuilt review aggregates for {updated} products')
+        )
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from store.inventory import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = 'Return stock held by checkout reservations whose payment window has expired'
+
+    def handle(self, *args, **options):
+        released = release_expired_reservations()
+        self.stdout.write(
+            self.style.SUCCESS(f'Released {released} expired stock reservations')
+        )
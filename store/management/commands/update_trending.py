@@ -0,0 +1,46 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from store.models import ProductView, SearchQueryHourly, TrendingScore
+from store.trending import KIND_PRODUCT, KIND_SEARCH, add_event, prune, record_increments
+
+
+class Command(BaseCommand):
+    help = 'Drop faded trending scores, or rebuild them from recent search rollups and product views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Recompute every score from history')
+        parser.add_argument('--days', type=int, default=14, help='History replayed by --rebuild')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            self._rebuild(timezone.now() - timedelta(days=options['days']))
+        removed = prune()
+        self.stdout.write(
+            self.style.SUCCESS(f'Removed {removed} faded trending scores')
+        )
+
+    @transaction.atomic
+    def _rebuild(self, since):
+        increments = {}
+        searches = SearchQueryHourly.objects.filter(bucket__gte=since, searches__gt=0)
+        for bucket, query, count in searches.values_list('bucket', 'query', 'searches').iterator():
+            add_event(increments, KIND_SEARCH, query, bucket, count)
+        views = (
+            ProductView.objects.filter(viewed_at__gte=since)
+            .annotate(hour=TruncHour('viewed_at'))
+            .values_list('product_id', 'hour')
+            .annotate(count=Count('id'))
+            .order_by()
+        )
+        for product_id, hour, count in views.iterator():
+            add_event(increments, KIND_PRODUCT, product_id, hour, count)
+
+        TrendingScore.objects.all().delete()
+        record_increments(increments)
+        self.stdout.write(f'Rebuilt {len(increments)} trending scores')
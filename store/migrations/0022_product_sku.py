@@ -0,0 +1,46 @@
+# Generated by Django 4.2.27 on 2026-10-19 16:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0021_order_is_paid_order_paid_at_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='brand',
+            options={'verbose_name': 'Thương hiệu', 'verbose_name_plural': 'Thương hiệu'},
+        ),
+        migrations.AlterModelOptions(
+            name='category',
+            options={'verbose_name': 'Danh mục', 'verbose_name_plural': 'Danh mục'},
+        ),
+        migrations.AlterModelOptions(
+            name='order',
+            options={'verbose_name': 'Đơn hàng', 'verbose_name_plural': 'Đơn hàng'},
+        ),
+        migrations.AlterModelOptions(
+            name='orderitem',
+            options={'verbose_name': 'Mục đơn hàng', 'verbose_name_plural': 'Mục đơn hàng'},
+        ),
+        migrations.AlterModelOptions(
+            name='product',
+            options={'ordering': ['-created_at'], 'verbose_name': 'Sản phẩm', 'verbose_name_plural': 'Sản phẩm'},
+        ),
+        migrations.AlterModelOptions(
+            name='productview',
+            options={'ordering': ['-viewed_at'], 'verbose_name': 'Lượt xem sản phẩm', 'verbose_name_plural': 'Lượt xem sản phẩm'},
+        ),
+        migrations.AlterModelOptions(
+            name='productviewanalytics',
+            options={'verbose_name': 'Thống kê lượt xem', 'verbose_name_plural': 'Thống kê lượt xem'},
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='sku',
+            field=models.CharField(blank=True, help_text='Warehouse stock-keeping unit', max_length=64, null=True, unique=True),
+        ),
+    ]
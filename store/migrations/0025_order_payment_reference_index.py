@@ -0,0 +1,18 @@
+# Generated by Django 4.2.27 on 2026-10-19 17:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0024_webhookevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='payment_reference',
+            field=models.CharField(blank=True, db_index=True, max_length=255, null=True),
+        ),
+    ]
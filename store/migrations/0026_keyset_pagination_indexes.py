@@ -0,0 +1,21 @@
+# Generated by Django 4.2.27 on 2026-10-19 17:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0025_order_payment_reference_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created_at', 'id'], name='store_order_created_1ce3a4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['created_at', 'id'], name='store_produ_created_8914b9_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.27 on 2026-10-19 17:31
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0026_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_id', models.BigIntegerField(unique=True)),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['updated_at', 'id'], name='store_produ_updated_b46f77_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='producttombstone',
+            index=models.Index(fields=['deleted_at', 'product_id'], name='store_produ_deleted_e67585_idx'),
+        ),
+    ]
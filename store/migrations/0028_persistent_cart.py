@@ -0,0 +1,69 @@
+# Generated by Django 4.2.27 on 2026-10-19 17:35
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def merge_duplicates_and_backfill(apps, schema_editor):
+    """Fold duplicate carts/items together so the unique constraints can be
+    added, then fill the cached totals from the items"""
+    Cart = apps.get_model('store', 'Cart')
+    CartItem = apps.get_model('store', 'CartItem')
+
+    keep = {}
+    for cart in Cart.objects.order_by('user_id', 'created_at', 'pk'):
+        if cart.user_id in keep:
+            CartItem.objects.filter(cart_id=cart.pk).update(cart_id=keep[cart.user_id])
+            cart.delete()
+        else:
+            keep[cart.user_id] = cart.pk
+
+    seen = {}
+    for item in CartItem.objects.select_related('product').order_by('cart_id', 'product_id', 'pk'):
+        if not item.price:
+            product = item.product
+            item.price = product.sale_price if product.sale_price else product.price
+            item.save(update_fields=['price'])
+        key = (item.cart_id, item.product_id)
+        if key in seen:
+            CartItem.objects.filter(pk=seen[key]).update(quantity=models.F('quantity') + item.quantity)
+            item.delete()
+        else:
+            seen[key] = item.pk
+
+    for cart in Cart.objects.all():
+        count, amount = 0, Decimal('0')
+        for quantity, price in CartItem.objects.filter(cart_id=cart.pk).values_list('quantity', 'price'):
+            count += quantity
+            amount += quantity * price
+        Cart.objects.filter(pk=cart.pk).update(item_count=count, subtotal=amount)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0027_catalog_delta_sync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(merge_duplicates_and_backfill, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('user',), name='unique_cart_per_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='unique_cart_product'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.27 on 2026-10-19 17:41
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_order_totals(apps, schema_editor):
+    Order = apps.get_model('store', 'Order')
+    OrderItem = apps.get_model('store', 'OrderItem')
+    totals = (
+        OrderItem.objects.filter(order=OuterRef('pk'))
+        .values('order')
+        .annotate(total=Sum(F('price') * F('quantity'), output_field=models.DecimalField(max_digits=14, decimal_places=2)))
+        .values('total')
+    )
+    Order.objects.update(
+        order_total=Coalesce(
+            Subquery(totals), Value(Decimal('0')), output_field=models.DecimalField(max_digits=14, decimal_places=2)
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0028_persistent_cart'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='order_total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.RunPython(backfill_order_totals, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='store_order_user_id_5946cf_idx'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 4.2.27 on 2026-10-19 17:44
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def backfill_rollups(apps, schema_editor):
+    """Roll the existing search log up into hourly counters"""
+    SearchQuery = apps.get_model('store', 'SearchQuery')
+    SearchQueryHourly = apps.get_model('store', 'SearchQueryHourly')
+    counts = {}
+    rows = SearchQuery.objects.values_list('query', 'result_count', 'created_at').iterator(chunk_size=5000)
+    for query, result_count, created_at in rows:
+        normalized = ' '.join(query.split()).casefold()[:255]
+        if not normalized:
+            continue
+        key = (created_at.replace(minute=0, second=0, microsecond=0), normalized)
+        entry = counts.setdefault(key, [0, 0, 0])
+        entry[0] += 1
+        entry[1] += 0 if result_count else 1
+        entry[2] += result_count
+    SearchQueryHourly.objects.bulk_create(
+        [
+            SearchQueryHourly(bucket=bucket, query=query, searches=n, zero_results=zero, result_total=total)
+            for (bucket, query), (n, zero, total) in counts.items()
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0029_order_total'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchQueryHourly',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('query', models.CharField(max_length=255)),
+                ('searches', models.PositiveIntegerField(default=0)),
+                ('zero_results', models.PositiveIntegerField(default=0)),
+                ('result_total', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Search query rollups',
+            },
+        ),
+        migrations.AlterField(
+            model_name='searchquery',
+            name='created_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddConstraint(
+            model_name='searchqueryhourly',
+            constraint=models.UniqueConstraint(fields=('bucket', 'query'), name='unique_search_bucket_query'),
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.27 on 2026-10-19 17:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0030_search_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrendingScore',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('search', 'Search query'), ('product', 'Product')], max_length=20)),
+                ('key', models.CharField(max_length=255)),
+                ('score', models.FloatField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['kind', '-score'], name='trending_kind_score_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='trendingscore',
+            constraint=models.UniqueConstraint(fields=('kind', 'key'), name='unique_trending_kind_key'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.27 on 2026-10-19 17:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0031_trending_scores'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteTrafficDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('views', models.PositiveIntegerField(default=0)),
+                ('unique_visitors', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Site traffic (daily)',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductViewDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('views', models.PositiveIntegerField(default=0)),
+                ('unique_visitors', models.PositiveIntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_views', to='store.product')),
+            ],
+            options={
+                'verbose_name_plural': 'Product views (daily)',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='productviewdaily',
+            constraint=models.UniqueConstraint(fields=('date', 'product'), name='unique_product_view_day'),
+        ),
+    ]
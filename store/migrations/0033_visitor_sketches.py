@@ -0,0 +1,74 @@
+# Generated by Django 4.2.27 on 2026-10-19 17:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+from store.hll import HyperLogLog
+
+
+def backfill_sketches(apps, schema_editor):
+    """Build the daily and lifetime sketches from the raw views still kept"""
+    ProductView = apps.get_model('store', 'ProductView')
+    ProductViewAnalytics = apps.get_model('store', 'ProductViewAnalytics')
+    VisitorSketch = apps.get_model('store', 'VisitorSketch')
+
+    daily, lifetime = {}, {}
+    rows = ProductView.objects.order_by().values_list('product_id', 'session_key', 'user_id', 'ip_address', 'viewed_at')
+    for product_id, session_key, user_id, ip_address, viewed_at in rows.iterator():
+        if session_key:
+            visitor = f'session:{session_key}'
+        elif user_id:
+            visitor = f'user:{user_id}'
+        elif ip_address:
+            visitor = f'ip:{ip_address}'
+        else:
+            continue
+        day = timezone.localtime(viewed_at).date()
+        for key in ((day, product_id), (day, None)):
+            daily.setdefault(key, HyperLogLog()).add(visitor)
+        lifetime.setdefault(product_id, HyperLogLog()).add(visitor)
+
+    VisitorSketch.objects.bulk_create(
+        [VisitorSketch(date=day, product_id=product_id, registers=sketch.to_bytes())
+         for (day, product_id), sketch in daily.items()],
+        batch_size=500,
+    )
+    for product_id, sketch in lifetime.items():
+        analytics, _ = ProductViewAnalytics.objects.get_or_create(product_id=product_id)
+        analytics.visitor_sketch = sketch.to_bytes()
+        analytics.unique_views = sketch.count()
+        analytics.save(update_fields=['visitor_sketch', 'unique_views'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0032_event_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productviewanalytics',
+            name='visitor_sketch',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='VisitorSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('registers', models.BinaryField()),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='visitor_sketches', to='store.product')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='visitorsketch',
+            constraint=models.UniqueConstraint(condition=models.Q(('product__isnull', False)), fields=('date', 'product'), name='unique_product_visitor_sketch'),
+        ),
+        migrations.AddConstraint(
+            model_name='visitorsketch',
+            constraint=models.UniqueConstraint(condition=models.Q(('product__isnull', True)), fields=('date',), name='unique_site_visitor_sketch'),
+        ),
+        migrations.RunPython(backfill_sketches, migrations.RunPython.noop),
+    ]
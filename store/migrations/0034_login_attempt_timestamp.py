@@ -0,0 +1,19 @@
+# Generated by Django 4.2.27 on 2026-10-19 18:01
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0033_visitor_sketches'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='loginattempt',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.27 on 2026-10-19 18:03
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0034_login_attempt_timestamp'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='suspiciousactivity',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 4.2.27 on 2026-10-19 18:16
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_review_aggregates(apps, schema_editor):
+    """Count the approved reviews into the new per-product aggregates"""
+    Product = apps.get_model('store', 'Product')
+    Review = apps.get_model('store', 'Review')
+    histograms = {}
+    rows = (
+        Review.objects.filter(is_approved=True, rating__in=(1, 2, 3, 4, 5))
+        .values_list('product_id', 'rating')
+        .annotate(reviews=Count('pk'))
+        .order_by()
+    )
+    for product_id, stars, reviews in rows:
+        histograms.setdefault(product_id, {})[stars] = reviews
+    Product.objects.update(rating=0)
+    for product_id, histogram in histograms.items():
+        count = sum(histogram.values())
+        total = sum(stars * reviews for stars, reviews in histogram.items())
+        Product.objects.filter(pk=product_id).update(
+            review_count=count,
+            rating_sum=total,
+            rating=(Decimal(total) / count).quantize(Decimal('0.01')),
+            **{f'rating_{stars}': histogram.get(stars, 0) for stars in range(1, 6)},
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0035_suspicious_activity_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_review_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.27 on 2026-10-19 18:42
+
+from django.db import migrations, models
+
+
+def blank_duplicate_references(apps, schema_editor):
+    """Keep a payment reference only on the first order that carries it, so the
+    unique constraint can be added (the old Stripe success page created a new
+    order on every refresh)"""
+    Order = apps.get_model('store', 'Order')
+
+    duplicates = (
+        Order.objects.exclude(payment_reference__isnull=True).exclude(payment_reference='')
+        .values('payment_method', 'payment_reference')
+        .annotate(orders=models.Count('pk'), first=models.Min('pk'))
+        .filter(orders__gt=1)
+    )
+    for group in duplicates:
+        Order.objects.filter(
+            payment_method=group['payment_method'], payment_reference=group['payment_reference'],
+        ).exclude(pk=group['first']).update(payment_reference='')
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("store", "0036_review_aggregates"),
+    ]
+
+    operations = [
+        migrations.RunPython(blank_duplicate_references, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="order",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(
+                    ("payment_reference__isnull", False),
+                    models.Q(("payment_reference", ""), _negated=True),
+                ),
+                fields=("payment_method", "payment_reference"),
+                name="unique_order_payment_reference",
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.27 on 2026-10-19 18:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("store", "0037_order_payment_reference_unique"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="appliedcoupon",
+            name="order",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="applied_coupons",
+                to="store.order",
+            ),
+        ),
+        migrations.AddField(
+            model_name="order",
+            name="discount_amount",
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+    ]
@@ -1,4 +1,8 @@
 from django.db import models
+from decimal import Decimal
+
+from django.db.models import Count, DecimalField, F, FloatField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Cast, Coalesce, Greatest
 from django.contrib.auth.models import User
 from django.utils.text import slugify
 from django.utils import timezone
@@ -43,6 +47,9 @@ class Category(models.Model):
         super().save(*args, **kwargs)
 
 
+REVIEW_STARS = (1, 2, 3, 4, 5)
+
+
 class Product(models.Model):
     """Main product model"""
     UNIT_LIT = 'LIT'
@@ -64,11 +71,22 @@ class Product(models.Model):
     stock_quantity = models.PositiveIntegerField(default=0)
     image = models.ImageField(upload_to='products/', blank=True, null=True)
     slug = models.SlugField(max_length=250, blank=True, null=True)
+    sku = models.CharField(max_length=64, unique=True, blank=True, null=True, help_text='Warehouse stock-keeping unit')
     is_active = models.BooleanField(default=True)
     is_new = models.BooleanField(default=False)
     is_on_sale = models.BooleanField(default=False)
     view_count = models.PositiveIntegerField(default=0)
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.0)
+    # Approved-review aggregates: count, sum of stars and a per-star
+    # histogram; kept current by Product.adjust_reviews, `rating` is their
+    # average
+    review_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_1 = models.PositiveIntegerField(default=0)
+    rating_2 = models.PositiveIntegerField(default=0)
+    rating_3 = models.PositiveIntegerField(default=0)
+    rating_4 = models.PositiveIntegerField(default=0)
+    rating_5 = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -80,6 +98,10 @@ class Product(models.Model):
             models.Index(fields=['name', 'brand']),
             models.Index(fields=['is_active', 'created_at']),
             models.Index(fields=['category', 'is_active']),
+            # keyset pagination (store.pagination.KeysetPagination)
+            models.Index(fields=['created_at', 'id']),
+            # catalog delta sync (store.catalog_sync)
+            models.Index(fields=['updated_at', 'id']),
         ]
 
     def __str__(self):
@@ -103,6 +125,57 @@ class Product(models.Model):
         """Check if product is in stock"""
         return self.stock_quantity > 0
 
+    @property
+    def rating_histogram(self):
+        """[(stars, reviews)] from 5 stars down to 1"""
+        return [(stars, getattr(self, f'rating_{stars}')) for stars in range(5, 0, -1)]
+
+    @staticmethod
+    def _average(count, total):
+        return Cast(
+            Cast(total, FloatField()) / Greatest(count, Value(1)),
+            DecimalField(max_digits=3, decimal_places=2),
+        )
+
+    @staticmethod
+    def adjust_reviews(product_id, stars, delta):
+        """Add (delta=1) or remove (delta=-1) one approved review in one UPDATE"""
+        if stars not in REVIEW_STARS:
+            return
+        count = F('review_count') + delta
+        total = F('rating_sum') + delta * stars
+        Product.objects.filter(pk=product_id).update(
+            review_count=count,
+            rating_sum=total,
+            rating=Product._average(count, total),
+            updated_at=timezone.now(),
+            **{f'rating_{stars}': F(f'rating_{stars}') + delta},
+        )
+
+    @staticmethod
+    def refresh_review_aggregates(product_ids=None):
+        """Recompute the review aggregates from the approved reviews"""
+        approved = Review.objects.filter(product=OuterRef('pk'), is_approved=True, rating__in=REVIEW_STARS)
+
+        def stat(aggregate):
+            rows = approved.values('product').annotate(value=aggregate).values('value')
+            return Coalesce(Subquery(rows), Value(0))
+
+        count, total = stat(Count('pk')), stat(Sum('rating'))
+        products = Product.objects.all() if product_ids is None else Product.objects.filter(pk__in=product_ids)
+        return products.update(
+            review_count=count,
+            rating_sum=total,
+            rating=Product._average(count, total),
+            updated_at=timezone.now(),
+            **{f'rating_{stars}': stat(Count('pk', filter=Q(rating=stars))) for stars in REVIEW_STARS},
+        )
+
+
+def line_total_sum(prefix=''):
+    """Sum(price * quantity) over order items, `prefix` e.g. 'items__' from Order"""
+    return Sum(F(f'{prefix}price') * F(f'{prefix}quantity'), output_field=DecimalField(max_digits=14, decimal_places=2))
+
 
 class Order(models.Model):
     """Order model for customer orders"""
@@ -142,9 +215,14 @@ class Order(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
     payment_method = models.CharField(max_length=30, default=PAYMENT_METHOD_COD, choices=PAYMENT_METHOD_CHOICES)
     payment_status = models.CharField(max_length=30, choices=PAYMENT_STATUS_CHOICES, default=PAYMENT_STATUS_PENDING)
-    payment_reference = models.CharField(max_length=255, blank=True, null=True)
+    payment_reference = models.CharField(max_length=255, blank=True, null=True, db_index=True)
     is_paid = models.BooleanField(default=False)
     paid_at = models.DateTimeField(blank=True, null=True)
+    # Sum of item price * quantity less discount_amount, stored so history
+    # pages and reports don't join the items; see Order.refresh_totals
+    order_total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    # Coupon discount taken off at checkout (see store.coupons)
+    discount_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -154,6 +232,38 @@ class Order(models.Model):
     class Meta:
         verbose_name = 'Đơn hàng'
         verbose_name_plural = 'Đơn hàng'
+        indexes = [
+            # keyset pagination (store.pagination.KeysetPagination)
+            models.Index(fields=['created_at', 'id']),
+            # per-customer order history, newest first
+            models.Index(fields=['user', 'created_at', 'id']),
+        ]
+        constraints = [
+            # one order per gateway payment, however many requests report it
+            models.UniqueConstraint(
+                fields=['payment_method', 'payment_reference'],
+                condition=models.Q(payment_reference__isnull=False) & ~models.Q(payment_reference=''),
+                name='unique_order_payment_reference',
+            ),
+        ]
+
+    @staticmethod
+    def refresh_totals(order_ids):
+        """Recompute order_total from the items and the discount in one UPDATE"""
+        totals = (
+            OrderItem.objects.filter(order=OuterRef('pk'))
+            .values('order')
+            .annotate(total=line_total_sum())
+            .values('total')
+        )
+        money = DecimalField(max_digits=14, decimal_places=2)
+        Order.objects.filter(pk__in=order_ids).update(
+            order_total=Greatest(
+                Coalesce(Subquery(totals), Value(Decimal('0')), output_field=money) - F('discount_amount'),
+                Value(Decimal('0')),
+                output_field=money,
+            )
+        )
 
     def save(self, *args, **kwargs):
         # Keep payment flags consistent
@@ -213,6 +323,8 @@ class ProductViewAnalytics(models.Model):
     total_purchases = models.PositiveIntegerField(default=0)
     last_viewed = models.DateTimeField(blank=True, null=True)
     last_purchased = models.DateTimeField(blank=True, null=True)
+    # lifetime HyperLogLog of viewers behind unique_views (store.visitors)
+    visitor_sketch = models.BinaryField(blank=True, null=True, editable=False)
 
     class Meta:
         verbose_name = 'Thống kê lượt xem'
@@ -226,7 +338,78 @@ class ProductViewAnalytics(models.Model):
         from django.utils import timezone
         self.total_views += 1
         self.last_viewed = timezone.now()
-        self.save()
+        # unique_views/visitor_sketch are written by the visitor sketch flush
+        self.save(update_fields=['total_views', 'last_viewed'])
+
+
+class ProductViewDaily(models.Model):
+    """One product's views on one day; outlives the raw ProductView rows (store.retention)"""
+    date = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_views')
+    views = models.PositiveIntegerField(default=0)
+    unique_visitors = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'Product views (daily)'
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'product'], name='unique_product_view_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} on {self.date}: {self.views}"
+
+
+class VisitorSketch(models.Model):
+    """HyperLogLog of one day's visitors, store-wide or for one product (store.visitors)"""
+    date = models.DateField()
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, blank=True, null=True, related_name='visitor_sketches'
+    )
+    registers = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'product'], condition=models.Q(product__isnull=False),
+                name='unique_product_visitor_sketch',
+            ),
+            models.UniqueConstraint(
+                fields=['date'], condition=models.Q(product__isnull=True),
+                name='unique_site_visitor_sketch',
+            ),
+        ]
+
+    def __str__(self):
+        return f"Visitors on {self.date} ({self.product_id or 'store'})"
+
+
+class SiteTrafficDaily(models.Model):
+    """Store-wide product views and distinct visitors (store.visitors.visitor_key) for one day"""
+    date = models.DateField(unique=True)
+    views = models.PositiveIntegerField(default=0)
+    unique_visitors = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'Site traffic (daily)'
+        ordering = ['-date']
+
+    def __str__(self):
+        return f"Traffic on {self.date}: {self.views} views"
+
+
+class ProductTombstone(models.Model):
+    """Marker left behind when a product row is deleted, so delta-sync
+    clients (POS, mobile) learn to drop it"""
+    product_id = models.BigIntegerField(unique=True)
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['deleted_at', 'product_id']),
+        ]
+
+    def __str__(self):
+        return f"Deleted product #{self.product_id}"
 
 
 class StockLevel(models.Model):
@@ -271,6 +454,35 @@ class StockAlert(models.Model):
         return f"{self.get_alert_type_display()} - {self.product.name}"
 
 
+class StockReservation(models.Model):
+    """Stock taken for an order at checkout, held until payment confirms or it expires"""
+    STATUS_HELD = 'held'
+    STATUS_COMMITTED = 'committed'
+    STATUS_RELEASED = 'released'
+    STATUS_CHOICES = [
+        (STATUS_HELD, 'Held'),
+        (STATUS_COMMITTED, 'Committed'),
+        (STATUS_RELEASED, 'Released'),
+    ]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_HELD)
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    released_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product.name} for order #{self.order_id} ({self.status})"
+
+
 class PreOrder(models.Model):
     """Pre-orders for out of stock products"""
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='pre_orders')
@@ -453,6 +665,9 @@ class AppliedCoupon(models.Model):
     coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, related_name='applications')
     user = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, null=True)
     session_key = models.CharField(max_length=40, blank=True, null=True)
+    order = models.ForeignKey(
+        'Order', on_delete=models.SET_NULL, blank=True, null=True, related_name='applied_coupons'
+    )
     discount_amount = models.DecimalField(max_digits=10, decimal_places=2)
     applied_at = models.DateTimeField(auto_now_add=True)
 
@@ -541,12 +756,32 @@ class NewsletterSubscription(models.Model):
 class Cart(models.Model):
     """Shopping cart model"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='carts')
+    # Denormalized from the items (sum of quantity, sum of quantity * price);
+    # kept current by Cart.adjust_totals, never recomputed on read
+    item_count = models.PositiveIntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user'], name='unique_cart_per_user'),
+        ]
+
     def __str__(self):
         return f"Cart for {self.user.username}"
 
+    @staticmethod
+    def adjust_totals(cart_id, quantity, amount):
+        """Shift the cached totals by a delta in one UPDATE"""
+        if not quantity and not amount:
+            return
+        Cart.objects.filter(pk=cart_id).update(
+            item_count=F('item_count') + quantity,
+            subtotal=F('subtotal') + amount,
+            updated_at=timezone.now(),
+        )
+
 
 class CartItem(models.Model):
     """Cart item model"""
@@ -555,6 +790,11 @@ class CartItem(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     price = models.DecimalField(max_digits=12, decimal_places=2, default=0)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
+
     def __str__(self):
         return f"{self.product.name} x {self.quantity}"
     
@@ -591,7 +831,8 @@ class LoginAttempt(models.Model):
     ip_address = models.GenericIPAddressField()
     success = models.BooleanField(default=False)
     user_agent = models.CharField(max_length=255, blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # set when the attempt happens; rows are bulk-inserted later (store.security)
+    timestamp = models.DateTimeField(default=timezone.now)
 
     class Meta:
         ordering = ['-timestamp']
@@ -610,7 +851,8 @@ class SuspiciousActivity(models.Model):
     activity_type = models.CharField(max_length=100)
     description = models.TextField()
     ip_address = models.GenericIPAddressField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # set when detected; rows are bulk-inserted later (store.security)
+    created_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
         ordering = ['-created_at']
@@ -694,6 +936,48 @@ class PaymentLog(models.Model):
         return f"Payment {self.transaction_id} for Order #{self.order.id}"
 
 
+class WebhookEvent(models.Model):
+    """Raw payment-provider webhook delivery, deduplicated by provider event id"""
+    PROVIDER_STRIPE = 'stripe'
+    PROVIDER_PAYPAL = 'paypal'
+    PROVIDER_CHOICES = [
+        (PROVIDER_STRIPE, 'Stripe'),
+        (PROVIDER_PAYPAL, 'PayPal'),
+    ]
+
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_PROCESSED = 'processed'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_PROCESSED, 'Processed'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    provider = models.CharField(max_length=20, choices=PROVIDER_CHOICES)
+    event_id = models.CharField(max_length=255)
+    event_type = models.CharField(max_length=100, blank=True)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-received_at']
+        unique_together = [('provider', 'event_id')]
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.provider} {self.event_type} {self.event_id} ({self.status})"
+
+
 class EmailLog(models.Model):
     """Log of sent emails"""
     recipient = models.EmailField()
@@ -723,7 +1007,8 @@ class SearchQuery(models.Model):
     query = models.CharField(max_length=255)
     session_key = models.CharField(max_length=40, blank=True, null=True)
     result_count = models.PositiveIntegerField(default=0)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # set by the caller so buffered writes keep the time of the search
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
 
     class Meta:
         verbose_name_plural = 'Search Queries'
@@ -733,3 +1018,47 @@ class SearchQuery(models.Model):
         return f"Search: {self.query}"
 
 
+class SearchQueryHourly(models.Model):
+    """Per-hour counters for a normalized search query (store.search_telemetry)"""
+    bucket = models.DateTimeField()
+    query = models.CharField(max_length=255)
+    searches = models.PositiveIntegerField(default=0)
+    zero_results = models.PositiveIntegerField(default=0)
+    result_total = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'Search query rollups'
+        constraints = [
+            models.UniqueConstraint(fields=['bucket', 'query'], name='unique_search_bucket_query'),
+        ]
+
+    def __str__(self):
+        return f"{self.bucket:%Y-%m-%d %H}:00 {self.query} ({self.searches})"
+
+
+class TrendingScore(models.Model):
+    """Exponentially decayed popularity of a search query or product (store.trending)"""
+    KIND_SEARCH = 'search'
+    KIND_PRODUCT = 'product'
+    KIND_CHOICES = [
+        (KIND_SEARCH, 'Search query'),
+        (KIND_PRODUCT, 'Product'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    key = models.CharField(max_length=255)
+    # log(sum of exp(rate * seconds since the trending epoch)) over all events
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key'], name='unique_trending_kind_key'),
+        ]
+        indexes = [
+            models.Index(fields=['kind', '-score'], name='trending_kind_score_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind}:{self.key} ({self.score:.3f})"
+
+
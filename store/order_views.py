@@ -5,40 +5,40 @@ Handles order history and order details
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Sum, F
-from django.db.models import Q
+from django.core.paginator import Paginator
+from django.db.models import Count, Sum
 from decimal import Decimal
 from django.views.decorators.http import require_POST
+from django.db import transaction
 from .models import Order, OrderItem
+from . import coupons
+from .inventory import release_reservations
+
+
+ORDER_HISTORY_PAGE_SIZE = 20
 
 
 @login_required
 def order_history(request):
     """
     Display user's order history
-    Lists all orders associated with the user
+    Paginated, newest first; totals come from the stored Order.order_total
     """
-    orders = Order.objects.filter(
-        Q(user=request.user) | Q(full_name__icontains=request.user.username)
-    ).prefetch_related('items__product').order_by('-created_at')
-    
-    # Alternative: if you want to show all orders for testing
-    # You can modify this to show orders based on email or other criteria
-    
-    # Calculate total spent
-    total_spent = 0
-    for order in orders:
-        order_total = sum(
-            item.price * item.quantity 
-            for item in order.items.all()
-        )
-        order.total = order_total
-        total_spent += order_total
-    
+    orders = Order.objects.filter(user=request.user)
+    summary = orders.aggregate(order_count=Count('id'), total_spent=Sum('order_total'))
+
+    paginator = Paginator(
+        orders.annotate(item_count=Count('items')).order_by('-created_at', '-id'),
+        ORDER_HISTORY_PAGE_SIZE,
+    )
+    paginator.count = summary['order_count']  # already counted above
+    page = paginator.get_page(request.GET.get('page'))
+
     context = {
-        'orders': orders,
-        'total_spent': total_spent,
-        'order_count': orders.count(),
+        'orders': page,
+        'page_obj': page,
+        'total_spent': summary['total_spent'] or Decimal('0'),
+        'order_count': summary['order_count'],
     }
     
     return render(request, 'orders/order_history.html', context)
@@ -110,7 +110,10 @@ def order_cancel(request, order_id):
         messages.info(request, 'Đơn hàng đã được hủy trước đó.')
         return redirect('store:order_detail', order_id=order_id)
 
-    order.status = Order.STATUS_CANCELED
-    order.save()
+    with transaction.atomic():
+        order.status = Order.STATUS_CANCELED
+        order.save()
+        release_reservations(order.reservations.all(), include_committed=True)
+        coupons.release(order)
     messages.success(request, 'Đơn hàng đã được hủy.')
     return redirect('store:order_detail', order_id=order_id)
@@ -0,0 +1,112 @@
+"""
+API Pagination - Page numbers for browsing, keyset cursors for syncing
+Keyset pages are addressed by the (created_at, id) of the last row seen, so
+each page is an index range scan with no COUNT(*) and no OFFSET.
+"""
+import base64
+import binascii
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Forward-only keyset pagination, newest first, on (created_at, id)
+
+    Response: {"next": <url or null>, "results": [...]}
+    """
+    ordering = ('-created_at', '-id')
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self):
+        self.page_size = api_settings.PAGE_SIZE
+        self.has_next = False
+        self.page = []
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def encode_cursor(self, row):
+        payload = json.dumps({'c': row.created_at.isoformat(), 'i': row.pk})
+        return base64.urlsafe_b64encode(payload.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, request):
+        raw = request.query_params.get(self.cursor_query_param)
+        if not raw:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(raw.encode('ascii')))
+            created_at = parse_datetime(payload['c'])
+            pk = int(payload['i'])
+        except (binascii.Error, ValueError, TypeError, KeyError, UnicodeEncodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            created_at, pk = position
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk)
+            )
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+
+class CatalogPagination(PageNumberPagination):
+    """
+    Page-number pagination by default (keeps `count` for the storefront);
+    switches to KeysetPagination when the client sends `?cursor=...` or
+    `?pagination=cursor` for the first page.
+    """
+    mode_query_param = 'pagination'
+    keyset_class = KeysetPagination
+
+    def __init__(self):
+        self.keyset = None
+
+    def use_keyset(self, request):
+        params = request.query_params
+        return self.keyset_class.cursor_query_param in params or params.get(self.mode_query_param) == 'cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.use_keyset(request):
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
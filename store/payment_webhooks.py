@@ -6,15 +6,19 @@ import json
 import hashlib
 import hmac
 import logging
-import time
+from datetime import timedelta
 from decimal import Decimal
 from django.conf import settings
 from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
-from django.db import transaction
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
 from django.core.mail import send_mail
-from .models import Order, Product, OrderItem
+from django.utils import timezone
+from .models import Order, Product, OrderItem, WebhookEvent
+from .inventory import commit_reservations, release_reservations
+from .tasks import enqueue
 import stripe
 
 logger = logging.getLogger(__name__)
@@ -79,7 +83,11 @@ def verify_paypal_signature(payload, headers):
 @require_POST
 def stripe_webhook(request):
     """
-    Handle Stripe webhooks with signature verification and retry logic
+    Handle Stripe webhooks with signature verification
+    
+    The raw event is stored keyed by its Stripe event id and acknowledged
+    immediately; processing (with retries) happens in a background task.
+    Redeliveries of an event already stored short-circuit with 200.
     
     Supported events:
     - payment_intent.succeeded
@@ -95,28 +103,14 @@ def stripe_webhook(request):
     if not event:
         return JsonResponse({'error': 'Invalid signature'}, status=400)
     
-    event_type = event.get('type') if isinstance(event, dict) else event.type
-    event_data = event.get('data', {}) if isinstance(event, dict) else event.data
-    
     try:
-        if event_type == 'payment_intent.succeeded':
-            handle_payment_success(event_data)
-        elif event_type == 'payment_intent.payment_failed':
-            handle_payment_failed(event_data)
-        elif event_type == 'charge.refunded':
-            handle_refund(event_data)
-        elif event_type == 'customer.subscription.updated':
-            handle_subscription_update(event_data)
-        else:
-            logger.info(f"Unhandled event type: {event_type}")
-        
-        log_payment_event(event_type, event_data, success=True)
-        return JsonResponse({'status': 'success'})
+        data = json.loads(payload.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    if not isinstance(data, dict) or not data.get('id'):
+        return JsonResponse({'error': 'Missing event id'}, status=400)
     
-    except Exception as e:
-        logger.exception(f"Error processing webhook: {e}")
-        log_payment_event(event_type, event_data, success=False, error_message=str(e))
-        return JsonResponse({'error': str(e)}, status=500)
+    return ingest_webhook_event(WebhookEvent.PROVIDER_STRIPE, data['id'], data.get('type', ''), data)
 
 
 @csrf_exempt
@@ -125,6 +119,8 @@ def paypal_webhook(request):
     """
     Handle PayPal webhooks with signature verification
     
+    Stored, deduplicated and processed in the background like Stripe events.
+    
     Supported events:
     - PAYMENT.CAPTURE.COMPLETED
     - PAYMENT.CAPTURE.DENIED
@@ -132,32 +128,151 @@ def paypal_webhook(request):
     """
     try:
         payload = json.loads(request.body.decode('utf-8'))
-    except json.JSONDecodeError:
+    except (ValueError, UnicodeDecodeError):
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
     
     # Verify signature
     if not verify_paypal_signature(payload, request.headers):
         return JsonResponse({'error': 'Invalid signature'}, status=400)
     
-    event_type = payload.get('event_type', '')
+    if not isinstance(payload, dict) or not payload.get('id'):
+        return JsonResponse({'error': 'Missing event id'}, status=400)
     
+    return ingest_webhook_event(WebhookEvent.PROVIDER_PAYPAL, payload['id'], payload.get('event_type', ''), payload)
+
+
+# ============= Ingestion & Background Processing =============
+
+# Attempts before an event is parked as failed, and the first retry delay
+# (doubled on every further attempt)
+WEBHOOK_MAX_ATTEMPTS = 5
+WEBHOOK_RETRY_BASE_DELAY = 30  # seconds
+# How long a worker may hold an event before another worker may reclaim it
+WEBHOOK_PROCESSING_LEASE = 300  # seconds
+
+
+def ingest_webhook_event(provider, event_id, event_type, payload):
+    """
+    Persist a verified delivery and queue it for processing
+    Returns the HTTP acknowledgement for the provider
+    """
     try:
-        if event_type == 'PAYMENT.CAPTURE.COMPLETED':
-            handle_paypal_payment_success(payload)
-        elif event_type == 'PAYMENT.CAPTURE.DENIED':
-            handle_paypal_payment_failed(payload)
-        elif event_type == 'BILLING.SUBSCRIPTION.CANCELLED':
-            handle_paypal_subscription_cancelled(payload)
-        else:
-            logger.info(f"Unhandled PayPal event: {event_type}")
-        
-        log_payment_event(event_type, payload, success=True)
-        return JsonResponse({'status': 'success'})
+        with transaction.atomic():
+            event = WebhookEvent.objects.create(
+                provider=provider,
+                event_id=str(event_id),
+                event_type=event_type,
+                payload=payload,
+            )
+    except IntegrityError:
+        logger.info(f"Duplicate {provider} webhook {event_id} ignored")
+        return JsonResponse({'status': 'duplicate'})
+    
+    enqueue(process_webhook_event, event.pk)
+    return JsonResponse({'status': 'received'})
+
+
+def backoff_delay(attempt, base_delay=WEBHOOK_RETRY_BASE_DELAY):
+    """Seconds to wait before retry number `attempt` (1-based): base, 2x, 4x, ..."""
+    return base_delay * (2 ** max(attempt - 1, 0))
+
+
+def _claimable(now):
+    return (
+        Q(status=WebhookEvent.STATUS_PENDING)
+        & (Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+    ) | Q(status=WebhookEvent.STATUS_PROCESSING, next_attempt_at__lte=now)
+
+
+def process_webhook_event(event_pk):
+    """
+    Process one stored webhook event
     
+    The event is claimed with a conditional UPDATE, so concurrent workers (or
+    a retry racing the original task) never apply it twice. Failures are
+    rescheduled with exponential backoff instead of sleeping in a worker.
+    Returns True when the event was processed by this call.
+    """
+    now = timezone.now()
+    claimed = WebhookEvent.objects.filter(_claimable(now), pk=event_pk).update(
+        status=WebhookEvent.STATUS_PROCESSING,
+        attempts=F('attempts') + 1,
+        next_attempt_at=now + timedelta(seconds=WEBHOOK_PROCESSING_LEASE),
+    )
+    if not claimed:
+        return False
+    
+    event = WebhookEvent.objects.get(pk=event_pk)
+    try:
+        dispatch_webhook_event(event)
     except Exception as e:
-        logger.exception(f"Error processing PayPal webhook: {e}")
-        log_payment_event(event_type, payload, success=False, error_message=str(e))
-        return JsonResponse({'error': str(e)}, status=500)
+        logger.exception(f"Error processing {event.provider} webhook {event.event_id}: {e}")
+        log_payment_event(event.event_type, event.payload, success=False, error_message=str(e))
+        if event.attempts >= WEBHOOK_MAX_ATTEMPTS:
+            event.status = WebhookEvent.STATUS_FAILED
+            event.next_attempt_at = None
+        else:
+            event.status = WebhookEvent.STATUS_PENDING
+            event.next_attempt_at = timezone.now() + timedelta(seconds=backoff_delay(event.attempts))
+        event.last_error = str(e)
+        event.save(update_fields=['status', 'next_attempt_at', 'last_error'])
+        return False
+    
+    log_payment_event(event.event_type, event.payload, success=True)
+    event.status = WebhookEvent.STATUS_PROCESSED
+    event.processed_at = timezone.now()
+    event.next_attempt_at = None
+    event.last_error = ''
+    event.save(update_fields=['status', 'processed_at', 'next_attempt_at', 'last_error'])
+    return True
+
+
+def process_due_webhook_events(limit=100):
+    """
+    Retry worker: process events whose backoff has elapsed (or whose worker
+    died mid-processing). Returns (processed, failed) counts.
+    """
+    due = list(
+        WebhookEvent.objects.filter(_claimable(timezone.now()))
+        .order_by('received_at')
+        .values_list('pk', flat=True)[:limit]
+    )
+    processed = sum(1 for pk in due if process_webhook_event(pk))
+    return processed, len(due) - processed
+
+
+def dispatch_webhook_event(event):
+    """Route a stored event to its provider handler"""
+    if event.provider == WebhookEvent.PROVIDER_STRIPE:
+        handle_stripe_event(event.event_type, event.payload.get('data', {}))
+    elif event.provider == WebhookEvent.PROVIDER_PAYPAL:
+        handle_paypal_event(event.event_type, event.payload)
+    else:
+        logger.warning(f"Unknown webhook provider: {event.provider}")
+
+
+def handle_stripe_event(event_type, event_data):
+    if event_type == 'payment_intent.succeeded':
+        handle_payment_success(event_data)
+    elif event_type == 'payment_intent.payment_failed':
+        handle_payment_failed(event_data)
+    elif event_type == 'charge.refunded':
+        handle_refund(event_data)
+    elif event_type == 'customer.subscription.updated':
+        handle_subscription_update(event_data)
+    else:
+        logger.info(f"Unhandled event type: {event_type}")
+
+
+def handle_paypal_event(event_type, payload):
+    if event_type == 'PAYMENT.CAPTURE.COMPLETED':
+        handle_paypal_payment_success(payload)
+    elif event_type == 'PAYMENT.CAPTURE.DENIED':
+        handle_paypal_payment_failed(payload)
+    elif event_type == 'BILLING.SUBSCRIPTION.CANCELLED':
+        handle_paypal_subscription_cancelled(payload)
+    else:
+        logger.info(f"Unhandled PayPal event: {event_type}")
 
 
 @transaction.atomic
@@ -188,8 +303,12 @@ def handle_payment_success(event_data):
         order.payment_reference = payment_intent.get('id')
         order.save()
         
-        # Update inventory
-        for item in order.items.all():
+        # Update inventory: stock reserved at checkout is committed; lines
+        # without a reservation (orders placed before checkout reserved
+        # every line) are decremented here
+        commit_reservations(order)
+        reserved = set(order.reservations.values_list('product_id', flat=True))
+        for item in order.items.exclude(product_id__in=reserved):
             product = item.product
             if hasattr(product, 'stock_quantity'):
                 product.stock_quantity = max(0, product.stock_quantity - item.quantity)
@@ -227,6 +346,9 @@ def handle_payment_failed(event_data):
         order.payment_status = 'failed'
         order.save()
         
+        # Give held stock back so other customers can buy it
+        release_reservations(order.reservations.all())
+        
         # Send failure email
         send_payment_failed_email(order)
         
@@ -253,11 +375,19 @@ def handle_refund(event_data):
     
     try:
         order = Order.objects.select_for_update().get(id=order_id)
+        
+        # Idempotency: a refund is applied once, even if the event is replayed
+        if order.payment_status == 'refunded':
+            logger.info(f"Order {order_id} already refunded")
+            return
+        
         order.payment_status = 'refunded'
         order.save()
         
         # Restore inventory
-        for item in order.items.all():
+        release_reservations(order.reservations.all(), include_committed=True)
+        reserved = set(order.reservations.values_list('product_id', flat=True))
+        for item in order.items.exclude(product_id__in=reserved):
             product = item.product
             if hasattr(product, 'stock_quantity'):
                 product.stock_quantity += item.quantity
@@ -392,19 +522,3 @@ def send_refund_confirmation_email(order):
         )
     except Exception as e:
         logger.exception(f"Error sending refund confirmation email: {e}")
-
-
-# Retry logic with exponential backoff
-def retry_with_backoff(func, max_retries=3, base_delay=1):
-    """
-    Retry function with exponential backoff
-    """
-    for attempt in range(max_retries):
-        try:
-            return func()
-        except Exception as e:
-            if attempt == max_retries - 1:
-                raise
-            delay = base_delay * (2 ** attempt)
-            logger.warning(f"Retry {attempt + 1}/{max_retries} after {delay}s: {e}")
-            time.sleep(delay)
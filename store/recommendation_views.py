@@ -5,6 +5,7 @@ from django.db.models import Count, Q, F
 from django.utils import timezone
 from datetime import timedelta
 from .models import Product, ProductView, ProductViewAnalytics, Order, OrderItem
+from .retention import most_viewed as most_viewed_since
 
 
 @require_GET
@@ -78,13 +79,8 @@ def get_trending_products(request):
     
     since = timezone.now() - timedelta(days=days)
     
-    # Most viewed products
-    most_viewed = Product.objects.filter(
-        views__viewed_at__gte=since,
-        is_active=True
-    ).annotate(
-        recent_views=Count('views')
-    ).order_by('-recent_views')[:limit]
+    # Most viewed products (daily aggregates once the raw views are archived)
+    most_viewed = most_viewed_since(timezone.localdate() - timedelta(days=days), limit)
     
     # Most sold products
     most_sold = Product.objects.filter(
@@ -95,8 +91,8 @@ def get_trending_products(request):
     ).order_by('-recent_sales')[:limit]
     
     return JsonResponse({
-        'most_viewed': [{'id': p.id, 'name': p.name, 'price': str(p.price), 'views': p.recent_views} 
-                       for p in most_viewed],
+        'most_viewed': [{'id': p.id, 'name': p.name, 'price': str(p.price), 'views': views} 
+                       for p, views in most_viewed],
         'most_sold': [{'id': p.id, 'name': p.name, 'price': str(p.price), 'sales': p.recent_sales} 
                      for p in most_sold],
     })
@@ -1,18 +1,119 @@
-from django.utils.deprecation import MiddlewareMixin
+"""
+Response Capture - Sampled, size-capped response logging for debugging
+Matching responses are sampled, truncated to RESPONSE_CAPTURE_MAX_BYTES and
+handed to a queue; a background listener writes them to a rotating file,
+so the request thread never touches the disk.
+"""
+import atexit
+from datetime import datetime, timezone as dt_timezone
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import threading
 
-class ResponseLoggerMiddleware(MiddlewareMixin):
-    def process_response(self, request, response):
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+_capture_logger = None
+_listener = None
+_lock = threading.Lock()
+
+
+def get_capture_logger():
+    """
+    Logger whose records go through a QueueHandler to a RotatingFileHandler
+    running on a QueueListener thread (created on first use)
+    """
+    global _capture_logger, _listener
+    if _capture_logger is None:
+        with _lock:
+            if _capture_logger is None:
+                file_handler = logging.handlers.RotatingFileHandler(
+                    settings.RESPONSE_CAPTURE_FILE,
+                    maxBytes=getattr(settings, 'RESPONSE_CAPTURE_FILE_MAX_BYTES', 5 * 1024 * 1024),
+                    backupCount=getattr(settings, 'RESPONSE_CAPTURE_BACKUP_COUNT', 3),
+                    encoding='utf-8',
+                )
+                file_handler.setFormatter(logging.Formatter('%(message)s'))
+                records = queue.Queue(maxsize=getattr(settings, 'RESPONSE_CAPTURE_QUEUE_SIZE', 1000))
+                _listener = logging.handlers.QueueListener(records, file_handler)
+                _listener.start()
+                atexit.register(stop_capture_logger)
+
+                capture_logger = logging.getLogger('store.response_capture')
+                capture_logger.setLevel(logging.INFO)
+                capture_logger.propagate = False
+                capture_logger.addHandler(_DroppingQueueHandler(records))
+                _capture_logger = capture_logger
+    return _capture_logger
+
+
+def stop_capture_logger():
+    """Flush pending records and stop the listener thread"""
+    global _capture_logger, _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+        if _capture_logger is not None:
+            for handler in list(_capture_logger.handlers):
+                _capture_logger.removeHandler(handler)
+        _capture_logger = None
+        _listener = None
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Drop records instead of blocking the request when the queue is full"""
+
+    def enqueue(self, record):
         try:
-            with open(r"C:\Users\letan\Desktop\lephat1898\tmp_final_response.txt", "w", encoding="utf-8") as f:
-                f.write(f"PATH: {getattr(request, 'path', '')}\n")
-                f.write(f"STATUS: {getattr(response, 'status_code', '')}\n")
-                try:
-                    content = getattr(response, 'content', b'')
-                    if isinstance(content, bytes):
-                        content = content.decode('utf-8', errors='replace')
-                    f.write(f"BODY: {content}\n")
-                except Exception:
-                    f.write("BODY: <unreadable>\n")
-        except Exception:
+            self.queue.put_nowait(record)
+        except queue.Full:
             pass
+
+
+class ResponseLoggerMiddleware:
+    """
+    Capture a sample of responses for paths matching RESPONSE_CAPTURE_PATHS
+
+    Disabled (removed from the middleware chain) unless
+    RESPONSE_CAPTURE_ENABLED is set.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'RESPONSE_CAPTURE_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = float(getattr(settings, 'RESPONSE_CAPTURE_SAMPLE_RATE', 0.01))
+        self.max_bytes = int(getattr(settings, 'RESPONSE_CAPTURE_MAX_BYTES', 2048))
+        self.patterns = [re.compile(p) for p in getattr(settings, 'RESPONSE_CAPTURE_PATHS', [])]
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if self.should_capture(request, response):
+            get_capture_logger().info(self.format_record(request, response))
         return response
+
+    def should_capture(self, request, response):
+        if getattr(response, 'streaming', False):
+            return False
+        if self.patterns and not any(p.search(request.path) for p in self.patterns):
+            return False
+        return random.random() < self.sample_rate
+
+    def format_record(self, request, response):
+        content = response.content
+        body = content[:self.max_bytes].decode('utf-8', errors='replace')
+        return json.dumps({
+            'time': datetime.now(dt_timezone.utc).isoformat(),
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'bytes': len(content),
+            'truncated': len(content) > self.max_bytes,
+            'body': body,
+        }, ensure_ascii=False)
@@ -0,0 +1,146 @@
+"""
+Event Retention - Daily rollups and archival of raw analytics events
+ProductView and SearchQuery rows older than EVENT_RETENTION_DAYS are copied
+into gzip JSONL files and deleted chunk by chunk, each chunk in its own
+short transaction. Product views are first rolled into per-day aggregates
+(searches already have hourly rollups), and the readers below serve
+rolled-up days from those aggregates and only recent days from raw rows.
+"""
+from datetime import datetime, time, timedelta
+import gzip
+import json
+import logging
+import os
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from . import visitors
+from .models import Product, ProductView, ProductViewDaily, SearchQuery, SiteTrafficDaily
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_CHUNK_SIZE = 5000
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def rolled_up_through():
+    """Last day whose product views are read from the daily aggregates"""
+    return SiteTrafficDaily.objects.aggregate(last=Max('date'))['last']
+
+
+def _raw_since(start_date):
+    """Raw views on or after start_date that are not covered by aggregates"""
+    last = rolled_up_through()
+    if last is not None and last >= start_date:
+        start_date = last + timedelta(days=1)
+    return ProductView.objects.filter(viewed_at__gte=_day_start(start_date))
+
+
+@transaction.atomic
+def _rollup_day(day):
+    rows = ProductView.objects.filter(
+        viewed_at__gte=_day_start(day), viewed_at__lt=_day_start(day + timedelta(days=1))
+    )
+    per_product = rows.values('product_id').annotate(views=Count('id')).order_by()
+    # uniques come from the same visitor keys and sketches as live ranges
+    sketches = visitors.day_sketches(day, rows)
+
+    def unique(product_id):
+        sketch = sketches.get(product_id)
+        return sketch.count() if sketch is not None else 0
+
+    ProductViewDaily.objects.filter(date=day).delete()
+    ProductViewDaily.objects.bulk_create([
+        ProductViewDaily(
+            date=day, product_id=row['product_id'], views=row['views'], unique_visitors=unique(row['product_id']),
+        )
+        for row in per_product
+    ])
+    SiteTrafficDaily.objects.update_or_create(date=day, defaults={
+        'views': rows.count(),
+        'unique_visitors': unique(visitors.SITE),
+    })
+
+
+def rollup_product_views(before):
+    """Aggregate every day before `before` that is not rolled up yet"""
+    raw = ProductView.objects.filter(viewed_at__lt=_day_start(before))
+    last = rolled_up_through()
+    if last is not None:
+        raw = raw.filter(viewed_at__gte=_day_start(last + timedelta(days=1)))
+    days = list(raw.annotate(day=TruncDate('viewed_at')).values_list('day', flat=True).distinct().order_by('day'))
+    for day in days:
+        _rollup_day(day)
+    return len(days)
+
+
+def archive_rows(queryset, name, directory, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Move the rows of `queryset` into <directory>/<name>/*.jsonl.gz, one file
+    per chunk of primary keys; each chunk is deleted only once its file is
+    complete, so an interrupted run never loses rows
+    """
+    target = Path(directory) / name
+    target.mkdir(parents=True, exist_ok=True)
+    fields = [field.attname for field in queryset.model._meta.concrete_fields]
+    archived, after = 0, 0
+    while True:
+        rows = list(queryset.filter(pk__gt=after).order_by('pk').values(*fields)[:chunk_size])
+        if not rows:
+            break
+        first, last = rows[0]['id'], rows[-1]['id']
+        path = target / f'{name}-{first:012d}-{last:012d}.jsonl.gz'
+        partial = path.with_name(path.name + '.part')
+        with gzip.open(partial, 'wt', encoding='utf-8') as handle:
+            for row in rows:
+                handle.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+        os.replace(partial, path)
+        with transaction.atomic():
+            queryset.filter(pk__gte=first, pk__lte=last).delete()
+        archived += len(rows)
+        after = last
+    return archived
+
+
+def apply_retention(days=None, directory=None, chunk_size=ARCHIVE_CHUNK_SIZE, today=None):
+    """Roll up, archive and delete raw events older than the retention window"""
+    days = days if days is not None else getattr(settings, 'EVENT_RETENTION_DAYS', 90)
+    directory = directory or settings.EVENT_ARCHIVE_DIR
+    cutoff = (today or timezone.localdate()) - timedelta(days=days)
+    horizon = _day_start(cutoff)
+
+    rolled = rollup_product_views(cutoff)
+    views = archive_rows(ProductView.objects.filter(viewed_at__lt=horizon), 'productview', directory, chunk_size)
+    searches = archive_rows(SearchQuery.objects.filter(created_at__lt=horizon), 'searchquery', directory, chunk_size)
+    logger.info(f"Retention before {cutoff}: {rolled} days rolled up, {views} views and {searches} searches archived")
+    return {'cutoff': cutoff, 'days_rolled_up': rolled, 'views_archived': views, 'searches_archived': searches}
+
+
+def view_counts(start_date, product_ids=None):
+    """{product_id: views} from start_date on, across aggregates and raw rows"""
+    daily = ProductViewDaily.objects.filter(date__gte=start_date)
+    raw = _raw_since(start_date)
+    if product_ids is not None:
+        daily = daily.filter(product_id__in=product_ids)
+        raw = raw.filter(product_id__in=product_ids)
+    counts = dict(daily.values('product_id').annotate(total=Sum('views')).order_by().values_list('product_id', 'total'))
+    for product_id, total in raw.values('product_id').annotate(total=Count('id')).order_by().values_list('product_id', 'total'):
+        counts[product_id] = counts.get(product_id, 0) + total
+    return counts
+
+
+def most_viewed(start_date, limit=10):
+    """[(product, views)] for active products, most viewed first"""
+    counts = view_counts(start_date)
+    ranked = sorted(counts, key=lambda pk: (-counts[pk], pk))
+    products = Product.objects.filter(pk__in=ranked, is_active=True).in_bulk()
+    return [(products[pk], counts[pk]) for pk in ranked if pk in products][:limit]
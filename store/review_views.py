@@ -4,7 +4,6 @@ from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
 from django.http import JsonResponse
 from django.views.decorators.http import require_POST
-from django.db.models import Avg
 
 from .models import Review, ReviewImage, ReviewHelpful, Product, Order, OrderItem
 
@@ -67,13 +66,12 @@ def review_list(request, pk):
         is_approved=True
     ).select_related('user').prefetch_related('images')
     
-    # Calculate average rating
-    avg_rating = reviews.aggregate(Avg('rating'))['rating__avg'] or 0
-    
+    # Average, count and histogram are stored on the product (Product.adjust_reviews)
     return render(request, 'reviews/review_list.html', {
         'product': product,
         'reviews': reviews,
-        'avg_rating': round(avg_rating, 1)
+        'avg_rating': round(product.rating, 1),
+        'rating_histogram': product.rating_histogram,
     })
 
 
@@ -1,8 +1,9 @@
 from django.core.paginator import Paginator
-from django.utils import timezone
-from datetime import timedelta
-from django.db.models import Count, Avg
-from .models import Product, SearchQuery
+from django.db.models import Count
+from .models import Product
+from .search_telemetry import (
+    failed_searches, make_event, popular_searches, search_stats, trending_searches, write_search_batch,
+)
 
 
 class ProductSearch:
@@ -51,7 +52,7 @@ class ProductSearch:
         elif sort_by == 'price_desc':
             qs = qs.order_by('-price')
         elif sort_by == 'rating':
-            qs = qs.order_by('-rating')
+            qs = qs.order_by('-rating', '-review_count')
         else:
             qs = qs.order_by('-created_at')
 
@@ -83,53 +84,23 @@ class ProductSearch:
         return [{'text': p.name} for p in qs]
 
     def track_search(self, query, user=None, session_key=None, result_count=0):
-        SearchQuery.objects.create(user=user, query=query, session_key=session_key, result_count=result_count)
+        """Write one search immediately; request handlers use search_telemetry.log_search"""
+        write_search_batch([make_event(query, user, session_key, result_count)])
 
     def get_popular_searches(self, limit=10, days=7):
-        since = timezone.now() - timedelta(days=days)
-        qs = (
-            SearchQuery.objects.filter(created_at__gte=since)
-            .values('query')
-            .annotate(count=Count('id'))
-            .order_by('-count')[:limit]
-        )
-        return list(qs)
+        return popular_searches(limit, days)
 
     def get_trending_searches(self, limit=10):
-        # simple trending: recent distinct queries
-        qs = (
-            SearchQuery.objects.order_by('-created_at')
-            .values('query')
-            .distinct()[:limit]
-        )
-        return list(qs)
+        return trending_searches(limit)
 
 
 class SearchAnalytics:
+    """Served from the hourly rollups (see store.search_telemetry)"""
+
     @classmethod
     def get_search_stats(cls, days=30):
-        since = timezone.now() - timedelta(days=days)
-        qs = SearchQuery.objects.filter(created_at__gte=since)
-        total_searches = qs.count()
-        unique_queries = qs.values('query').distinct().count()
-        zero_result_searches = qs.filter(result_count=0).count()
-        avg_results = qs.aggregate(avg=Avg('result_count'))['avg'] or 0
-
-        return {
-            'total_searches': total_searches,
-            'unique_queries': unique_queries,
-            'zero_result_searches': zero_result_searches,
-            'zero_result_rate': (zero_result_searches / total_searches) if total_searches else 0,
-            'avg_results_per_search': float(avg_results)
-        }
+        return search_stats(days)
 
     @classmethod
     def get_failed_searches(cls, limit=10, days=7):
-        since = timezone.now() - timedelta(days=days)
-        qs = (
-            SearchQuery.objects.filter(created_at__gte=since, result_count=0)
-            .values('query')
-            .annotate(count=Count('id'))
-            .order_by('-count')[:limit]
-        )
-        return list(qs)
\ No newline at end of file
+        return failed_searches(limit, days)
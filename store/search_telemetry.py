@@ -0,0 +1,204 @@
+"""
+Search Telemetry - Buffered search logging with hourly rollups
+Search requests only append to an in-process buffer; a background task
+writes each batch with one bulk INSERT plus one counter UPDATE per distinct
+(hour, normalized query) and one decayed-score UPDATE per query (see
+store.trending). Popular and failed searches are read from the hourly
+rollups and cached per telemetry version, so analytics cost grows with the
+number of days asked for, not with search volume.
+"""
+from collections import namedtuple
+from datetime import timedelta
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from .models import SearchQuery, SearchQueryHourly
+from .tasks import BufferedWriter
+from .trending import KIND_SEARCH, add_event, record_increments, trending_queries
+
+TELEMETRY_VERSION_KEY = 'search:telemetry:version'
+TOP_SEARCHES_TIMEOUT = 300
+MAX_TOP_LIMIT = 50
+MAX_WINDOW_DAYS = 90
+
+SearchEvent = namedtuple('SearchEvent', 'query user_id session_key result_count created_at')
+
+
+def normalize_query(query):
+    """Case-folded, whitespace-collapsed form used as the rollup key"""
+    return ' '.join((query or '').split()).casefold()[:255]
+
+
+def hour_bucket(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def get_telemetry_version():
+    version = cache.get(TELEMETRY_VERSION_KEY)
+    if version is None:
+        cache.add(TELEMETRY_VERSION_KEY, time.time(), None)
+        version = cache.get(TELEMETRY_VERSION_KEY)
+    return version
+
+
+def bump_telemetry_version():
+    cache.set(TELEMETRY_VERSION_KEY, time.time(), None)
+
+
+def record_rollups(events):
+    """Add events to their hourly counters and trending scores (caller provides the transaction)"""
+    counts = {}
+    trending = {}
+    for event in events:
+        query = normalize_query(event.query)
+        if not query:
+            continue
+        add_event(trending, KIND_SEARCH, query, event.created_at)
+        entry = counts.setdefault((hour_bucket(event.created_at), query), [0, 0, 0])
+        entry[0] += 1
+        entry[1] += 0 if event.result_count else 1
+        entry[2] += event.result_count
+
+    for (bucket, query), (searches, zero_results, result_total) in counts.items():
+        increments = {
+            'searches': F('searches') + searches,
+            'zero_results': F('zero_results') + zero_results,
+            'result_total': F('result_total') + result_total,
+        }
+        rollup = SearchQueryHourly.objects.filter(bucket=bucket, query=query)
+        if rollup.update(**increments):
+            continue
+        try:
+            with transaction.atomic():
+                SearchQueryHourly.objects.create(
+                    bucket=bucket, query=query, searches=searches,
+                    zero_results=zero_results, result_total=result_total,
+                )
+        except IntegrityError:
+            # another writer created this hour's row first
+            rollup.update(**increments)
+    record_increments(trending)
+
+
+def write_search_batch(events):
+    """Persist a batch: raw SearchQuery rows plus the hourly rollups"""
+    if not events:
+        return
+    with transaction.atomic():
+        SearchQuery.objects.bulk_create([
+            SearchQuery(
+                user_id=event.user_id,
+                query=event.query[:255],
+                session_key=event.session_key,
+                result_count=event.result_count,
+                created_at=event.created_at,
+            )
+            for event in events
+        ])
+        record_rollups(events)
+    bump_telemetry_version()
+
+
+class SearchLogBuffer(BufferedWriter):
+    """Search events waiting to be bulk written with their hourly rollups"""
+    batch_size_setting = 'SEARCH_LOG_BATCH_SIZE'
+    flush_seconds_setting = 'SEARCH_LOG_FLUSH_SECONDS'
+
+    def collect(self, batch, event):
+        batch.append(event)
+
+    def write(self, batch):
+        write_search_batch(batch)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_search_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = SearchLogBuffer()
+    return _buffer
+
+
+def make_event(query, user=None, session_key=None, result_count=0):
+    user_id = user.pk if user is not None and user.is_authenticated else None
+    return SearchEvent(query, user_id, session_key, int(result_count or 0), timezone.now())
+
+
+def log_search(query, user=None, session_key=None, result_count=0):
+    """Record a search from a request handler without touching the database"""
+    if normalize_query(query):
+        get_search_buffer().add(make_event(query, user, session_key, result_count))
+
+
+def _since(hours):
+    return hour_bucket(timezone.now() - timedelta(hours=hours))
+
+
+def _clamp(value, upper):
+    return max(1, min(int(value), upper))
+
+
+def _cached(name, compute, *args):
+    key = f"search:{name}:{get_telemetry_version()}:{':'.join(str(a) for a in args)}"
+    result = cache.get(key)
+    if result is None:
+        result = compute(*args)
+        cache.set(key, result, TOP_SEARCHES_TIMEOUT)
+    return result
+
+
+def _top(counter, limit, hours):
+    return list(
+        SearchQueryHourly.objects.filter(bucket__gte=_since(hours))
+        .values('query')
+        .annotate(count=Sum(counter))
+        .filter(count__gt=0)
+        .order_by('-count', 'query')[:limit]
+    )
+
+
+def popular_searches(limit=10, days=7):
+    """[{'query', 'count'}] most searched over the last `days`"""
+    return _cached('popular', _top, 'searches', _clamp(limit, MAX_TOP_LIMIT), _clamp(days, MAX_WINDOW_DAYS) * 24)
+
+
+def trending_searches(limit=10):
+    """[{'query', 'score'}] searches ranked by exponentially decayed volume"""
+    return trending_queries(_clamp(limit, MAX_TOP_LIMIT))
+
+
+def failed_searches(limit=10, days=7):
+    """[{'query', 'count'}] searches that returned nothing"""
+    return _cached('failed', _top, 'zero_results', _clamp(limit, MAX_TOP_LIMIT), _clamp(days, MAX_WINDOW_DAYS) * 24)
+
+
+def _stats(hours):
+    totals = SearchQueryHourly.objects.filter(bucket__gte=_since(hours)).aggregate(
+        total_searches=Sum('searches'),
+        unique_queries=Count('query', distinct=True),
+        zero_result_searches=Sum('zero_results'),
+        result_total=Sum('result_total'),
+    )
+    total = totals['total_searches'] or 0
+    zero = totals['zero_result_searches'] or 0
+    return {
+        'total_searches': total,
+        'unique_queries': totals['unique_queries'],
+        'zero_result_searches': zero,
+        'zero_result_rate': (zero / total) if total else 0,
+        'avg_results_per_search': (totals['result_total'] or 0) / total if total else 0.0,
+    }
+
+
+def search_stats(days=30):
+    return _cached('stats', _stats, _clamp(days, MAX_WINDOW_DAYS) * 24)
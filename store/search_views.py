@@ -6,6 +6,7 @@ from django.http import JsonResponse
 from django.views.decorators.http import require_GET
 from django.contrib.auth.decorators import login_required
 from .search import ProductSearch, SearchAnalytics
+from .search_telemetry import log_search
 from .models import Product
 
 
@@ -55,8 +56,8 @@ def product_search_view(request):
     if query:
         user = request.user if request.user.is_authenticated else None
         session_key = request.session.session_key if not user else None
-        searcher.track_search(
-            query=query,
+        log_search(
+            query,
             user=user,
             session_key=session_key,
             result_count=results['total_results']
@@ -162,8 +163,10 @@ def popular_searches_view(request):
     
     searcher = ProductSearch()
     popular = list(searcher.get_popular_searches(limit=limit, days=days))
+    trending = searcher.get_trending_searches(limit=limit)
     
     return JsonResponse({
         'success': True,
-        'popular_searches': popular
+        'popular_searches': popular,
+        'trending_searches': trending,
     })
\ No newline at end of file
@@ -4,13 +4,19 @@ Implements 2FA, rate limiting, security headers, and input validation
 """
 import re
 import logging
+import math
 import secrets
 import hashlib
+import ipaddress
+import threading
+import time
+from collections import namedtuple
 from datetime import timedelta
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.password_validation import validate_password
-from django.core.exceptions import ValidationError
+from django.core.exceptions import PermissionDenied, ValidationError
 from django.core.cache import cache
 from django.http import JsonResponse, HttpResponseForbidden
 from django.utils import timezone
@@ -21,6 +27,8 @@ from functools import wraps
 import pyotp
 import urllib.parse
 
+from .tasks import BufferedWriter
+
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
@@ -106,6 +114,13 @@ class TwoFactorAuth:
 
 # ============= Rate Limiting =============
 
+def _valid_ip(value):
+    try:
+        return str(ipaddress.ip_address((value or '').strip()))
+    except ValueError:
+        return None
+
+
 class RateLimiter:
     """
     Rate limiting to prevent abuse and DoS attacks
@@ -113,13 +128,22 @@ class RateLimiter:
     
     @staticmethod
     def get_client_ip(request):
-        """Get client IP address"""
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        if x_forwarded_for:
-            ip = x_forwarded_for.split(',')[0]
-        else:
-            ip = request.META.get('REMOTE_ADDR')
-        return ip
+        """
+        Get client IP address
+        
+        REMOTE_ADDR, unless TRUSTED_PROXY_COUNT reverse proxies sit in front
+        of the app: then the X-Forwarded-For entry the outermost of them
+        appended (the TRUSTED_PROXY_COUNT-th from the right). Entries left of
+        it are supplied by the client and never trusted. None if no valid
+        address is found.
+        """
+        remote_addr = _valid_ip(request.META.get('REMOTE_ADDR'))
+        proxies = getattr(settings, 'TRUSTED_PROXY_COUNT', 0)
+        if proxies > 0:
+            forwarded = [hop.strip() for hop in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if hop.strip()]
+            if len(forwarded) >= proxies:
+                return _valid_ip(forwarded[-proxies]) or remote_addr
+        return remote_addr
     
     @staticmethod
     def is_rate_limited(key, limit, period):
@@ -185,42 +209,187 @@ class RateLimiter:
 
 # ============= Login Protection =============
 
+LoginCheck = namedtuple('LoginCheck', 'locked retry_after remaining')
+
+
 class LoginProtection:
     """
     Protect login endpoints from brute force attacks
+    
+    Failures are counted per username and per client IP with atomic cache
+    increments inside a fixed window. Reaching a threshold locks that
+    username (or IP) out; every repeat lockout within STRIKE_MEMORY doubles
+    the lockout, up to MAX_LOCKOUT_DURATION.
     """
     
-    LOCKOUT_THRESHOLD = 5  # Failed attempts before lockout
-    LOCKOUT_DURATION = 900  # 15 minutes
+    LOCKOUT_THRESHOLD = 5  # Failed attempts per username before lockout
+    IP_LOCKOUT_THRESHOLD = 20  # Failed attempts per IP (shared NATs) before lockout
+    FAILURE_WINDOW = 900  # Failures older than this are forgotten
+    LOCKOUT_DURATION = 900  # First lockout: 15 minutes
+    MAX_LOCKOUT_DURATION = 86400
+    STRIKE_MEMORY = 86400  # How long earlier lockouts count towards doubling
     
     @staticmethod
-    def record_failed_attempt(username):
-        """Record a failed login attempt"""
-        key = f"login_attempts:{username}"
-        attempts = cache.get(key, 0)
-        cache.set(key, attempts + 1, LoginProtection.LOCKOUT_DURATION)
-        
-        logger.warning(f"Failed login attempt for {username} (attempt {attempts + 1})")
+    def _scopes(username, ip=None):
+        """[(scope key, threshold)] for the username and, if known, the IP"""
+        digest = hashlib.sha256((username or '').casefold().encode('utf-8')).hexdigest()[:32]
+        scopes = [(f"user:{digest}", LoginProtection.LOCKOUT_THRESHOLD)]
+        if ip:
+            scopes.append((f"ip:{ip}", LoginProtection.IP_LOCKOUT_THRESHOLD))
+        return scopes
+    
+    @staticmethod
+    def _increment(key, timeout):
+        """Atomic counter; the TTL is set by the first increment only"""
+        cache.add(key, 0, timeout)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # expired between add() and incr()
+            cache.set(key, 1, timeout)
+            return 1
+    
+    @staticmethod
+    def check(username, ip=None):
+        """Lockout state for a login attempt, read in one cache round trip"""
+        scopes = LoginProtection._scopes(username, ip)
+        keys = [f"login_lock:{scope}" for scope, _ in scopes] + [f"login_attempts:{scope}" for scope, _ in scopes]
+        values = cache.get_many(keys)
+        now = time.time()
+        retry_after = max(
+            [math.ceil(values[f"login_lock:{scope}"] - now) for scope, _ in scopes if f"login_lock:{scope}" in values] or [0]
+        )
+        remaining = min(threshold - values.get(f"login_attempts:{scope}", 0) for scope, threshold in scopes)
+        locked = retry_after > 0
+        return LoginCheck(locked, retry_after, 0 if locked else max(0, remaining))
     
     @staticmethod
-    def is_locked_out(username):
+    def record_failed_attempt(username, ip=None):
+        """Record a failed login attempt; returns the resulting LoginCheck"""
+        for scope, threshold in LoginProtection._scopes(username, ip):
+            failures = LoginProtection._increment(f"login_attempts:{scope}", LoginProtection.FAILURE_WINDOW)
+            # == so that concurrent failures past the threshold lock only once
+            if failures == threshold:
+                strikes = LoginProtection._increment(f"login_strikes:{scope}", LoginProtection.STRIKE_MEMORY)
+                duration = min(
+                    LoginProtection.LOCKOUT_DURATION * 2 ** (strikes - 1), LoginProtection.MAX_LOCKOUT_DURATION
+                )
+                cache.set(f"login_lock:{scope}", time.time() + duration, duration)
+                cache.delete(f"login_attempts:{scope}")
+                logger.warning(f"Login locked out for {scope} for {duration}s (strike {strikes})")
+        
+        logger.warning(f"Failed login attempt for {username} from {ip}")
+        return LoginProtection.check(username, ip)
+    
+    @staticmethod
+    def is_locked_out(username, ip=None):
         """Check if account is locked due to failed attempts"""
-        key = f"login_attempts:{username}"
-        attempts = cache.get(key, 0)
-        return attempts >= LoginProtection.LOCKOUT_THRESHOLD
+        return LoginProtection.check(username, ip).locked
     
     @staticmethod
     def clear_attempts(username):
-        """Clear failed login attempts"""
-        key = f"login_attempts:{username}"
-        cache.delete(key)
+        """Clear failed login attempts and lockouts for a username"""
+        scope = LoginProtection._scopes(username)[0][0]
+        cache.delete_many([f"login_attempts:{scope}", f"login_lock:{scope}", f"login_strikes:{scope}"])
     
     @staticmethod
-    def get_remaining_attempts(username):
+    def get_remaining_attempts(username, ip=None):
         """Get remaining login attempts"""
-        key = f"login_attempts:{username}"
-        attempts = cache.get(key, 0)
-        return max(0, LoginProtection.LOCKOUT_THRESHOLD - attempts)
+        return LoginProtection.check(username, ip).remaining
+
+
+class LoginProtectionBackend(ModelBackend):
+    """
+    ModelBackend that refuses usernames and IPs LoginProtection has locked
+    out, so every login path (store login, django.contrib.auth views and the
+    admin) shares the lockout. Failures are counted, and successes clear
+    them, by the auth signal receivers below.
+    """
+    
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(get_user_model().USERNAME_FIELD)
+        ip = RateLimiter.get_client_ip(request) if request is not None else None
+        status = LoginProtection.check(username, ip)
+        if request is not None:
+            request.login_check = status
+        if status.locked:
+            # stops authenticate() here, before any password is checked
+            raise PermissionDenied
+        return super().authenticate(request, username=username, password=password, **kwargs)
+
+
+def record_login_failure(request, username):
+    """Count a failed login and queue its audit row (user_login_failed)"""
+    if request is not None:
+        log_login_attempt(request, username, success=False)
+    status = getattr(request, 'login_check', None)
+    if status is not None and status.locked:
+        # refused while locked out; not a new failure
+        return status
+    status = LoginProtection.record_failed_attempt(
+        username, RateLimiter.get_client_ip(request) if request is not None else None
+    )
+    if request is not None:
+        request.login_check = status
+    return status
+
+
+def record_login_success(request, user):
+    """Clear the username's failures and queue its audit row (user_logged_in)"""
+    LoginProtection.clear_attempts(user.get_username())
+    if request is not None:
+        log_login_attempt(request, user.get_username(), success=True)
+
+
+class AuditLogBuffer(BufferedWriter):
+    """
+    Audit rows (LoginAttempt, SuspiciousActivity) for one model, so a burst
+    of attempts costs one INSERT per batch instead of one per request
+    """
+    batch_size_setting = 'AUDIT_LOG_BATCH_SIZE'
+    flush_seconds_setting = 'AUDIT_LOG_FLUSH_SECONDS'
+    default_batch_size = 200
+    default_flush_seconds = 10
+    
+    def __init__(self, model, batch_size=None, flush_seconds=None):
+        self.model = model
+        super().__init__(batch_size, flush_seconds)
+    
+    def collect(self, batch, row):
+        batch.append(row)
+    
+    def write(self, batch):
+        write_audit_rows(self.model, batch)
+
+
+def write_audit_rows(model, rows):
+    if rows:
+        model.objects.bulk_create(rows)
+
+
+_audit_buffers = {}
+_audit_buffers_lock = threading.Lock()
+
+
+def get_audit_buffer(model):
+    buffer = _audit_buffers.get(model)
+    if buffer is None:
+        with _audit_buffers_lock:
+            buffer = _audit_buffers.setdefault(model, AuditLogBuffer(model))
+    return buffer
+
+
+def log_login_attempt(request, username, success):
+    """Queue a LoginAttempt audit row for this request"""
+    from .models import LoginAttempt
+    get_audit_buffer(LoginAttempt).add(LoginAttempt(
+        username=(username or '')[:150],
+        ip_address=RateLimiter.get_client_ip(request) or '0.0.0.0',
+        success=success,
+        user_agent=request.META.get('HTTP_USER_AGENT', '')[:255],
+        timestamp=timezone.now(),
+    ))
 
 
 # ============= Input Validation & Sanitization =============
@@ -337,6 +506,56 @@ class SecurityHeadersMiddleware:
         return response
 
 
+class ThreatScanMiddleware:
+    """
+    Scan query strings and form fields for injection/XSS probes and record
+    hits as SuspiciousActivity (buffered). Requests are never blocked; the
+    joined field values are scanned once, up to THREAT_SCAN_MAX_CHARS.
+    """
+    
+    # Field values that are never scanned (secrets, CSRF tokens)
+    SKIPPED_FIELDS = ('password', 'csrfmiddlewaretoken')
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.limit = getattr(settings, 'THREAT_SCAN_MAX_CHARS', 8192)
+    
+    def _payload(self, request):
+        parts, size = [], 0
+        fields = [request.GET]
+        if request.method == 'POST' and request.content_type in ('application/x-www-form-urlencoded', 'multipart/form-data'):
+            fields.append(request.POST)
+        for querydict in fields:
+            for key, values in querydict.lists():
+                if any(skipped in key.lower() for skipped in self.SKIPPED_FIELDS):
+                    continue
+                for value in values:
+                    parts.append(value)
+                    size += len(value) + 1
+                    if size >= self.limit:
+                        # NUL cannot match any pattern, so hits never span two fields
+                        return '\x00'.join(parts)
+        return '\x00'.join(parts)
+    
+    def __call__(self, request):
+        payload = self._payload(request)
+        hit = scan_for_threats(payload, self.limit) if payload else None
+        if hit is not None:
+            self._record(request, *hit)
+        return self.get_response(request)
+    
+    def _record(self, request, kind, fragment):
+        from .models import SuspiciousActivity
+        ip = RateLimiter.get_client_ip(request) or '0.0.0.0'
+        logger.warning(f"Possible {kind} from {ip} on {request.path}: {fragment[:100]!r}")
+        get_audit_buffer(SuspiciousActivity).add(SuspiciousActivity(
+            activity_type=kind,
+            description=f"{request.method} {request.path[:200]}: {fragment[:200]}",
+            ip_address=ip,
+            created_at=timezone.now(),
+        ))
+
+
 # ============= CAPTCHA Integration =============
 
 class CaptchaValidator:
@@ -396,6 +615,58 @@ def configure_session_security():
 
 # ============= Suspicious Activity Detection =============
 
+# SQL keywords only count in injection context (a quote, a stacked
+# statement, UNION SELECT), so "drop cloth" or "update my order" stay clean
+THREAT_PATTERNS = {
+    'sql_injection': [
+        r'\bUNION\b(?:\s+ALL)?\s+SELECT\b',
+        r"'\s*;\s*(?:SELECT|DROP|INSERT|UPDATE|DELETE)\b",
+        r';\s*(?:DROP\s+TABLE|DELETE\s+FROM|INSERT\s+INTO|UPDATE\s+\w+\s+SET|SELECT\s+\S+\s+FROM)\b',
+        r"'\s*(?:--|/\*)",
+        r'/\*.*?\*/',
+        r'\bOR\b\s+\d+\s*=\s*\d+',
+        r"'\s*OR\s+'[^']*'\s*=\s*'",
+    ],
+    'xss': [
+        r'<script[^>]*>.*?</script>',
+        r'javascript:',
+        r'onerror\s*=',
+        r'onload\s*=',
+    ],
+}
+
+_SQL_INJECTION = re.compile('|'.join(THREAT_PATTERNS['sql_injection']), re.IGNORECASE)
+_XSS = re.compile('|'.join(THREAT_PATTERNS['xss']), re.IGNORECASE)
+# Every pattern in one alternation; the named group that matched tells the kind
+_THREATS = re.compile(
+    '|'.join(f"(?P<{kind}>{'|'.join(patterns)})" for kind, patterns in THREAT_PATTERNS.items()),
+    re.IGNORECASE,
+)
+# Any match contains one of these (casefolded); keep in step with THREAT_PATTERNS.
+# The OR probe is caught by its '=' (a bare 'or' is in order, color, for...)
+_THREAT_KEYWORDS = (
+    'union', 'select', 'drop', 'insert', 'update', 'delete', '--', '/*', '=',
+    '<script', 'javascript:', 'onerror', 'onload',
+)
+
+
+def scan_for_threats(text, limit=None):
+    """
+    First suspicious fragment in the first `limit` characters of text as
+    (kind, fragment), or None. Clean text is usually rejected by plain
+    substring checks; otherwise the combined pattern runs once.
+    """
+    if limit is None:
+        limit = getattr(settings, 'THREAT_SCAN_MAX_CHARS', 8192)
+    folded = text[:limit].casefold()
+    if not any(keyword in folded for keyword in _THREAT_KEYWORDS):
+        return None
+    match = _THREATS.search(text, 0, limit)
+    if match is None:
+        return None
+    return match.lastgroup, match.group()
+
+
 class SuspiciousActivityDetector:
     """
     Detect and log suspicious activity
@@ -404,34 +675,17 @@ class SuspiciousActivityDetector:
     @staticmethod
     def detect_sql_injection(text):
         """Detect SQL injection attempts"""
-        sql_patterns = [
-            r'(\bUNION\b|\bSELECT\b|\bDROP\b|\bINSERT\b|\bUPDATE\b|\bDELETE\b)',
-            r'(--|\/\*|\*\/)',
-            r'(\bOR\b\s+\d+\s*=\s*\d+)',
-        ]
-        
-        for pattern in sql_patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                logger.critical(f"Potential SQL injection detected: {text[:100]}")
-                return True
-        
+        if _SQL_INJECTION.search(text):
+            logger.critical(f"Potential SQL injection detected: {text[:100]}")
+            return True
         return False
     
     @staticmethod
     def detect_xss(text):
         """Detect XSS attempts"""
-        xss_patterns = [
-            r'<script[^>]*>.*?</script>',
-            r'javascript:',
-            r'onerror\s*=',
-            r'onload\s*=',
-        ]
-        
-        for pattern in xss_patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                logger.critical(f"Potential XSS detected: {text[:100]}")
-                return True
-        
+        if _XSS.search(text):
+            logger.critical(f"Potential XSS detected: {text[:100]}")
+            return True
         return False
     
     @staticmethod
@@ -442,5 +696,4 @@ class SuspiciousActivityDetector:
             f"Details: {details}"
         )
         
-        # Optionally save to database for tracking
-        # SuspiciousActivity.objects.create(...)
+        # Requests are recorded to SuspiciousActivity by ThreatScanMiddleware
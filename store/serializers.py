@@ -1,10 +1,26 @@
+from decimal import Decimal
+
+from django.db.models import Prefetch
 from rest_framework import serializers
 from .models import (
     Product, Brand, Category, Order, OrderItem,
-    ProductView, StockLevel, Coupon
+    ProductView, StockLevel, Coupon, line_total_sum
 )
 
 
+class SparseFieldsetMixin:
+    """
+    Accepts `fields=[...]` to serialize only those fields (unknown names are
+    ignored). Views pass it from the `?fields=` query parameter.
+    """
+    
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
 class BrandSerializer(serializers.ModelSerializer):
     class Meta:
         model = Brand
@@ -17,7 +33,11 @@ class CategorySerializer(serializers.ModelSerializer):
         fields = ['id', 'name']
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    """
+    Querysets should be passed through `setup_eager_loading` so brand,
+    category and stock come from the same query as the products.
+    """
     brand = BrandSerializer(read_only=True)
     category = CategorySerializer(read_only=True)
     stock_quantity = serializers.SerializerMethodField()
@@ -31,6 +51,12 @@ class ProductSerializer(serializers.ModelSerializer):
             'created_at', 'updated_at', 'stock_quantity', 'in_stock'
         ]
     
+    @staticmethod
+    def setup_eager_loading(queryset, prefix=''):
+        return queryset.select_related(
+            f'{prefix}brand', f'{prefix}category', f'{prefix}stock'
+        )
+    
     def get_stock_quantity(self, obj):
         try:
             return obj.stock.quantity
@@ -52,7 +78,11 @@ class OrderItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product', 'quantity', 'price']
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    """
+    Use `setup_eager_loading` to prefetch items (with their products) and
+    annotate `items_total` in the database.
+    """
     items = OrderItemSerializer(many=True, read_only=True)
     total = serializers.SerializerMethodField()
     
@@ -65,7 +95,18 @@ class OrderSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['payment_status', 'payment_reference']
     
+    @staticmethod
+    def setup_eager_loading(queryset, fields=None):
+        if not fields or 'items' in fields:
+            items = ProductSerializer.setup_eager_loading(OrderItem.objects.all(), prefix='product__')
+            queryset = queryset.prefetch_related(Prefetch('items', queryset=items))
+        if fields and 'total' not in fields:
+            return queryset
+        return queryset.annotate(items_total=line_total_sum('items__'))
+    
     def get_total(self, obj):
+        if hasattr(obj, 'items_total'):
+            return obj.items_total or Decimal('0')
         return sum(item.price * item.quantity for item in obj.items.all())
 
 
@@ -1,27 +1,42 @@
+from decimal import Decimal
+
 from django.conf import settings
+from django.contrib.auth.signals import user_logged_in, user_login_failed
 from django.core.mail import send_mail
-from django.db.models.signals import pre_save, post_save
+from django.db import transaction
+from django.db.models.signals import m2m_changed, pre_save, post_save, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
 
-from .models import Order
-
-
-def _get_recipient(order: Order):
-    # Prefer linked user's email; otherwise skip if not available.
-    if order.user and getattr(order.user, "email", None):
-        return order.user.email
-    return None
+from .cache import bump_catalog_version_on_commit
+from .cart import merge_session_cart
+from .coupons import bump_coupon_version
+from .email_utils import order_created_message, order_paid_message, order_recipient, order_status_message
+from .search_telemetry import SearchEvent, bump_telemetry_version, record_rollups
+from .security import record_login_failure, record_login_success
+from .trending import record_product_view
+from .visitors import record_view
+from .models import (
+    Brand, Cart, CartItem, Category, Coupon, Order, OrderItem, Product, ProductTombstone, ProductView, Review,
+    SearchQuery, StockLevel,
+)
 
 
 def _send_order_email(subject, body, recipient):
     if not recipient:
         return
     from_email = getattr(settings, "DEFAULT_FROM_EMAIL", None) or None
-    try:
-        send_mail(subject, body, from_email, [recipient], fail_silently=True)
-    except Exception:
-        # Never raise from signals to avoid breaking save flows
-        pass
+
+    def send():
+        try:
+            send_mail(subject, body, from_email, [recipient], fail_silently=True)
+        except Exception:
+            # Never raise from signals to avoid breaking save flows
+            pass
+
+    # Only email about orders that actually committed (checkout rolls back
+    # the order when stock cannot be reserved)
+    transaction.on_commit(send)
 
 
 @receiver(pre_save, sender=Order)
@@ -41,39 +56,150 @@ def order_pre_save_track_status(sender, instance: Order, **kwargs):
 
 @receiver(post_save, sender=Order)
 def order_post_save_notify(sender, instance: Order, created, **kwargs):
-    recipient = _get_recipient(instance)
+    recipient = order_recipient(instance)
     if created:
-        subject = f"Đơn hàng #{instance.id} đã được tạo"
-        body = (
-            f"Xin chào {instance.full_name},\n\n"
-            f"Đơn hàng #{instance.id} của bạn đã được tạo và đang chờ xử lý.\n"
-            f"Trạng thái hiện tại: {instance.get_status_display()}.\n\n"
-            "Cảm ơn bạn đã mua hàng!"
-        )
-        _send_order_email(subject, body, recipient)
+        _send_order_email(*order_created_message(instance), recipient)
         return
 
     # Status change notification
     old_status = getattr(instance, "_old_status", None)
     if old_status and old_status != instance.status:
-        subject = f"Đơn hàng #{instance.id} cập nhật trạng thái"
-        body = (
-            f"Xin chào {instance.full_name},\n\n"
-            f"Đơn hàng #{instance.id} đã chuyển từ '{dict(Order.STATUS_CHOICES).get(old_status, old_status)}' "
-            f"sang '{instance.get_status_display()}'.\n\n"
-            "Cảm ơn bạn đã mua hàng!"
-        )
-        _send_order_email(subject, body, recipient)
+        _send_order_email(*order_status_message(instance, old_status), recipient)
 
     # Paid notification (trigger only on transition False -> True)
     old_is_paid = getattr(instance, "_old_is_paid", None)
     if old_is_paid is False and instance.is_paid:
-        subject = f"Đơn hàng #{instance.id} đã được thanh toán"
-        body = (
-            f"Xin chào {instance.full_name},\n\n"
-            f"Đơn hàng #{instance.id} đã được xác nhận thanh toán thành công.\n"
-            f"Phương thức: {instance.get_payment_method_display()}.\n"
-            f"Trạng thái hiện tại: {instance.get_status_display()}.\n\n"
-            "Cảm ơn bạn đã mua hàng!"
-        )
-        _send_order_email(subject, body, recipient)
+        _send_order_email(*order_paid_message(instance), recipient)
+
+
+@receiver([post_save, post_delete], sender=OrderItem)
+def order_item_changed(sender, instance: OrderItem, **kwargs):
+    # Checkout bulk-creates items and sets order_total itself; this covers
+    # the admin inline and other per-item edits
+    Order.refresh_totals([instance.order_id])
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=Brand)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=StockLevel)
+def catalog_changed(sender, **kwargs):
+    # Invalidates ETags of catalog pages and API responses (see store.conditional)
+    bump_catalog_version_on_commit()
+
+
+@receiver(post_save, sender=StockLevel)
+def stock_level_saved(sender, instance, **kwargs):
+    # Stock is part of the product's sync payload (store.catalog_sync)
+    Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    ProductTombstone.objects.update_or_create(
+        product_id=instance.pk, defaults={'deleted_at': timezone.now()}
+    )
+
+
+@receiver(pre_save, sender=CartItem)
+def cart_item_pre_save(sender, instance: CartItem, **kwargs):
+    if not instance.price:
+        instance.price = instance.product.get_price()
+    old = None
+    if instance.pk:
+        old = CartItem.objects.filter(pk=instance.pk).values_list('cart_id', 'quantity', 'price').first()
+    instance._old_line = old  # type: ignore[attr-defined]
+
+
+@receiver(post_save, sender=CartItem)
+def cart_item_saved(sender, instance: CartItem, **kwargs):
+    # store.cart updates quantities with queryset F() updates and adjusts the
+    # totals itself; this keeps them right for admin and direct ORM saves.
+    # price may still be the float/int it was assigned as.
+    quantity, amount = instance.quantity, instance.quantity * Decimal(str(instance.price))
+    old = getattr(instance, '_old_line', None)
+    if old is not None:
+        old_cart_id, old_quantity, old_price = old
+        if old_cart_id == instance.cart_id:
+            quantity, amount = quantity - old_quantity, amount - old_quantity * old_price
+        else:
+            Cart.adjust_totals(old_cart_id, -old_quantity, -old_quantity * old_price)
+    Cart.adjust_totals(instance.cart_id, quantity, amount)
+
+
+@receiver(post_delete, sender=CartItem)
+def cart_item_deleted(sender, instance: CartItem, **kwargs):
+    Cart.adjust_totals(instance.cart_id, -instance.quantity, -instance.quantity * Decimal(str(instance.price)))
+
+
+@receiver(user_logged_in)
+def merge_cart_on_login(sender, request, user, **kwargs):
+    if request is not None and hasattr(request, 'session'):
+        merge_session_cart(request.session, user)
+
+
+@receiver(user_logged_in)
+def login_succeeded(sender, request, user, **kwargs):
+    record_login_success(request, user)
+
+
+@receiver(user_login_failed)
+def login_failed(sender, credentials, request=None, **kwargs):
+    record_login_failure(request, credentials.get('username'))
+
+
+@receiver(post_save, sender=SearchQuery)
+def search_query_saved(sender, instance: SearchQuery, created, **kwargs):
+    # Buffered logging bulk-inserts (no signal) and rolls up itself; this
+    # keeps the hourly rollups complete for rows saved one at a time
+    if created:
+        record_rollups([SearchEvent(
+            instance.query, instance.user_id, instance.session_key, instance.result_count, instance.created_at
+        )])
+        bump_telemetry_version()
+
+
+@receiver(post_save, sender=ProductView)
+def product_view_saved(sender, instance: ProductView, created, **kwargs):
+    # Buffered; trending scores and visitor sketches are written in batches
+    if created:
+        record_product_view(instance.product_id, instance.viewed_at)
+        record_view(instance)
+
+
+@receiver(pre_save, sender=Review)
+def review_pre_save(sender, instance: Review, **kwargs):
+    old = None
+    if instance.pk:
+        old = Review.objects.filter(pk=instance.pk).values_list('product_id', 'rating', 'is_approved').first()
+    instance._old_review = old  # type: ignore[attr-defined]
+
+
+@receiver(post_save, sender=Review)
+def review_saved(sender, instance: Review, **kwargs):
+    # Only approved reviews count towards the product's rating aggregates
+    old = getattr(instance, '_old_review', None) or (None, None, False)
+    new = (instance.product_id, instance.rating, instance.is_approved)
+    if old == new or not (old[2] or new[2]):
+        return
+    if old[2]:
+        Product.adjust_reviews(old[0], old[1], -1)
+    if new[2]:
+        Product.adjust_reviews(new[0], new[1], 1)
+    bump_catalog_version_on_commit()
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(sender, instance: Review, **kwargs):
+    if instance.is_approved:
+        Product.adjust_reviews(instance.product_id, instance.rating, -1)
+        bump_catalog_version_on_commit()
+
+
+@receiver([post_save, post_delete], sender=Coupon)
+@receiver(m2m_changed, sender=Coupon.allowed_users.through)
+@receiver(m2m_changed, sender=Coupon.allowed_products.through)
+def coupon_changed(sender, **kwargs):
+    # Compiled rules are cached per coupon version (store.coupons); used_count
+    # is not part of them, so redemptions (queryset updates) leave them be
+    bump_coupon_version()
@@ -0,0 +1,169 @@
+"""
+Background Tasks - Deferred work off the request thread
+Jobs are dispatched once the surrounding transaction commits and run on a
+small in-process thread pool (or inline when TASKS_ALWAYS_EAGER is set).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import atexit
+import logging
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Lazily create the shared task thread pool
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'TASKS_MAX_WORKERS', 2),
+                    thread_name_prefix='store-task',
+                )
+    return _executor
+
+
+def run_task(func, *args, **kwargs):
+    """
+    Run a task, logging (never raising) failures and releasing the
+    thread's database connection afterwards
+    """
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        logger.exception(f"Background task {func.__name__} failed: {e}")
+    finally:
+        if not is_eager():
+            connections.close_all()
+
+
+def is_eager():
+    return getattr(settings, 'TASKS_ALWAYS_EAGER', False)
+
+
+def enqueue(func, *args, **kwargs):
+    """
+    Schedule func(*args, **kwargs) to run after the current transaction commits
+
+    Usage:
+        enqueue(fan_out_back_in_stock, product.id)
+    """
+    job = partial(run_task, func, *args, **kwargs)
+    if is_eager():
+        transaction.on_commit(job)
+    else:
+        transaction.on_commit(lambda: get_executor().submit(job))
+
+
+_buffers = weakref.WeakSet()
+
+
+class BufferedWriter:
+    """
+    Thread-safe in-process buffer that hands batches to the task pool
+
+    A batch goes out once it holds `batch_size` entries or its oldest entry
+    is `flush_seconds` old. Staleness is checked on every add and, when
+    BUFFER_AUTO_FLUSH is on, by a timer armed with the batch's first
+    entry, so a quiet process still writes on time; an atexit hook then
+    flushes whatever is left when the interpreter exits.
+
+    Subclasses name their settings and implement new_batch(), collect()
+    and write().
+    """
+    batch_size_setting = None
+    flush_seconds_setting = None
+    default_batch_size = 100
+    default_flush_seconds = 30
+
+    def __init__(self, batch_size=None, flush_seconds=None):
+        self.batch_size = batch_size or getattr(settings, self.batch_size_setting, self.default_batch_size)
+        self.flush_seconds = (
+            flush_seconds if flush_seconds is not None
+            else getattr(settings, self.flush_seconds_setting, self.default_flush_seconds)
+        )
+        self._batch = self.new_batch()
+        self._count = 0
+        self._oldest = None
+        self._timer = None
+        self._lock = threading.Lock()
+        _buffers.add(self)
+
+    def new_batch(self):
+        return []
+
+    def collect(self, batch, *entry):
+        """Fold one entry into the pending batch"""
+        raise NotImplementedError
+
+    def write(self, batch):
+        """Persist a batch; runs on the task pool"""
+        raise NotImplementedError
+
+    def __len__(self):
+        return self._count
+
+    def add(self, *entry):
+        with self._lock:
+            self.collect(self._batch, *entry)
+            self._count += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if self._count < self.batch_size and time.monotonic() - self._oldest < self.flush_seconds:
+                self._arm_timer()
+                return
+            batch = self._drain()
+        enqueue(self.write, batch)
+
+    def _arm_timer(self):
+        if self._timer is None and getattr(settings, 'BUFFER_AUTO_FLUSH', True):
+            self._timer = threading.Timer(self.flush_seconds, self._flush_stale)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_stale(self):
+        with self._lock:
+            self._timer = None
+            if self._oldest is None:
+                return
+            if time.monotonic() - self._oldest < self.flush_seconds:
+                self._arm_timer()
+                return
+            batch = self._drain()
+        enqueue(self.write, batch)
+
+    def _drain(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._batch, self._count, self._oldest = self._batch, self.new_batch(), 0, None
+        return batch
+
+    def flush(self):
+        """Write whatever is buffered, synchronously"""
+        with self._lock:
+            batch = self._drain()
+        self.write(batch)
+
+
+@atexit.register
+def flush_buffers():
+    """Write every BufferedWriter's pending entries (runs at interpreter exit)"""
+    if not getattr(settings, 'BUFFER_AUTO_FLUSH', True):
+        return
+    for buffer in list(_buffers):
+        if len(buffer):
+            run_task(buffer.flush)
+
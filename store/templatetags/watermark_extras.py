@@ -1,12 +1,13 @@
 from django import template
 from django.core.files.storage import default_storage
-import os
+
+from store.watermark_manifest import get_manifest
 
 register = template.Library()
 
 @register.filter
 def watermarked(field):
-    """Return URL of `_wm.png` version if it exists in storage, else original url."""
+    """Return URL of the watermarked version recorded in the manifest, else original url."""
     if not field:
         return ''
     name = getattr(field, 'name', None)
@@ -15,14 +16,47 @@ def watermarked(field):
             return field.url
         except Exception:
             return ''
-    base, _ext = os.path.splitext(name)
-    wm_name = f"{base}_wm.png"
-    try:
-        if default_storage.exists(wm_name):
-            return default_storage.url(wm_name)
-    except Exception:
-        pass
+    entry = get_manifest().get(name)
+    if entry:
+        try:
+            return default_storage.url(entry['name'])
+        except Exception:
+            pass
     try:
         return field.url
     except Exception:
         return ''
+
+
+def _variants(field):
+    name = getattr(field, 'name', None)
+    entry = get_manifest().get(name) if name else None
+    if not entry:
+        return []
+    return sorted(
+        ((int(width), variant) for width, variant in entry.get('variants', {}).items()),
+        key=lambda item: item[0],
+    )
+
+
+@register.filter
+def watermarked_thumb(field, width=300):
+    """URL of the smallest JPEG variant at least `width` px wide, else the full watermarked image."""
+    try:
+        width = int(width)
+    except (TypeError, ValueError):
+        width = 300
+    for variant_width, variant in _variants(field):
+        if variant_width >= width and 'jpeg' in variant:
+            return default_storage.url(variant['jpeg'])
+    return watermarked(field)
+
+
+@register.filter
+def watermarked_srcset(field, fmt='webp'):
+    """`srcset` value listing every variant in `fmt`, or '' when none exist."""
+    return ', '.join(
+        f"{default_storage.url(variant[fmt])} {variant_width}w"
+        for variant_width, variant in _variants(field)
+        if fmt in variant
+    )
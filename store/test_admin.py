@@ -0,0 +1,192 @@
+"""
+Tests for Admin Changelists
+"""
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from store.admin import EstimatedCountPaginator
+from store.models import AppliedCoupon, Brand, Category, Coupon, Order, OrderItem, Product, ProductView, StockLevel, StockReservation
+
+
+class ChangelistQueryCountTests(TestCase):
+    """A changelist page costs the same number of queries however many rows it shows"""
+
+    changelists = (
+        '/admin/store/order/',
+        '/admin/store/product/',
+        '/admin/store/orderitem/',
+        '/admin/store/productview/',
+        '/admin/store/stocklevel/',
+    )
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'admin123')
+        self.client.force_login(self.admin)
+        self.created = 0
+
+    def add_rows(self, count):
+        for _ in range(count):
+            self.created += 1
+            n = self.created
+            brand = Brand.objects.create(name=f'Brand {n}')
+            category = Category.objects.create(name=f'Category {n}')
+            product = Product.objects.create(
+                name=f'Product {n}', brand=brand, category=category, price=Decimal('100000'), stock_quantity=10,
+            )
+            StockLevel.objects.get_or_create(product=product, defaults={'quantity': 10})
+            order = Order.objects.create(full_name=f'Customer {n}', phone='0900000000', address='1 Test St')
+            OrderItem.objects.create(order=order, product=product, quantity=2, price=Decimal('100000'))
+            ProductView.objects.create(product=product, user=self.admin, session_key=f'session-{n}')
+
+    def query_count(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.add_rows(2)
+        few = {url: self.query_count(url) for url in self.changelists}
+        self.add_rows(8)
+        many = {url: self.query_count(url) for url in self.changelists}
+        self.assertEqual(few, many)
+
+    def test_order_changelist_shows_totals(self):
+        self.add_rows(1)
+        response = self.client.get('/admin/store/order/')
+        self.assertContains(response, '<td class="field-item_count">1</td>', html=True)
+        self.assertContains(response, '200000 ₫')
+
+
+class EstimatedCountPaginatorTests(TestCase):
+
+    def test_unfiltered_large_table_uses_estimate(self):
+        with mock.patch('store.admin.estimated_row_count', return_value=5000000), \
+                CaptureQueriesContext(connection) as queries:
+            paginator = EstimatedCountPaginator(ProductView.objects.order_by('-pk'), 100)
+            self.assertEqual(paginator.count, 5000000)
+        self.assertEqual(len(queries), 0)
+
+    def test_filtered_or_small_tables_are_counted(self):
+        product = Product.objects.create(
+            name='Counted', brand=Brand.objects.create(name='B'), category=Category.objects.create(name='C'),
+            price=Decimal('1000'),
+        )
+        ProductView.objects.create(product=product, session_key='s')
+        with mock.patch('store.admin.estimated_row_count', return_value=5000000):
+            filtered = EstimatedCountPaginator(ProductView.objects.filter(session_key='s'), 100)
+            self.assertEqual(filtered.count, 1)
+        with mock.patch('store.admin.estimated_row_count', return_value=10):
+            small = EstimatedCountPaginator(ProductView.objects.all(), 100)
+            self.assertEqual(small.count, 1)
+
+
+@override_settings(TASKS_ALWAYS_EAGER=True)
+class BulkOrderActionTests(TestCase):
+    """Order admin actions change a whole selection with set-based queries"""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'admin123')
+        self.client.force_login(self.admin)
+        customer = User.objects.create_user('customer', 'customer@example.com', 'pw')
+        self.product = Product.objects.create(
+            name='Son nước', brand=Brand.objects.create(name='B'), category=Category.objects.create(name='C'),
+            price=Decimal('100000'), stock_quantity=0,
+        )
+        self.stock, _ = StockLevel.objects.get_or_create(product=self.product, defaults={'quantity': 0})
+        self.orders = []
+        for n in range(5):
+            order = Order.objects.create(full_name=f'Customer {n}', phone='0900000000', address='1 Test St', user=customer)
+            OrderItem.objects.create(order=order, product=self.product, quantity=2, price=Decimal('100000'))
+            StockReservation.objects.create(
+                order=order, product=self.product, quantity=2, expires_at=order.created_at + timedelta(minutes=30),
+            )
+            self.orders.append(order)
+        mail.outbox = []
+
+    def run_action(self, action, orders):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/admin/store/order/', {
+                'action': action, '_selected_action': [order.pk for order in orders],
+            })
+
+    def test_mark_as_paid(self):
+        Order.objects.filter(pk=self.orders[0].pk).update(is_paid=True, payment_status=Order.PAYMENT_STATUS_PAID, paid_at=timezone.now())
+        with CaptureQueriesContext(connection) as few:
+            self.run_action('mark_as_paid', self.orders[:2])
+        mail.outbox = []
+        with CaptureQueriesContext(connection) as many:
+            response = self.run_action('mark_as_paid', self.orders)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(Order.objects.filter(is_paid=True, payment_status=Order.PAYMENT_STATUS_PAID, paid_at__isnull=False).count(), 5)
+        held = StockReservation.objects.filter(status=StockReservation.STATUS_HELD)
+        self.assertEqual(list(held.values_list('order_id', flat=True)), [self.orders[0].pk])
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertIn('đã được thanh toán', mail.outbox[0].subject)
+
+    def test_mark_as_paid_retakes_released_stock(self):
+        StockReservation.objects.filter(order__in=self.orders[:2]).update(
+            status=StockReservation.STATUS_RELEASED, released_at=timezone.now()
+        )
+        StockLevel.objects.filter(pk=self.stock.pk).update(quantity=3)
+
+        with self.assertLogs('store.inventory', 'ERROR') as logs:
+            self.run_action('mark_as_paid', self.orders[:2])
+
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 1)
+        statuses = dict(StockReservation.objects.filter(order__in=self.orders[:2]).values_list('order_id', 'status'))
+        self.assertEqual(statuses, {
+            self.orders[0].pk: StockReservation.STATUS_COMMITTED,
+            self.orders[1].pk: StockReservation.STATUS_RELEASED,
+        })
+        self.assertIn(f'Order {self.orders[1].pk} paid after its reservation expired', logs.output[0])
+
+    def test_cancel_releases_stock(self):
+        response = self.run_action('cancel_orders', self.orders[:3])
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Order.objects.filter(status=Order.STATUS_CANCELED).count(), 3)
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 6)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertIn("sang 'Canceled'", mail.outbox[0].body)
+
+        mail.outbox = []
+        self.run_action('cancel_orders', self.orders[:3])
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 6)
+        self.assertEqual(mail.outbox, [])
+
+    def test_cancel_gives_coupon_uses_back(self):
+        coupon = Coupon.objects.create(code='FLASH', discount_type='percentage', discount_value=10, max_uses=3)
+        Coupon.objects.filter(pk=coupon.pk).update(used_count=3)
+        for order in self.orders[:3]:
+            AppliedCoupon.objects.create(coupon=coupon, order=order, discount_amount=Decimal('20000'))
+
+        self.run_action('cancel_orders', self.orders[:2])
+
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used_count, 1)
+        self.assertEqual(list(AppliedCoupon.objects.values_list('order_id', flat=True)), [self.orders[2].pk])
+
+    def test_export_streams_csv(self):
+        response = self.run_action('export_orders_csv', self.orders)
+
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,full_name,phone,address,created_at,items')
+        self.assertEqual(len(lines), 6)
+        self.assertIn('Son nước x2 @100000.00', lines[1])
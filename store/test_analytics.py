@@ -1,7 +1,21 @@
+import gzip
+import json
+from pathlib import Path
+import shutil
+import tempfile
+
+from unittest import mock
+
 from django.test import TestCase, Client
 from django.urls import reverse
 from django.contrib.auth.models import User
-from store.models import Brand, Category, Product, Order, OrderItem, ProductView
+from store.models import (
+    Brand, Category, Product, Order, OrderItem, ProductView, ProductViewAnalytics, ProductViewDaily, SearchQuery,
+    SiteTrafficDaily,
+)
+from store import retention, visitors
+from store.hll import HyperLogLog
+from store.admin_dashboard import get_kpi_metrics
 from datetime import timedelta
 from django.utils import timezone
 
@@ -139,3 +153,165 @@ class AnalyticsTests(TestCase):
         data = response.json()
         self.assertIn('daily_sales', data)
         self.assertIn('top_products', data)
+
+
+class EventRetentionTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.admin = User.objects.create_user(username='admin', password='admin', is_staff=True)
+        brand = Brand.objects.create(name='TestBrand')
+        self.product = Product.objects.create(
+            name='Paint 1', brand=brand, price=100.00, unit_type=Product.UNIT_LIT, volume=5, is_active=True
+        )
+        self.other = Product.objects.create(
+            name='Paint 2', brand=brand, price=200.00, unit_type=Product.UNIT_LIT, volume=10, is_active=True
+        )
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir, ignore_errors=True)
+        self.today = timezone.localdate()
+    
+    def _view(self, product, days_ago, session):
+        view = ProductView.objects.create(product=product, session_key=session)
+        moment = timezone.now() - timedelta(days=days_ago)
+        ProductView.objects.filter(pk=view.pk).update(viewed_at=moment)
+    
+    def test_old_views_are_rolled_up_archived_and_deleted(self):
+        """Test raw rows past the window end up in daily aggregates and archive files"""
+        self._view(self.product, 60, 's1')
+        self._view(self.product, 60, 's1')
+        self._view(self.other, 60, 's2')
+        self._view(self.product, 45, 's3')
+        self._view(self.product, 2, 's4')
+        old_search = SearchQuery.objects.create(query='primer', result_count=1)
+        SearchQuery.objects.filter(pk=old_search.pk).update(created_at=timezone.now() - timedelta(days=60))
+        SearchQuery.objects.create(query='primer', result_count=1)
+        since = self.today - timedelta(days=90)
+        before = retention.view_counts(since)
+        
+        result = retention.apply_retention(days=30, directory=self.archive_dir, chunk_size=2)
+        
+        self.assertEqual(result['days_rolled_up'], 2)
+        self.assertEqual((result['views_archived'], result['searches_archived']), (4, 1))
+        self.assertEqual(ProductView.objects.count(), 1)
+        self.assertEqual(SearchQuery.objects.count(), 1)
+        self.assertEqual(SiteTrafficDaily.objects.get(date=self.today - timedelta(days=60)).unique_visitors, 2)
+        self.assertEqual(ProductViewDaily.objects.get(product=self.product, date=self.today - timedelta(days=60)).views, 2)
+        self.assertEqual(retention.view_counts(since), before)
+        
+        archived = []
+        for path in sorted(Path(self.archive_dir, 'productview').glob('*.jsonl.gz')):
+            with gzip.open(path, 'rt', encoding='utf-8') as handle:
+                archived.extend(json.loads(line) for line in handle)
+        self.assertEqual(len(archived), 4)
+        self.assertEqual({row['session_key'] for row in archived}, {'s1', 's2', 's3'})
+    
+    def test_rollup_counts_visitors_like_live_ranges(self):
+        """Test views without a session count by account or address, as visitor_key does"""
+        day = self.today - timedelta(days=60)
+        self._view(self.product, 60, 's1')
+        for user_id, ip in ((self.admin.pk, None), (None, '10.0.0.1'), (None, '10.0.0.2')):
+            view = ProductView.objects.create(product=self.product, user_id=user_id, ip_address=ip, session_key='')
+            ProductView.objects.filter(pk=view.pk).update(viewed_at=timezone.now() - timedelta(days=60))
+        
+        retention.apply_retention(days=30, directory=self.archive_dir)
+        
+        self.assertEqual(SiteTrafficDaily.objects.get(date=day).unique_visitors, 4)
+        self.assertEqual(ProductViewDaily.objects.get(product=self.product, date=day).unique_visitors, 4)
+    
+    def test_rerun_does_not_double_count(self):
+        """Test already rolled-up days are left alone by the next run"""
+        self._view(self.product, 40, 's1')
+        retention.apply_retention(days=30, directory=self.archive_dir)
+        self._view(self.product, 35, 's2')
+        
+        result = retention.apply_retention(days=30, directory=self.archive_dir)
+        
+        self.assertEqual(result['days_rolled_up'], 1)
+        self.assertEqual(retention.view_counts(self.today - timedelta(days=90)), {self.product.pk: 2})
+    
+    def test_dashboards_read_aggregates_for_archived_days(self):
+        """Test product performance includes archived views"""
+        self._view(self.product, 20, 's1')
+        self._view(self.product, 3, 's2')
+        retention.apply_retention(days=10, directory=self.archive_dir)
+        
+        self.client.login(username='admin', password='admin')
+        response = self.client.get(reverse('store:product_performance'), {'product_id': self.product.id, 'days': 30})
+        self.assertEqual(response.json()['performance'][0]['views'], 2)
+
+
+class HyperLogLogTests(TestCase):
+    def test_estimate_within_error_bounds(self):
+        """Test counts stay within three standard errors"""
+        sketch = HyperLogLog()
+        sketch.update(f'visitor-{i}' for i in range(20000))
+        sketch.update(f'visitor-{i}' for i in range(5000))  # repeats are free
+        self.assertLess(abs(sketch.count() - 20000), 20000 * 3 * sketch.relative_error)
+        self.assertEqual(HyperLogLog().update(range(40)).count(), 40)
+    
+    def test_merge_is_union(self):
+        """Test merged sketches count the union, not the sum"""
+        first = HyperLogLog().update(range(3000))
+        second = HyperLogLog().update(range(2000, 5000))
+        merged = HyperLogLog.from_bytes(first.to_bytes()).merge(HyperLogLog.from_bytes(second.to_bytes()))
+        self.assertLess(abs(merged.count() - 5000), 5000 * 3 * merged.relative_error)
+    
+    def test_sparse_and_dense_round_trip(self):
+        """Test small sketches serialize compactly and both forms decode"""
+        small = HyperLogLog().update(range(10))
+        large = HyperLogLog().update(range(10000))
+        self.assertLess(len(small.to_bytes()), 64)
+        self.assertEqual(HyperLogLog.from_bytes(small.to_bytes()).registers, small.registers)
+        self.assertEqual(HyperLogLog.from_bytes(large.to_bytes()).registers, large.registers)
+
+
+class VisitorSketchTests(TestCase):
+    def setUp(self):
+        brand = Brand.objects.create(name='TestBrand')
+        self.product = Product.objects.create(
+            name='Paint 1', brand=brand, price=100.00, unit_type=Product.UNIT_LIT, volume=5, is_active=True
+        )
+        self.other = Product.objects.create(
+            name='Paint 2', brand=brand, price=200.00, unit_type=Product.UNIT_LIT, volume=10, is_active=True
+        )
+        self.today = timezone.localdate()
+        self.buffer = visitors.VisitorSketchBuffer(batch_size=1000, flush_seconds=3600)
+        patcher = mock.patch('store.visitors.get_visitor_buffer', return_value=self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_views_feed_daily_and_lifetime_sketches(self):
+        """Test ingested views give mergeable per-day and per-product counts"""
+        yesterday = self.today - timedelta(days=1)
+        ProductView.objects.create(product=self.product, session_key='s1')
+        ProductView.objects.create(product=self.product, session_key='s1')
+        ProductView.objects.create(product=self.other, session_key='s2')
+        self.buffer.add(yesterday, self.product.pk, 'session:s1')
+        self.buffer.add(yesterday, self.product.pk, 'session:s3')
+        self.assertEqual(len(self.buffer), 5)
+        self.buffer.flush()
+        
+        self.assertEqual(visitors.unique_visitors(self.today, self.today), 2)
+        self.assertEqual(visitors.unique_visitors(yesterday), 3)
+        self.assertEqual(
+            visitors.product_unique_visitors([self.product.pk, self.other.pk], yesterday),
+            {self.product.pk: 2, self.other.pk: 1},
+        )
+        self.assertEqual(ProductViewAnalytics.objects.get(product=self.product).unique_views, 2)
+        
+        # a later batch merges into the same rows
+        ProductView.objects.create(product=self.product, session_key='s4')
+        self.buffer.flush()
+        self.assertEqual(visitors.unique_visitors(yesterday), 4)
+        self.assertEqual(ProductViewAnalytics.objects.get(product=self.product).unique_views, 3)
+    
+    def test_kpi_conversion_uses_sketches(self):
+        """Test KPI unique visitors come from the merged daily sketches"""
+        for session in ('s1', 's2', 's2', 's3', 's4'):
+            ProductView.objects.create(product=self.product, session_key=session)
+        self.buffer.flush()
+        Order.objects.create(full_name='User', phone='123', address='Addr', payment_status='completed')
+        
+        with self.assertNumQueries(1):
+            self.assertEqual(visitors.unique_visitors(self.today - timedelta(days=30)), 4)
+        self.assertEqual(get_kpi_metrics(self.today - timedelta(days=30))['conversion_rate'], 25.0)
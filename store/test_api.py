@@ -1,9 +1,13 @@
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth.models import User
-from rest_framework.test import APIClient
+from django.utils import timezone
+from rest_framework.test import APIClient, APIRequestFactory
 from rest_framework import status
-from store.models import Brand, Category, Product, Order, OrderItem
+from store.api_views import BrandViewSet, CategoryViewSet
+from store.models import Brand, Category, Product, Order, OrderItem, StockLevel
 
 
 class APITests(TestCase):
@@ -74,17 +78,6 @@ class APITests(TestCase):
             'product_id': self.product1.id,
             'quantity': 2
         }, format='json')
-        # Debug: write response for inspection
-        try:
-            with open(r'C:\Users\letan\Desktop\lephat1898\tmp_test_response_debug.txt', 'w', encoding='utf-8') as f:
-                f.write(f'STATUS: {response.status_code}\n')
-                try:
-                    f.write(f'CONTENT: {response.content.decode("utf-8")}\n')
-                except Exception:
-                    f.write('CONTENT: <binary>\n')
-        except Exception:
-            pass
-        
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(response.data['success'])
         self.assertEqual(response.data['quantity'], 2)
@@ -174,3 +167,231 @@ class APITests(TestCase):
         response = self.client.get(url)
         
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class APIQueryCountTests(TestCase):
+    """
+    Every list endpoint must run a fixed number of queries: the count is
+    measured with a few rows, more rows are added, and it must not change.
+    """
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        self.admin = User.objects.create_user(username='admin', password='admin', is_staff=True)
+        self.factory = APIRequestFactory()
+        self.serial = 0
+        self.add_rows(2)
+    
+    def add_rows(self, n):
+        for _ in range(n):
+            self.serial += 1
+            brand = Brand.objects.create(name=f'Brand {self.serial}')
+            category = Category.objects.create(name=f'Cat {self.serial}')
+            product = Product.objects.create(
+                name=f'Paint {self.serial}', brand=brand, category=category, price=10, is_active=True
+            )
+            if self.serial % 2:
+                StockLevel.objects.create(product=product, quantity=self.serial)
+            order = Order.objects.create(user=self.user, full_name='Buyer', phone='1', address='a')
+            OrderItem.objects.create(order=order, product=product, quantity=2, price=10)
+            OrderItem.objects.create(order=order, product=product, quantity=1, price=5)
+    
+    def count_queries(self, fetch):
+        with CaptureQueriesContext(connection) as ctx:
+            response = fetch()
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response
+    
+    def assertConstantQueries(self, fetch, expected):
+        small, _ = self.count_queries(fetch)
+        self.add_rows(10)
+        large, response = self.count_queries(fetch)
+        self.assertEqual((small, large), (expected, expected))
+        return response
+    
+    def test_product_list(self):
+        # COUNT + page
+        self.assertConstantQueries(lambda: self.client.get(reverse('store:api-product-list')), 2)
+    
+    def test_root_product_list(self):
+        self.assertConstantQueries(lambda: self.client.get(reverse('product-list')), 2)
+    
+    def test_order_list_for_user(self):
+        self.client.force_authenticate(self.user)
+        # COUNT + orders with annotated totals + prefetched items/products
+        response = self.assertConstantQueries(lambda: self.client.get(reverse('store:api-order-list')), 3)
+        self.assertEqual(response.data['results'][0]['total'], 25)
+    
+    def test_order_list_for_staff(self):
+        self.client.force_authenticate(self.admin)
+        self.assertConstantQueries(lambda: self.client.get(reverse('store:api-order-list')), 3)
+    
+    def test_category_and_brand_lists(self):
+        for viewset in (CategoryViewSet, BrandViewSet):
+            view = viewset.as_view({'get': 'list'})
+            self.assertConstantQueries(lambda: view(self.factory.get('/')), 2)
+    
+    def test_product_recommendations(self):
+        product = Product.objects.first()
+        url = reverse('store:api-product-recommendations', args=[product.pk])
+        # product lookup + three recommendation lists
+        self.assertConstantQueries(lambda: self.client.get(url), 4)
+
+
+class APIPaginationAndFieldsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='buyer', password='pass')
+        brand = Brand.objects.create(name='TestBrand')
+        category = Category.objects.create(name='TestCat')
+        self.products = [
+            Product.objects.create(name=f'Paint {i}', brand=brand, category=category, price=10 + i)
+            for i in range(7)
+        ]
+        # ties on created_at must still page deterministically by id
+        same_time = timezone.now()
+        Product.objects.filter(pk__in=[p.pk for p in self.products[2:5]]).update(created_at=same_time)
+    
+    def walk(self, url, params):
+        seen, pages = [], 0
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            seen.extend(row['id'] for row in response.data['results'])
+            pages += 1
+            if not response.data['next']:
+                return seen, pages
+            response = self.client.get(response.data['next'])
+    
+    def test_cursor_pagination_walks_catalog_once(self):
+        url = reverse('store:api-product-list')
+        seen, pages = self.walk(url, {'pagination': 'cursor', 'page_size': 3})
+        
+        expected = list(
+            Product.objects.order_by('-created_at', '-id').values_list('id', flat=True)
+        )
+        self.assertEqual(seen, expected)
+        self.assertEqual(pages, 3)
+    
+    def test_cursor_page_runs_no_count(self):
+        url = reverse('store:api-product-list')
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url, {'pagination': 'cursor'})
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertNotIn('COUNT', ctx.captured_queries[0]['sql'])
+    
+    def test_page_number_pagination_still_default(self):
+        response = self.client.get(reverse('store:api-product-list'))
+        self.assertEqual(response.data['count'], 7)
+    
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('store:api-product-list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+    
+    def test_sparse_fieldset(self):
+        response = self.client.get(reverse('store:api-product-list'), {'fields': 'id,price,bogus'})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'price'})
+        
+        detail = self.client.get(
+            reverse('store:api-product-detail', args=[self.products[0].pk]), {'fields': 'name'}
+        )
+        self.assertEqual(detail.data, {'name': 'Paint 0'})
+    
+    def test_order_cursor_and_fields(self):
+        for product in self.products[:3]:
+            order = Order.objects.create(user=self.user, full_name='Buyer', phone='1', address='a')
+            OrderItem.objects.create(order=order, product=product, quantity=1, price=product.price)
+        self.client.force_authenticate(self.user)
+        url = reverse('store:api-order-list')
+        
+        seen, _pages = self.walk(url, {'pagination': 'cursor', 'page_size': 2, 'fields': 'id,total'})
+        self.assertEqual(len(seen), 3)
+        
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, {'pagination': 'cursor', 'fields': 'id,payment_status'})
+        self.assertEqual(set(response.data['results'][0]), {'id', 'payment_status'})
+        # no items prefetch when items are not requested
+        self.assertFalse(any('store_orderitem' in q['sql'] for q in ctx.captured_queries))
+
+
+class CatalogDeltaSyncTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        settings_override = override_settings(CATALOG_SYNC_SETTLE_SECONDS=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.brand = Brand.objects.create(name='TestBrand')
+        self.category = Category.objects.create(name='TestCat')
+        self.products = [
+            Product.objects.create(
+                name=f'Paint {i}', brand=self.brand, category=self.category, price=10 + i, stock_quantity=3
+            )
+            for i in range(5)
+        ]
+        self.url = reverse('store:api-product-changes')
+    
+    def sync(self, cursor=None, **params):
+        if cursor:
+            params['since'] = cursor
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+    
+    def sync_all(self, cursor=None, **params):
+        changed, removed = [], []
+        while True:
+            page = self.sync(cursor, **params)
+            changed += page['changed']
+            removed += page['removed']
+            cursor = page['cursor']
+            if not page['has_more']:
+                return changed, removed, cursor
+    
+    def test_initial_sync_pages_through_catalog(self):
+        changed, removed, _cursor = self.sync_all(limit=2)
+        
+        self.assertEqual(sorted(row['id'] for row in changed), sorted(p.pk for p in self.products))
+        self.assertEqual(removed, [])
+        self.assertEqual(set(changed[0]), {
+            'id', 'sku', 'name', 'brand_id', 'category_id', 'price', 'sale_price',
+            'unit_type', 'volume', 'stock_quantity', 'in_stock', 'updated_at',
+        })
+    
+    def test_poll_returns_only_changes(self):
+        _changed, _removed, cursor = self.sync_all()
+        self.assertEqual(self.sync(cursor)['changed'], [])
+        
+        repriced = self.products[1]
+        repriced.price = 99
+        repriced.save()
+        StockLevel.objects.create(product=self.products[2], quantity=7)
+        self.products[3].is_active = False
+        self.products[3].save()
+        deleted_pk = self.products[4].pk
+        self.products[4].delete()
+        
+        changed, removed, _cursor = self.sync_all(cursor)
+        by_id = {row['id']: row for row in changed}
+        self.assertEqual(set(by_id), {repriced.pk, self.products[2].pk})
+        self.assertEqual(str(by_id[repriced.pk]['price']), '99.00')
+        self.assertEqual(by_id[self.products[2].pk]['stock_quantity'], 7)
+        self.assertEqual(sorted(removed), sorted([self.products[3].pk, deleted_pk]))
+    
+    def test_poll_query_count_is_constant(self):
+        _changed, _removed, cursor = self.sync_all()
+        for product in self.products:
+            product.save()
+        with self.assertNumQueries(2):
+            self.sync(cursor, limit=500)
+    
+    def test_recent_rows_wait_for_settle_window(self):
+        with override_settings(CATALOG_SYNC_SETTLE_SECONDS=60):
+            page = self.sync()
+        self.assertEqual(page['changed'], [])
+        self.assertEqual(page['cursor'], '')
+    
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'since': 'garbage'})
+        self.assertEqual(response.status_code, 400)
@@ -1,10 +1,14 @@
 """
 Tests for Caching Layer
 """
-from django.test import TestCase
+import time
+from unittest import mock
+
+from django.test import TestCase, Client, override_settings
 from django.core.cache import cache
 from django.contrib.auth.models import User
-from store.models import Product, Category, Brand, Order, OrderItem, Review
+from django.urls import reverse
+from store.models import Product, Category, Brand, Order, OrderItem, Review, ProductView
 from store.cache import (
     CacheManager,
     get_active_products,
@@ -258,3 +262,122 @@ class CacheWarmingTestCase(TestCase):
             CacheManager.warm_cache()
         except Exception as e:
             self.fail(f"Cache warming raised exception: {e}")
+
+
+class ConditionalGetTestCase(TestCase):
+    """Test ETag/Last-Modified revalidation of catalog pages and APIs"""
+    
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.brand = Brand.objects.create(name='Test Brand')
+        self.category = Category.objects.create(name='Test Category')
+        self.product = Product.objects.create(
+            name='Paint', brand=self.brand, category=self.category, price=Decimal('10.00'),
+        )
+    
+    def revalidate(self, url, **extra):
+        first = self.client.get(url, **extra)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('ETag', first)
+        self.assertIn('Last-Modified', first)
+        return first, self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'], **extra)
+    
+    def test_api_product_list_returns_304(self):
+        first, second = self.revalidate(reverse('store:api-product-list'))
+        
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.content, b'')
+        self.assertIn('public', first['Cache-Control'])
+        self.assertIn('max-age=60', first['Cache-Control'])
+    
+    def test_304_runs_no_catalog_queries(self):
+        first = self.client.get(reverse('store:api-product-list'))
+        with self.assertNumQueries(0):
+            second = self.client.get(reverse('store:api-product-list'), HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 304)
+    
+    def test_catalog_change_invalidates_etag(self):
+        url = reverse('store:api-product-list')
+        first = self.client.get(url)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = Decimal('12.00')
+            self.product.save()
+        
+        second = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+    
+    @override_settings(TASKS_ALWAYS_EAGER=True)
+    def test_stock_import_invalidates_etag(self):
+        from store.inventory import apply_stock_levels
+        url = reverse('store:api-product-detail', args=[self.product.pk])
+        first = self.client.get(url)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_stock_levels({self.product.pk: 5})
+        
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200)
+    
+    def test_api_detail_and_if_modified_since(self):
+        url = reverse('store:api-product-detail', args=[self.product.pk])
+        first, second = self.revalidate(url)
+        self.assertEqual(second.status_code, 304)
+        
+        third = self.client.get(url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(third.status_code, 304)
+    
+    def test_brand_and_category_endpoints(self):
+        from rest_framework.test import APIRequestFactory
+        from store.api_views import BrandViewSet, CategoryViewSet
+        factory = APIRequestFactory()
+        for viewset in (BrandViewSet, CategoryViewSet):
+            view = viewset.as_view({'get': 'list'})
+            first = view(factory.get('/'))
+            first.render()
+            second = view(factory.get('/', HTTP_IF_NONE_MATCH=first['ETag']))
+            self.assertEqual(second.status_code, 304)
+    
+    def test_product_list_page(self):
+        first, second = self.revalidate(reverse('store:product_list'))
+        
+        self.assertEqual(second.status_code, 304)
+        self.assertIn('private', first['Cache-Control'])
+    
+    def test_page_etag_varies_with_cart(self):
+        url = reverse('store:product_list')
+        first = self.client.get(url)
+        session = self.client.session
+        session['cart'] = {str(self.product.pk): 1}
+        session.save()
+        
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200)
+    
+    def test_product_detail_page_still_tracks_views(self):
+        url = reverse('store:product_detail', args=[self.product.pk])
+        first, second = self.revalidate(url)
+        
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(ProductView.objects.filter(product=self.product).count(), 2)
+    
+    def test_product_detail_refreshes_recommendations(self):
+        url = reverse('store:product_detail', args=[self.product.pk])
+        now = time.time()
+        with mock.patch('store.conditional.time.time', return_value=now):
+            first = self.client.get(url)
+        with mock.patch('store.conditional.time.time', return_value=now + 600):
+            second = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+    
+    def test_revalidated_search_is_logged(self):
+        url = reverse('store:product_list') + '?q=Paint'
+        with mock.patch('store.views.log_search') as log_search:
+            first, second = self.revalidate(url)
+        
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(log_search.call_count, 2)
+        self.assertEqual(log_search.call_args.args, ('Paint',))
+        self.assertEqual(log_search.call_args.kwargs['result_count'], 1)
@@ -1,9 +1,14 @@
+from decimal import Decimal
+
+from django.core.cache import cache
 from django.test import TestCase, Client
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta
-from store.models import Brand, Category, Product, Coupon, AppliedCoupon
+from store import coupons
+from store.cart import DatabaseCart
+from store.models import Brand, Cart, CartItem, Category, Product, Coupon, AppliedCoupon, Order
 
 
 class CouponTests(TestCase):
@@ -183,3 +188,111 @@ class CouponTests(TestCase):
         self.assertEqual(response.status_code, 200)
         data = response.json()
         self.assertTrue(data['success'])
+
+
+class CouponEngineTests(TestCase):
+    """Cached coupon rules, one-query eligibility and the atomic redemption counter"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='buyer', password='pw')
+        self.other = User.objects.create_user(username='other', password='pw')
+        brand = Brand.objects.create(name='TestBrand')
+        category = Category.objects.create(name='TestCat')
+        self.paint = Product.objects.create(
+            name='Paint', brand=brand, category=category, price=Decimal('100'), stock_quantity=5,
+        )
+        self.brush = Product.objects.create(
+            name='Brush', brand=brand, category=category, price=Decimal('50'), stock_quantity=5,
+        )
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.paint, quantity=2)
+        CartItem.objects.create(cart=cart, product=self.brush, quantity=1)
+        self.cart = DatabaseCart(self.user)
+        self.coupon = Coupon.objects.create(
+            code='FLASH', discount_type='percentage', discount_value=10, max_uses=1, max_uses_per_user=1,
+            start_date=timezone.now() - timedelta(days=1), end_date=timezone.now() + timedelta(days=1),
+        )
+
+    def test_check_reads_cached_rules(self):
+        quote = coupons.check('FLASH', self.user, self.cart)
+        self.assertEqual((quote.subtotal, quote.discount), (Decimal('250'), Decimal('25')))
+        # cart totals and the live usage counters; the rules come from the cache
+        with self.assertNumQueries(2):
+            coupons.check('FLASH', self.user, self.cart)
+
+    def test_edit_invalidates_cached_rules(self):
+        coupons.check('FLASH', self.user, self.cart)
+        self.coupon.end_date = timezone.now() - timedelta(hours=1)
+        self.coupon.save()
+        with self.assertRaisesMessage(coupons.CouponError, 'not valid or has expired'):
+            coupons.check('FLASH', self.user, self.cart)
+
+    def test_allowed_users_and_products(self):
+        self.coupon.allowed_products.add(self.brush)
+        quote = coupons.check('FLASH', self.user, self.cart)
+        self.assertEqual(quote.discount, Decimal('5'))
+
+        self.coupon.allowed_users.add(self.other)
+        with self.assertRaises(coupons.CouponError) as raised:
+            coupons.check('FLASH', self.user, self.cart)
+        self.assertEqual(raised.exception.status, 403)
+
+    def test_redeem_claims_the_last_use_once(self):
+        quote = coupons.check('FLASH', self.user, self.cart)
+        coupons.redeem(quote, self.user)
+        with self.assertRaisesMessage(coupons.CouponError, 'usage limit'):
+            coupons.redeem(quote, self.other)
+        with self.assertRaisesMessage(coupons.CouponError, 'usage limit'):
+            coupons.check('FLASH', self.other, self.cart)
+
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.used_count, 1)
+        self.assertEqual(AppliedCoupon.objects.filter(coupon=self.coupon).count(), 1)
+
+    def test_redeem_enforces_per_user_limit(self):
+        self.coupon.max_uses = None
+        self.coupon.save()
+        quote = coupons.check('FLASH', self.user, self.cart)
+        coupons.redeem(quote, self.user)
+        with self.assertRaisesMessage(coupons.CouponError, 'already used'):
+            coupons.redeem(quote, self.user)
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.used_count, 1)
+
+    def test_checkout_redeems_applied_coupon(self):
+        self.client.login(username='buyer', password='pw')
+        response = self.client.post(reverse('store:apply_coupon'), {'coupon_code': 'flash'})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post(reverse('store:checkout'), {
+            'name': 'Buyer', 'phone': '0900000000', 'address': '1 Test St', 'payment_method': 'cod',
+        })
+
+        self.assertRedirects(response, reverse('store:checkout_success'), fetch_redirect_response=False)
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.used_count, 1)
+        applied = AppliedCoupon.objects.get()
+        self.assertEqual(applied.discount_amount, Decimal('25'))
+        self.assertNotIn('applied_coupon', self.client.session)
+        # the order is charged the discounted total, and keeps it on recount
+        order = Order.objects.get()
+        self.assertEqual(applied.order, order)
+        self.assertEqual((order.discount_amount, order.order_total), (Decimal('25'), Decimal('225')))
+        Order.refresh_totals([order.pk])
+        order.refresh_from_db()
+        self.assertEqual(order.order_total, Decimal('225'))
+
+    def test_customer_cancel_gives_the_coupon_back(self):
+        self.client.login(username='buyer', password='pw')
+        self.client.post(reverse('store:apply_coupon'), {'coupon_code': 'flash'})
+        self.client.post(reverse('store:checkout'), {
+            'name': 'Buyer', 'phone': '0900000000', 'address': '1 Test St', 'payment_method': 'cod',
+        })
+        order = Order.objects.get()
+
+        self.client.post(reverse('store:order_cancel', args=[order.pk]))
+
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.used_count, 0)
+        self.assertFalse(AppliedCoupon.objects.exists())
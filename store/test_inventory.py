@@ -1,9 +1,28 @@
-from django.test import TestCase, Client
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib.auth.models import User
+from store.email_utils import send_back_in_stock_notifications
+from django.utils import timezone
+from store.inventory import (
+    InsufficientStock, apply_stock_levels, import_stock, parse_stock_file, release_reservations, reserve_stock
+)
+from store.payment_webhooks import handle_payment_failed, handle_payment_success
 from store.models import (
     Brand, Category, Product, StockLevel, 
-    StockAlert, PreOrder, BackInStockNotification
+    StockAlert, PreOrder, BackInStockNotification, EmailQueue,
+    Order, OrderItem, StockReservation
 )
 
 
@@ -124,3 +143,304 @@ class InventoryTests(TestCase):
         data = response.json()
         self.assertIn('alerts', data)
         self.assertEqual(len(data['alerts']), 1)
+
+    @override_settings(TASKS_ALWAYS_EAGER=True)
+    def test_restock_fans_out_back_in_stock_emails(self):
+        """Test restocking queues one email per subscriber and marks them notified"""
+        self.client.login(username='admin', password='admin')
+        StockLevel.objects.create(product=self.product, quantity=0)
+        for i in range(3):
+            BackInStockNotification.objects.create(product=self.product, email=f'user{i}@example.com')
+
+        url = reverse('store:update_stock', args=[self.product.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'quantity': 20})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(EmailQueue.objects.filter(context_data__product_id=self.product.id).count(), 3)
+        self.assertFalse(BackInStockNotification.objects.filter(product=self.product, notified=False).exists())
+
+    def test_back_in_stock_fan_out_chunks(self):
+        """Test fan-out renders once and bulk-inserts across chunks"""
+        for i in range(5):
+            BackInStockNotification.objects.create(product=self.product, email=f'user{i}@example.com')
+        BackInStockNotification.objects.create(
+            product=self.product, email='done@example.com', notified=True
+        )
+
+        with self.assertNumQueries(9):
+            # aggregate, template lookup, savepoint, subscriber read,
+            # 3 bulk inserts (chunks of 2), update, savepoint release
+            queued = send_back_in_stock_notifications(self.product, chunk_size=2)
+
+        self.assertEqual(queued, 5)
+        self.assertEqual(EmailQueue.objects.count(), 5)
+        self.assertEqual(len(set(EmailQueue.objects.values_list('html_content', flat=True))), 1)
+        self.assertEqual(send_back_in_stock_notifications(self.product), 0)
+
+
+class BulkStockImportTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='admin', password='admin', is_staff=True)
+        self.brand = Brand.objects.create(name='TestBrand')
+        self.products = [
+            Product.objects.create(
+                name=f'Paint {i}', brand=self.brand, price=100, sku=f'SKU-{i}'
+            )
+            for i in range(3)
+        ]
+
+    def test_parse_stock_file_formats(self):
+        """Test CSV and both JSON shapes parse to the same mapping"""
+        expected = {'SKU-0': 5, 'SKU-1': 0}
+        self.assertEqual(parse_stock_file('sku,quantity\nSKU-0,5\nSKU-1,0\n')[0], expected)
+        self.assertEqual(parse_stock_file('{"SKU-0": 5, "SKU-1": 0}')[0], expected)
+        self.assertEqual(
+            parse_stock_file('[{"sku": "SKU-0", "quantity": 5}, {"sku": "SKU-1", "quantity": "0"}]')[0],
+            expected,
+        )
+        quantities, invalid = parse_stock_file('sku,quantity\nSKU-0,-3\n,4\nSKU-2,abc\n')
+        self.assertEqual(quantities, {})
+        self.assertEqual(len(invalid), 3)
+        with self.assertRaises(ValueError):
+            parse_stock_file('code,qty\nSKU-0,1\n')
+
+    def test_import_reports_diff_and_reconciles_alerts(self):
+        """Test bulk import applies changes, opens/resolves alerts and reports unknown SKUs"""
+        StockLevel.objects.create(product=self.products[0], quantity=50)
+        StockLevel.objects.create(product=self.products[1], quantity=0)
+        StockAlert.objects.create(product=self.products[1], alert_type='out')
+
+        report = import_stock({'SKU-0': 50, 'SKU-1': 40, 'SKU-2': 3, 'NOPE': 1})
+
+        self.assertEqual(report['unchanged'], 1)
+        self.assertEqual(report['updated'], 1)
+        self.assertEqual(report['created'], 1)
+        self.assertEqual(report['unknown'], ['NOPE'])
+        self.assertEqual(report['alerts_created'], 1)
+        self.assertEqual(report['alerts_resolved'], 1)
+        self.assertCountEqual(report['restocked'], [self.products[1].id, self.products[2].id])
+        self.assertIn({'product_id': self.products[1].id, 'old': 0, 'new': 40, 'sku': 'SKU-1'}, report['changes'])
+
+        self.assertEqual(StockLevel.objects.get(product=self.products[1]).quantity, 40)
+        self.products[2].refresh_from_db()
+        self.assertEqual(self.products[2].stock_quantity, 3)
+        self.assertFalse(StockAlert.objects.filter(product=self.products[1], resolved=False).exists())
+        self.assertTrue(StockAlert.objects.filter(product=self.products[2], alert_type='low', resolved=False).exists())
+
+    def test_import_query_count_does_not_scale_with_rows(self):
+        """Test the import costs the same number of queries for 3 or 27 products"""
+        more = [
+            Product.objects.create(name=f'Bulk {i}', brand=self.brand, price=10, sku=f'BULK-{i}')
+            for i in range(27)
+        ]
+        with CaptureQueriesContext(connection) as small:
+            import_stock({p.sku: 5 for p in self.products})
+        with CaptureQueriesContext(connection) as large:
+            import_stock({p.sku: 7 for p in more})
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+    def test_each_chunk_is_stamped_when_it_runs(self):
+        """Test a long import stamps each chunk with its own time, not the start of the import"""
+        start = timezone.now()
+        ticks = (start + timedelta(minutes=n) for n in range(1000))
+        with mock.patch('django.utils.timezone.now', side_effect=lambda: next(ticks)):
+            apply_stock_levels({p.pk: 4 for p in self.products[:2]}, chunk_size=1)
+
+        first, second = (Product.objects.get(pk=p.pk).updated_at for p in self.products[:2])
+        self.assertGreater(second, first)
+
+    def test_dry_run_writes_nothing(self):
+        """Test dry-run reports the diff but leaves stock untouched"""
+        report = import_stock({'SKU-0': 9}, dry_run=True)
+        self.assertEqual(report['created'], 1)
+        self.assertFalse(StockLevel.objects.exists())
+
+    def test_bulk_import_endpoint(self):
+        """Test staff endpoint accepts a JSON body"""
+        url = reverse('store:bulk_import_stock')
+        payload = json.dumps({'SKU-0': 12, 'SKU-9': 1})
+
+        response = self.client.post(url, payload, content_type='application/json')
+        self.assertEqual(response.status_code, 302)  # staff only
+
+        self.client.login(username='admin', password='admin')
+        response = self.client.post(url, payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['created'], 1)
+        self.assertEqual(data['unknown'], ['SKU-9'])
+
+        response = self.client.post(url, 'not json', content_type='application/json', QUERY_STRING='format=json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_import_stock_command(self):
+        """Test management command reads a CSV file"""
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as f:
+            f.write('sku,quantity\nSKU-0,0\nSKU-1,30\n')
+        self.addCleanup(os.remove, path)
+
+        out = StringIO()
+        call_command('import_stock', path, '--show-changes', stdout=out, stderr=StringIO())
+        self.assertIn('2 created', out.getvalue())
+        self.assertIn('SKU-1: 0 -> 30', out.getvalue())
+        self.assertTrue(StockAlert.objects.filter(product=self.products[0], alert_type='out').exists())
+
+    def test_check_stock_command(self):
+        """Test check_stock reconciles alerts for every stock level"""
+        StockLevel.objects.create(product=self.products[0], quantity=0)
+        StockLevel.objects.create(product=self.products[1], quantity=5)
+        StockLevel.objects.create(product=self.products[2], quantity=500)
+        StockAlert.objects.create(product=self.products[2], alert_type='low')
+
+        out = StringIO()
+        call_command('check_stock', stdout=out)
+        self.assertIn('Created 2 stock alerts, resolved 1', out.getvalue())
+
+
+class StockReservationTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.brand = Brand.objects.create(name='TestBrand')
+        self.product = Product.objects.create(name='Bucket', brand=self.brand, price=100, stock_quantity=3)
+        self.stock = StockLevel.objects.create(product=self.product, quantity=3, low_stock_threshold=1)
+
+    def _checkout(self, qty, payment_method='cod'):
+        session = self.client.session
+        session['cart'] = {str(self.product.pk): qty}
+        session.save()
+        return self.client.post(reverse('store:checkout'), {
+            'name': 'Alice', 'phone': '0123', 'address': 'Addr', 'payment_method': payment_method
+        })
+
+    def _pending_order(self, qty):
+        order = Order.objects.create(full_name='Bob', phone='1', address='A', payment_method='stripe')
+        OrderItem.objects.create(order=order, product=self.product, quantity=qty, price=100)
+        reserve_stock(order, {self.product.pk: qty})
+        return order
+
+    def test_checkout_takes_stock(self):
+        """Test checkout decrements stock and commits the reservation"""
+        response = self._checkout(2)
+        self.assertRedirects(response, reverse('store:checkout_success'), fetch_redirect_response=False)
+
+        self.stock.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 1)
+        self.assertEqual(self.product.stock_quantity, 1)
+        reservation = StockReservation.objects.get()
+        self.assertEqual(reservation.status, StockReservation.STATUS_COMMITTED)
+        self.assertTrue(StockAlert.objects.filter(product=self.product, alert_type='low', resolved=False).exists())
+
+    def test_checkout_rejects_oversell(self):
+        """Test checkout fails cleanly when asking for more than is in stock"""
+        response = self._checkout(5)
+        self.assertRedirects(response, reverse('store:cart_view'), fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 3)
+        self.assertIn('cart', self.client.session)
+
+    def test_payment_failure_releases_hold(self):
+        """Test a failed payment gives held stock back"""
+        order = self._pending_order(2)
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 1)
+
+        handle_payment_failed({'object': {'metadata': {'order_id': str(order.id)}}})
+
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 3)
+        self.assertEqual(order.reservations.get().status, StockReservation.STATUS_RELEASED)
+        # Releasing again is a no-op
+        self.assertEqual(release_reservations(order.reservations.all()), 0)
+
+    def test_payment_success_commits_without_double_decrement(self):
+        """Test payment success commits the reservation instead of decrementing again"""
+        order = self._pending_order(2)
+        handle_payment_success({'object': {'id': 'pi_1', 'metadata': {'order_id': str(order.id)}}})
+
+        self.stock.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 1)
+        self.assertEqual(self.product.stock_quantity, 1)
+        self.assertEqual(order.reservations.get().status, StockReservation.STATUS_COMMITTED)
+
+    def test_sweeper_releases_expired_holds(self):
+        """Test the sweeper command returns expired holds and a late payment re-takes stock"""
+        order = self._pending_order(2)
+        fresh = self._pending_order(1)
+        order.reservations.update(expires_at=timezone.now() - timedelta(minutes=1))
+
+        out = StringIO()
+        call_command('release_expired_reservations', stdout=out)
+        self.assertIn('Released 1', out.getvalue())
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 2)
+        self.assertEqual(fresh.reservations.get().status, StockReservation.STATUS_HELD)
+
+        handle_payment_success({'object': {'id': 'pi_2', 'metadata': {'order_id': str(order.id)}}})
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 0)
+        self.assertEqual(order.reservations.get().status, StockReservation.STATUS_COMMITTED)
+
+    def test_untracked_products_reserve_product_stock(self):
+        """Test products without a StockLevel are held from Product.stock_quantity"""
+        other = Product.objects.create(name='Untracked', brand=self.brand, price=10, stock_quantity=5)
+        order = Order.objects.create(full_name='C', phone='1', address='A')
+        reservations = reserve_stock(order, {other.pk: 4})
+        self.assertEqual([(r.product_id, r.quantity) for r in reservations], [(other.pk, 4)])
+        other.refresh_from_db()
+        self.assertEqual(other.stock_quantity, 1)
+
+        second = Order.objects.create(full_name='D', phone='1', address='A')
+        with self.assertRaises(InsufficientStock):
+            reserve_stock(second, {other.pk: 2})
+
+        release_reservations(order.reservations.all())
+        other.refresh_from_db()
+        self.assertEqual(other.stock_quantity, 5)
+
+
+class StockReservationConcurrencyTests(TransactionTestCase):
+    def test_last_unit_is_sold_once(self):
+        """Test many threads racing for the last unit: exactly one wins"""
+        brand = Brand.objects.create(name='TestBrand')
+        product = Product.objects.create(name='Last Bucket', brand=brand, price=100, stock_quantity=1)
+        StockLevel.objects.create(product=product, quantity=1)
+
+        results = []
+        barrier = threading.Barrier(8)
+
+        def buy():
+            barrier.wait()
+            try:
+                for attempt in range(200):
+                    try:
+                        with transaction.atomic():
+                            order = Order.objects.create(full_name='Racer', phone='1', address='A')
+                            reserve_stock(order, {product.pk: 1})
+                        results.append('won')
+                        return
+                    except InsufficientStock:
+                        results.append('sold out')
+                        return
+                    except OperationalError:
+                        # SQLite serialises writers by failing fast; back off and retry
+                        time.sleep(0.005 * (attempt % 10 + 1))
+                results.append('gave up')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results.count('won'), 1)
+        self.assertEqual(results.count('sold out'), 7)
+        self.assertEqual(StockLevel.objects.get(product=product).quantity, 0)
+        self.assertEqual(StockReservation.objects.filter(product=product).count(), 1)
@@ -1,7 +1,15 @@
 """
 Tests for Monitoring and Logging
 """
-from django.test import TestCase, Client
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import TestCase, Client, RequestFactory, override_settings
 from django.contrib.auth.models import User
 from store.monitoring import (
     check_database,
@@ -11,6 +19,11 @@ from store.monitoring import (
     PerformanceMonitor,
     AlertSystem,
 )
+from store.response_logger_middleware import (
+    ResponseLoggerMiddleware,
+    get_capture_logger,
+    stop_capture_logger,
+)
 
 
 class HealthCheckTestCase(TestCase):
@@ -262,3 +275,81 @@ class SentryIntegrationTestCase(TestCase):
         except ImportError:
             # Sentry SDK not installed - this is fine
             pass
+
+
+class ResponseCaptureTestCase(TestCase):
+    """Test sampled response capture middleware"""
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.log_file = os.path.join(self.tmp, 'responses.log')
+        self.factory = RequestFactory()
+        self.addCleanup(stop_capture_logger)
+    
+    def middleware(self, response, **overrides):
+        options = {
+            'RESPONSE_CAPTURE_ENABLED': True,
+            'RESPONSE_CAPTURE_SAMPLE_RATE': 1.0,
+            'RESPONSE_CAPTURE_PATHS': [r'^/api/'],
+            'RESPONSE_CAPTURE_MAX_BYTES': 10,
+            'RESPONSE_CAPTURE_FILE': self.log_file,
+            **overrides,
+        }
+        settings_override = override_settings(**options)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        return ResponseLoggerMiddleware(lambda request: response)
+    
+    def captured(self):
+        stop_capture_logger()  # flush the queue
+        if not os.path.exists(self.log_file):
+            return []
+        with open(self.log_file, encoding='utf-8') as fh:
+            return [json.loads(line) for line in fh]
+    
+    def test_disabled_by_default(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            ResponseLoggerMiddleware(lambda request: HttpResponse())
+    
+    def test_matching_response_is_captured_and_truncated(self):
+        middleware = self.middleware(HttpResponse('0123456789abcdef'))
+        middleware(self.factory.get('/api/products/'))
+        
+        records = self.captured()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['path'], '/api/products/')
+        self.assertEqual(records[0]['body'], '0123456789')
+        self.assertEqual(records[0]['bytes'], 16)
+        self.assertTrue(records[0]['truncated'])
+    
+    def test_unmatched_path_is_skipped(self):
+        middleware = self.middleware(HttpResponse('page'))
+        middleware(self.factory.get('/products/'))
+        
+        self.assertEqual(self.captured(), [])
+    
+    def test_sampling(self):
+        middleware = self.middleware(HttpResponse('x'), RESPONSE_CAPTURE_SAMPLE_RATE=0.5)
+        with mock.patch('store.response_logger_middleware.random.random', side_effect=[0.2, 0.7, 0.4]):
+            for _ in range(3):
+                middleware(self.factory.get('/api/products/'))
+        
+        self.assertEqual(len(self.captured()), 2)
+    
+    def test_streaming_response_not_consumed(self):
+        response = StreamingHttpResponse(iter([b'a', b'b']))
+        middleware = self.middleware(response)
+        middleware(self.factory.get('/api/export/'))
+        
+        self.assertEqual(self.captured(), [])
+        self.assertEqual(b''.join(response.streaming_content), b'ab')
+    
+    def test_logger_writes_through_queue(self):
+        self.middleware(HttpResponse())
+        logger = get_capture_logger()
+        
+        self.assertFalse(logger.propagate)
+        self.assertEqual(
+            [type(h).__name__ for h in logger.handlers], ['_DroppingQueueHandler']
+        )
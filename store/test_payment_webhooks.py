@@ -2,16 +2,26 @@
 Tests for Payment Webhooks
 """
 import json
+from datetime import timedelta
 from decimal import Decimal
-from django.test import TestCase, Client
+from unittest import mock
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
 from django.contrib.auth.models import User
-from store.models import Order, OrderItem, Product, Brand, Category
+from django.core.cache import cache
+from django.utils import timezone
+from store.models import (
+    AppliedCoupon, Brand, Category, Coupon, Order, OrderItem, Product, StockLevel, StockReservation, WebhookEvent,
+)
 from store.payment_webhooks import (
     verify_stripe_signature,
     handle_payment_success,
     handle_payment_failed,
     handle_refund,
+    backoff_delay,
+    process_webhook_event,
+    process_due_webhook_events,
+    WEBHOOK_MAX_ATTEMPTS,
 )
 
 
@@ -229,3 +239,337 @@ class WebhookSecurityTestCase(TestCase):
         # Should handle gracefully
         with self.assertRaises(Exception):
             handle_payment_success(event_data)
+
+
+@override_settings(TASKS_ALWAYS_EAGER=True, STRIPE_WEBHOOK_SECRET='')
+class WebhookPipelineTestCase(TestCase):
+    """Test persisted, deduplicated webhook processing"""
+    
+    def setUp(self):
+        self.client = Client()
+        brand = Brand.objects.create(name="Test Brand")
+        category = Category.objects.create(name="Test Category")
+        self.product = Product.objects.create(
+            name="Test Product",
+            brand=brand,
+            category=category,
+            price=Decimal('100.00'),
+            stock_quantity=5,
+        )
+        self.order = Order.objects.create(
+            full_name="John Doe",
+            phone="1234567890",
+            address="123 Test St",
+            payment_method="stripe",
+            payment_status="completed",
+        )
+        OrderItem.objects.create(
+            order=self.order, product=self.product, quantity=2, price=Decimal('100.00'),
+        )
+    
+    def post_stripe(self, event_id, event_type='charge.refunded'):
+        payload = {
+            'id': event_id,
+            'type': event_type,
+            'data': {'object': {'metadata': {'order_id': str(self.order.id)}}},
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                reverse('store:webhook_stripe'),
+                data=json.dumps(payload),
+                content_type='application/json',
+            )
+    
+    def test_event_is_stored_and_processed(self):
+        response = self.post_stripe('evt_1')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'received')
+        event = WebhookEvent.objects.get(event_id='evt_1')
+        self.assertEqual(event.status, WebhookEvent.STATUS_PROCESSED)
+        self.assertEqual(event.attempts, 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'refunded')
+    
+    def test_duplicate_delivery_short_circuits(self):
+        self.post_stripe('evt_1')
+        
+        with mock.patch('store.payment_webhooks.handle_refund') as handler:
+            response = self.post_stripe('evt_1')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'duplicate')
+        handler.assert_not_called()
+        self.assertEqual(WebhookEvent.objects.filter(event_id='evt_1').count(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 7)
+    
+    def test_refund_replayed_under_new_event_id_is_not_double_applied(self):
+        self.post_stripe('evt_1')
+        self.post_stripe('evt_2')
+        
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock_quantity, 7)
+    
+    def test_missing_event_id_rejected(self):
+        response = self.client.post(
+            reverse('store:webhook_stripe'),
+            data=json.dumps({'type': 'charge.refunded'}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+    
+    def test_failure_schedules_retry_with_backoff(self):
+        with mock.patch('store.payment_webhooks.handle_refund', side_effect=RuntimeError('db down')):
+            response = self.post_stripe('evt_1')
+        
+        # The provider is still acknowledged; the event waits for a retry
+        self.assertEqual(response.status_code, 200)
+        event = WebhookEvent.objects.get(event_id='evt_1')
+        self.assertEqual(event.status, WebhookEvent.STATUS_PENDING)
+        self.assertEqual(event.attempts, 1)
+        self.assertEqual(event.last_error, 'db down')
+        self.assertGreater(event.next_attempt_at, timezone.now())
+        
+        # Not yet due
+        self.assertEqual(process_due_webhook_events(), (0, 0))
+        
+        WebhookEvent.objects.filter(pk=event.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(process_due_webhook_events(), (1, 0))
+        event.refresh_from_db()
+        self.assertEqual(event.status, WebhookEvent.STATUS_PROCESSED)
+        self.assertEqual(event.attempts, 2)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'refunded')
+    
+    def test_event_marked_failed_after_max_attempts(self):
+        event = WebhookEvent.objects.create(
+            provider=WebhookEvent.PROVIDER_STRIPE,
+            event_id='evt_1',
+            event_type='charge.refunded',
+            payload={'data': {'object': {'metadata': {'order_id': str(self.order.id)}}}},
+            attempts=WEBHOOK_MAX_ATTEMPTS - 1,
+        )
+        with mock.patch('store.payment_webhooks.handle_refund', side_effect=RuntimeError('boom')):
+            self.assertFalse(process_webhook_event(event.pk))
+        
+        event.refresh_from_db()
+        self.assertEqual(event.status, WebhookEvent.STATUS_FAILED)
+        self.assertIsNone(event.next_attempt_at)
+    
+    def test_processed_event_is_not_reclaimed(self):
+        self.post_stripe('evt_1')
+        event = WebhookEvent.objects.get(event_id='evt_1')
+        
+        self.assertFalse(process_webhook_event(event.pk))
+        event.refresh_from_db()
+        self.assertEqual(event.attempts, 1)
+    
+    def test_stale_processing_lease_is_reclaimed(self):
+        event = WebhookEvent.objects.create(
+            provider=WebhookEvent.PROVIDER_STRIPE,
+            event_id='evt_1',
+            event_type='charge.refunded',
+            payload={'data': {'object': {'metadata': {'order_id': str(self.order.id)}}}},
+            status=WebhookEvent.STATUS_PROCESSING,
+            attempts=1,
+            next_attempt_at=timezone.now() - timedelta(seconds=1),
+        )
+        self.assertTrue(process_webhook_event(event.pk))
+    
+    def test_backoff_delay_doubles(self):
+        self.assertEqual([backoff_delay(n, base_delay=10) for n in (1, 2, 3)], [10, 20, 40])
+
+
+@mock.patch.dict('os.environ', {'STRIPE_SECRET_KEY': 'sk_test'})
+class StripeCheckoutSessionTestCase(TestCase):
+    """Test Stripe Checkout session creation and success handling"""
+    
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        brand = Brand.objects.create(name="Test Brand")
+        category = Category.objects.create(name="Test Category")
+        self.products = [
+            Product.objects.create(
+                name=f"Paint {i}", brand=brand, category=category, price=Decimal('10.00') * (i + 1),
+                stock_quantity=5,
+            )
+            for i in range(3)
+        ]
+    
+    def make_session(self, session_id='cs_test_1'):
+        lines = [
+            {
+                'description': 'renamed in stripe dashboard',
+                'quantity': i + 1,
+                'price': {
+                    'unit_amount': int(p.price * 100),
+                    'product': {'metadata': {'product_id': str(p.pk)}},
+                },
+            }
+            for i, p in enumerate(self.products)
+        ]
+        return {
+            'id': session_id,
+            'customer_details': {'name': 'Jane Doe'},
+            'payment_intent': {'id': 'pi_test_1'},
+            'line_items': {'data': lines},
+        }
+    
+    def create_session(self, session_id='cs_test_1'):
+        session = self.client.session
+        session['cart'] = {str(p.pk): 1 for p in self.products}
+        session.save()
+        with mock.patch('stripe.checkout.Session.create') as create:
+            create.return_value = mock.Mock(id=session_id, url='https://checkout.stripe.test/x')
+            response = self.client.get(reverse('store:stripe_create'))
+        return response, create
+    
+    def test_create_session_holds_stock_for_a_pending_order(self):
+        for p in self.products:
+            StockLevel.objects.update_or_create(product=p, defaults={'quantity': 5})
+        response, create = self.create_session()
+        
+        self.assertEqual(response.status_code, 302)
+        order = Order.objects.get()
+        self.assertEqual(order.payment_method, 'stripe')
+        self.assertEqual(order.payment_status, 'pending')
+        self.assertEqual(order.payment_reference, 'cs_test_1')
+        self.assertEqual(
+            set(order.reservations.values_list('status', flat=True)), {StockReservation.STATUS_HELD}
+        )
+        self.assertEqual(set(StockLevel.objects.values_list('quantity', flat=True)), {4})
+        kwargs = create.call_args.kwargs
+        self.assertEqual(kwargs['client_reference_id'], str(order.pk))
+        self.assertEqual(
+            [item['price_data']['product_data']['metadata']['product_id'] for item in kwargs['line_items']],
+            sorted(str(p.pk) for p in self.products),
+        )
+        # the cart survives until Stripe confirms the payment
+        self.assertIn('cart', self.client.session)
+    
+    def test_success_commits_the_held_stock(self):
+        for p in self.products:
+            StockLevel.objects.update_or_create(product=p, defaults={'quantity': 5})
+        self.create_session()
+        order = Order.objects.get()
+        sess = dict(self.make_session(), client_reference_id=str(order.pk), payment_status='paid')
+        with mock.patch('stripe.checkout.Session.retrieve', return_value=sess):
+            self.client.get(reverse('store:stripe_success'), {'session_id': 'cs_test_1'})
+        
+        order.refresh_from_db()
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(order.payment_status, 'paid')
+        self.assertEqual(order.payment_reference, 'pi_test_1')
+        self.assertEqual(
+            set(order.reservations.values_list('status', flat=True)), {StockReservation.STATUS_COMMITTED}
+        )
+        self.assertNotIn('cart', self.client.session)
+    
+    def test_cancel_releases_the_held_stock(self):
+        for p in self.products:
+            StockLevel.objects.update_or_create(product=p, defaults={'quantity': 5})
+        create = self.create_session()[1]
+        cancel_url = create.call_args.kwargs['cancel_url']
+        with mock.patch('stripe.checkout.Session.expire') as expire:
+            response = self.client.get(reverse('store:stripe_cancel'), {'order': cancel_url.split('order=')[1]})
+        
+        self.assertRedirects(response, reverse('store:cart_view'), fetch_redirect_response=False)
+        order = Order.objects.get()
+        self.assertEqual(order.status, Order.STATUS_CANCELED)
+        self.assertEqual(set(StockLevel.objects.values_list('quantity', flat=True)), {5})
+        expire.assert_called_once_with('cs_test_1')
+    
+    def test_session_coupon_discounts_the_order_and_the_stripe_session(self):
+        coupon = Coupon.objects.create(code='FLASH', discount_type='percentage', discount_value=10, max_uses=5)
+        session = self.client.session
+        session['applied_coupon'] = {'code': 'FLASH'}
+        session.save()
+        with mock.patch('stripe.Coupon.create') as create_coupon:
+            create = self.create_session()[1]
+        
+        order = Order.objects.get()
+        self.assertEqual((order.discount_amount, order.order_total), (Decimal('6.00'), Decimal('54.00')))
+        self.assertEqual(AppliedCoupon.objects.get().order, order)
+        stripe_id = f'store-{coupon.pk}-600'
+        create_coupon.assert_called_once_with(id=stripe_id, amount_off=600, currency='usd', duration='once')
+        self.assertEqual(create.call_args.kwargs['discounts'], [{'coupon': stripe_id}])
+        
+        cancel_url = create.call_args.kwargs['cancel_url']
+        with mock.patch('stripe.checkout.Session.expire'):
+            self.client.get(reverse('store:stripe_cancel'), {'order': cancel_url.split('order=')[1]})
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used_count, 0)
+        self.assertFalse(AppliedCoupon.objects.exists())
+    
+    def test_stripe_coupon_is_created_once_per_amount(self):
+        coupon = Coupon.objects.create(code='FLASH', discount_type='fixed', discount_value=5)
+        for n in range(2):
+            session = self.client.session
+            session['applied_coupon'] = {'code': 'FLASH'}
+            session.save()
+            with mock.patch('stripe.Coupon.create') as create_coupon:
+                create = self.create_session(f'cs_test_{n}')[1]
+            self.assertEqual(create.call_args.kwargs['discounts'], [{'coupon': f'store-{coupon.pk}-500'}])
+        # the second checkout finds the Stripe coupon in the cache
+        create_coupon.assert_not_called()
+    
+    def test_unreachable_stripe_cancels_the_order(self):
+        for p in self.products:
+            StockLevel.objects.update_or_create(product=p, defaults={'quantity': 5})
+        session = self.client.session
+        session['cart'] = {str(p.pk): 1 for p in self.products}
+        session.save()
+        with mock.patch('stripe.checkout.Session.create', side_effect=Exception('down')):
+            self.client.get(reverse('store:stripe_create'))
+        
+        self.assertEqual(Order.objects.get().status, Order.STATUS_CANCELED)
+        self.assertEqual(set(StockLevel.objects.values_list('quantity', flat=True)), {5})
+    
+    def test_success_maps_lines_by_product_id(self):
+        with mock.patch('stripe.checkout.Session.retrieve', return_value=self.make_session()):
+            response = self.client.get(reverse('store:stripe_success'), {'session_id': 'cs_test_1'})
+        
+        self.assertEqual(response.status_code, 302)
+        order = Order.objects.get()
+        self.assertEqual(order.payment_reference, 'pi_test_1')
+        self.assertEqual(order.payment_status, 'paid')
+        self.assertEqual(
+            sorted(order.items.values_list('product_id', 'quantity')),
+            [(p.pk, i + 1) for i, p in enumerate(self.products)],
+        )
+    
+    def test_success_refresh_does_not_duplicate_order(self):
+        url = reverse('store:stripe_success')
+        with mock.patch('stripe.checkout.Session.retrieve', return_value=self.make_session()) as retrieve:
+            self.client.get(url, {'session_id': 'cs_test_1'})
+            self.client.get(url, {'session_id': 'cs_test_1'})
+        
+        self.assertEqual(Order.objects.count(), 1)
+        # the second request is answered from the cache, without calling Stripe
+        self.assertEqual(retrieve.call_count, 1)
+    
+    def test_concurrent_success_loads_the_order_that_won(self):
+        existing = Order.objects.create(
+            full_name='Jane Doe', phone='', address='', payment_method='stripe',
+            payment_status='paid', payment_reference='pi_test_1',
+        )
+        # the lookup misses because the other request has not committed yet
+        with mock.patch('stripe.checkout.Session.retrieve', return_value=self.make_session()), \
+                mock.patch('store.views._stripe_order_id', side_effect=[None, existing.pk]):
+            response = self.client.get(reverse('store:stripe_success'), {'session_id': 'cs_test_1'})
+        
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(Order.objects.values_list('pk', flat=True)), [existing.pk])
+        self.assertEqual(cache.get('stripe_session_order:cs_test_1'), existing.pk)
+    
+    def test_success_is_idempotent_after_cache_eviction(self):
+        url = reverse('store:stripe_success')
+        with mock.patch('stripe.checkout.Session.retrieve', return_value=self.make_session()):
+            self.client.get(url, {'session_id': 'cs_test_1'})
+            cache.clear()
+            self.client.get(url, {'session_id': 'cs_test_1'})
+        
+        self.assertEqual(Order.objects.count(), 1)
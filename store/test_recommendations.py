@@ -1,10 +1,14 @@
-from django.test import TestCase, Client
+from unittest import mock
+
+from django.test import TestCase, Client, override_settings
+from django.core.cache import cache
 from django.urls import reverse
 from django.contrib.auth.models import User
 from store.models import (
     Brand, Category, Product, ProductView, 
     ProductViewAnalytics, Order, OrderItem
 )
+from store import trending
 
 
 class RecommendationTests(TestCase):
@@ -108,3 +112,23 @@ class RecommendationTests(TestCase):
         
         self.assertEqual(analytics.total_views, 1)
         self.assertIsNotNone(analytics.last_viewed)
+
+    @override_settings(TASKS_ALWAYS_EAGER=True)
+    def test_trending_products_from_decayed_views(self):
+        """Test product views are buffered into trending scores"""
+        cache.clear()
+        self.addCleanup(cache.clear)
+        buffer = trending.TrendingBuffer(batch_size=3, flush_seconds=3600)
+        with mock.patch('store.trending.get_trending_buffer', return_value=buffer):
+            with self.captureOnCommitCallbacks(execute=True):
+                ProductView.objects.create(product=self.product2, user=self.user)
+                ProductView.objects.create(product=self.product3, user=self.user)
+                self.assertEqual(len(buffer), 2)
+                ProductView.objects.create(product=self.product2, user=self.user)
+        self.assertEqual(len(buffer), 0)
+        
+        self.product3.is_active = False
+        self.product3.save()
+        self.assertEqual(trending.trending_products(limit=5), [self.product2])
+        response = self.client.get(reverse('store:home'))
+        self.assertEqual(list(response.context['trending_products']), [self.product2])
@@ -1,3 +1,7 @@
+from decimal import Decimal
+from io import StringIO
+
+from django.core.management import call_command
 from django.test import TestCase, Client
 from django.urls import reverse
 from django.contrib.auth.models import User
@@ -188,3 +192,67 @@ class ReviewTests(TestCase):
         
         # Average should be 4.0
         self.assertContains(response, '4.0')
+
+
+class ReviewAggregateTests(TestCase):
+    """Product rating, count and histogram follow approvals, edits and deletes"""
+
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'user{n}', password='pw') for n in range(4)]
+        brand = Brand.objects.create(name='TestBrand')
+        category = Category.objects.create(name='TestCat')
+        self.product = Product.objects.create(name='Test Paint', brand=brand, category=category, price=100)
+        self.other = Product.objects.create(name='Other Paint', brand=brand, category=category, price=100)
+
+    def review(self, user, rating, approved=True, product=None):
+        return Review.objects.create(product=product or self.product, user=user, rating=rating, is_approved=approved)
+
+    def aggregates(self, product=None):
+        product = Product.objects.get(pk=(product or self.product).pk)
+        return product.review_count, product.rating_sum, str(product.rating), product.rating_histogram
+
+    def test_approve_edit_and_delete(self):
+        pending = self.review(self.users[0], 5, approved=False)
+        self.assertEqual(self.aggregates()[:3], (0, 0, '0.00'))
+
+        pending.is_approved = True
+        pending.save()
+        self.review(self.users[1], 4)
+        self.review(self.users[2], 4)
+        self.assertEqual(self.aggregates(), (3, 13, '4.33', [(5, 1), (4, 2), (3, 0), (2, 0), (1, 0)]))
+
+        pending.rating = 1
+        pending.save()
+        self.assertEqual(self.aggregates()[:3], (3, 9, '3.00'))
+
+        pending.product = self.other
+        pending.save()
+        self.assertEqual(self.aggregates()[:3], (2, 8, '4.00'))
+        self.assertEqual(self.aggregates(self.other)[:3], (1, 1, '1.00'))
+
+        pending.delete()
+        self.assertEqual(self.aggregates(self.other)[:3], (0, 0, '0.00'))
+
+    def test_rebuild_matches_incremental(self):
+        for user, rating in zip(self.users, (5, 4, 2, 1)):
+            self.review(user, rating)
+        self.review(self.users[0], 3, product=self.other, approved=False)
+        incremental = self.aggregates()
+        # bulk changes bypass the signals
+        Review.objects.filter(product=self.other).update(is_approved=True)
+        Product.objects.update(review_count=0, rating_sum=0, rating=0, rating_5=0)
+
+        call_command('rebuild_review_aggregates', stdout=StringIO())
+
+        self.assertEqual(self.aggregates(), incremental)
+        self.assertEqual(self.aggregates(self.other), (1, 3, '3.00', [(5, 0), (4, 0), (3, 1), (2, 0), (1, 0)]))
+
+    def test_review_list_reads_stored_aggregates(self):
+        self.review(self.users[0], 5)
+        self.review(self.users[1], 2)
+        url = reverse('store:review_list', args=[self.product.pk])
+        # product, reviews, review images: no aggregate query
+        with self.assertNumQueries(3):
+            response = self.client.get(url)
+        self.assertEqual(response.context['avg_rating'], Decimal('3.5'))
+        self.assertContains(response, '2 reviews')
@@ -1,11 +1,18 @@
 """
 Tests for Advanced Search Functionality
 """
-from django.test import TestCase, Client
+import time
+from unittest import mock
+
+from django.test import TestCase, Client, override_settings
 from django.contrib.auth.models import User
-from store.models import Product, Brand, Category, SearchQuery
+from django.core.cache import cache
+from store.models import Product, Brand, Category, SearchQuery, SearchQueryHourly, TrendingScore
 from store.search import ProductSearch, SearchAnalytics
+from store import search_telemetry, tasks, trending
+from datetime import timedelta
 from decimal import Decimal
+from django.utils import timezone
 
 
 class ProductSearchTest(TestCase):
@@ -272,3 +279,134 @@ class SearchViewsTest(TestCase):
         
         self.assertTrue(data['success'])
         self.assertIn('popular_searches', data)
+
+
+class SearchTelemetryTest(TestCase):
+    """Test buffered search logging and rollup-backed analytics"""
+    
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+    
+    @override_settings(TASKS_ALWAYS_EAGER=True)
+    def test_buffer_writes_in_batches(self):
+        """Test searches are held until the batch is full, then bulk written"""
+        buffer = search_telemetry.SearchLogBuffer(batch_size=3, flush_seconds=3600)
+        with self.captureOnCommitCallbacks(execute=True):
+            buffer.add(search_telemetry.make_event('Red Paint', result_count=2))
+            buffer.add(search_telemetry.make_event('  red   PAINT ', result_count=0))
+        self.assertFalse(SearchQuery.objects.exists())
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            buffer.add(search_telemetry.make_event('primer', result_count=1))
+        
+        self.assertEqual(SearchQuery.objects.count(), 3)
+        self.assertEqual(len(buffer), 0)
+        rollup = SearchQueryHourly.objects.get(query='red paint')
+        self.assertEqual((rollup.searches, rollup.zero_results, rollup.result_total), (2, 1, 2))
+    
+    @override_settings(BUFFER_AUTO_FLUSH=True)
+    def test_quiet_buffer_flushes_on_its_timer(self):
+        """Test a stale batch is handed off without waiting for another search"""
+        buffer = search_telemetry.SearchLogBuffer(batch_size=100, flush_seconds=0.05)
+        with mock.patch('store.tasks.enqueue') as enqueue:
+            buffer.add(search_telemetry.make_event('primer'))
+            for _ in range(100):
+                if enqueue.called:
+                    break
+                time.sleep(0.02)
+        
+        enqueue.assert_called_once()
+        write, batch = enqueue.call_args.args
+        self.assertEqual(write, buffer.write)
+        self.assertEqual([event.query for event in batch], ['primer'])
+        self.assertEqual(len(buffer), 0)
+    
+    @override_settings(BUFFER_AUTO_FLUSH=True, TASKS_ALWAYS_EAGER=True)
+    def test_exit_hook_flushes_buffers(self):
+        """Test the atexit hook writes what is still buffered"""
+        buffer = search_telemetry.SearchLogBuffer(batch_size=100, flush_seconds=3600)
+        buffer.add(search_telemetry.make_event('primer'))
+        with mock.patch('store.tasks._buffers', [buffer]):
+            tasks.flush_buffers()
+        
+        self.assertEqual(list(SearchQuery.objects.values_list('query', flat=True)), ['primer'])
+        self.assertEqual(len(buffer), 0)
+    
+    def test_search_view_does_not_write(self):
+        """Test the search endpoint only buffers the query"""
+        buffer = search_telemetry.SearchLogBuffer(batch_size=100, flush_seconds=3600)
+        with mock.patch('store.search_telemetry.get_search_buffer', return_value=buffer):
+            response = self.client.get('/search/?q=anything')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(buffer), 1)
+        self.assertFalse(SearchQuery.objects.exists())
+    
+    def test_popular_searches_come_from_cached_rollups(self):
+        """Test top-N is computed once per telemetry version"""
+        for query in ('Red Paint', 'red paint', 'primer'):
+            SearchQuery.objects.create(query=query, result_count=1)
+        
+        expected = [{'query': 'red paint', 'count': 2}, {'query': 'primer', 'count': 1}]
+        self.assertEqual(search_telemetry.popular_searches(limit=5), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(search_telemetry.popular_searches(limit=5), expected)
+        
+        ProductSearch().track_search('primer', result_count=1)
+        self.assertEqual(search_telemetry.popular_searches(limit=5)[0], {'query': 'primer', 'count': 2})
+
+
+@override_settings(TRENDING_HALF_LIFE_HOURS=24)
+class TrendingSearchesTest(TestCase):
+    """Test exponentially decayed trending scores"""
+    
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+    
+    def _record(self, query, hours_ago, count=1):
+        moment = timezone.now() - timedelta(hours=hours_ago)
+        trending.record_increments(trending.add_event({}, trending.KIND_SEARCH, query, moment, count))
+    
+    def test_recent_searches_outrank_older_volume(self):
+        """Test an event loses half its weight per half-life"""
+        self._record('old favourite', hours_ago=72, count=6)
+        self._record('new colour', hours_ago=0, count=1)
+        self._record('new colour', hours_ago=0, count=1)
+        
+        ranked = trending.trending_queries(limit=5)
+        self.assertEqual([row['query'] for row in ranked], ['new colour', 'old favourite'])
+        self.assertAlmostEqual(ranked[0]['score'], 2, places=1)
+        self.assertAlmostEqual(ranked[1]['score'], 0.75, places=1)
+        self.assertEqual(TrendingScore.objects.filter(key='new colour').count(), 1)
+    
+    def test_logged_searches_feed_trending(self):
+        """Test search batches update the decayed scores"""
+        search_telemetry.write_search_batch([
+            search_telemetry.make_event('Red Paint', result_count=2),
+            search_telemetry.make_event('red paint', result_count=2),
+            search_telemetry.make_event('primer', result_count=1),
+        ])
+        SearchQuery.objects.create(query='primer', result_count=1)
+        SearchQuery.objects.create(query='primer', result_count=1)
+        
+        ranked = ProductSearch().get_trending_searches(limit=5)
+        self.assertEqual([row['query'] for row in ranked], ['primer', 'red paint'])
+    
+    def test_top_k_is_cached(self):
+        """Test trending reads hit the database once per cache period"""
+        self._record('primer', hours_ago=1)
+        trending.trending_queries(limit=3)
+        search_telemetry.popular_searches(limit=3, days=7)
+        with self.assertNumQueries(0):
+            response = self.client.get('/search/popular/?limit=3')
+        self.assertEqual(response.json()['trending_searches'][0]['query'], 'primer')
+    
+    def test_prune_drops_faded_keys(self):
+        """Test keys whose decayed count fell below the floor are removed"""
+        self._record('last season', hours_ago=24 * 30)
+        self._record('primer', hours_ago=1)
+        
+        self.assertEqual(trending.prune(min_count=0.01), 1)
+        self.assertEqual(list(TrendingScore.objects.values_list('key', flat=True)), ['primer'])
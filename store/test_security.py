@@ -1,11 +1,17 @@
 """
 Tests for Security Module
 """
-from django.test import TestCase, RequestFactory
+from unittest import mock
+
+from django.test import TestCase, RequestFactory, override_settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.cache import cache
+from django.urls import reverse
+from store.models import LoginAttempt, SuspiciousActivity
 from store.security import (
+    AuditLogBuffer,
+    scan_for_threats,
     TwoFactorAuth,
     RateLimiter,
     LoginProtection,
@@ -95,13 +101,17 @@ class RateLimiterTestCase(TestCase):
         self.assertEqual(ip, '192.168.1.1')
     
     def test_get_client_ip_with_proxy(self):
-        """Test client IP extraction with X-Forwarded-For"""
+        """Test X-Forwarded-For is read only behind configured proxies"""
         request = self.factory.get('/')
-        request.META['HTTP_X_FORWARDED_FOR'] = '203.0.113.1, 192.168.1.1'
-        request.META['REMOTE_ADDR'] = '192.168.1.1'
+        request.META['HTTP_X_FORWARDED_FOR'] = '198.51.100.7, 203.0.113.1'
+        request.META['REMOTE_ADDR'] = '10.0.0.2'
         
-        ip = RateLimiter.get_client_ip(request)
-        self.assertEqual(ip, '203.0.113.1')
+        self.assertEqual(RateLimiter.get_client_ip(request), '10.0.0.2')
+        with override_settings(TRUSTED_PROXY_COUNT=1):
+            # the client-supplied first entry is ignored
+            self.assertEqual(RateLimiter.get_client_ip(request), '203.0.113.1')
+            request.META['HTTP_X_FORWARDED_FOR'] = '198.51.100.7, not-an-ip'
+            self.assertEqual(RateLimiter.get_client_ip(request), '10.0.0.2')
 
 
 class LoginProtectionTestCase(TestCase):
@@ -139,6 +149,91 @@ class LoginProtectionTestCase(TestCase):
         
         remaining = LoginProtection.get_remaining_attempts(username)
         self.assertEqual(remaining, LoginProtection.LOCKOUT_THRESHOLD)
+    
+    def test_lockouts_double_with_each_strike(self):
+        """Test repeat lockouts grow exponentially"""
+        username = 'testuser'
+        with mock.patch('store.security.time.time', return_value=1000.0):
+            for _ in range(LoginProtection.LOCKOUT_THRESHOLD):
+                LoginProtection.record_failed_attempt(username)
+            first = LoginProtection.check(username)
+        self.assertEqual(first.retry_after, LoginProtection.LOCKOUT_DURATION)
+        
+        with mock.patch('store.security.time.time', return_value=1000.0 + LoginProtection.LOCKOUT_DURATION):
+            self.assertFalse(LoginProtection.is_locked_out(username))
+            for _ in range(LoginProtection.LOCKOUT_THRESHOLD):
+                LoginProtection.record_failed_attempt(username)
+            second = LoginProtection.check(username)
+        self.assertEqual(second.retry_after, LoginProtection.LOCKOUT_DURATION * 2)
+    
+    def test_ip_lockout_spans_usernames(self):
+        """Test credential stuffing from one IP locks the IP, not each user"""
+        for i in range(LoginProtection.IP_LOCKOUT_THRESHOLD):
+            LoginProtection.record_failed_attempt(f'user{i}', '203.0.113.9')
+        
+        self.assertTrue(LoginProtection.is_locked_out('someone-else', '203.0.113.9'))
+        self.assertFalse(LoginProtection.is_locked_out('someone-else', '198.51.100.1'))
+    
+    def test_check_is_one_round_trip(self):
+        """Test the combined check reads every key with one get_many"""
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+            status = LoginProtection.check('testuser', '203.0.113.9')
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(status, (False, 0, LoginProtection.LOCKOUT_THRESHOLD))
+
+
+class LoginViewProtectionTestCase(TestCase):
+    """Test the login view uses the lockout engine and batched audit rows"""
+    
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        User.objects.create_user(username='victim', password='right-password')
+        self.audit = AuditLogBuffer(LoginAttempt, batch_size=100, flush_seconds=3600)
+        patcher = mock.patch('store.security.get_audit_buffer', return_value=self.audit)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_locked_out_after_threshold(self):
+        """Test the right password is refused while locked out"""
+        url = reverse('store:login')
+        for _ in range(LoginProtection.LOCKOUT_THRESHOLD - 1):
+            response = self.client.post(url, {'username': 'victim', 'password': 'wrong'})
+            self.assertEqual(response.status_code, 200)
+        response = self.client.post(url, {'username': 'Victim', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 429)
+        
+        response = self.client.post(url, {'username': 'victim', 'password': 'right-password'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(int(response['Retry-After']), LoginProtection.LOCKOUT_DURATION)
+        self.assertNotIn('_auth_user_id', self.client.session)
+    
+    def test_every_login_path_shares_the_lockout(self):
+        """Test failures on the store, root and admin logins lock all of them"""
+        User.objects.create_superuser(username='boss', password='right-password')
+        urls = [reverse('store:login'), reverse('login'), reverse('admin:login')]
+        for n in range(LoginProtection.LOCKOUT_THRESHOLD):
+            self.client.post(urls[n % len(urls)], {'username': 'boss', 'password': 'wrong'})
+        self.assertTrue(LoginProtection.is_locked_out('boss'))
+        
+        for url in urls[1:]:
+            self.client.post(url, {'username': 'boss', 'password': 'right-password'})
+            self.assertNotIn('_auth_user_id', self.client.session)
+    
+    def test_audit_rows_are_batched(self):
+        """Test attempts are queued and written in one bulk insert"""
+        url = reverse('store:login')
+        self.client.post(url, {'username': 'victim', 'password': 'wrong'})
+        self.client.post(url, {'username': 'victim', 'password': 'right-password'})
+        self.assertEqual(len(self.audit), 2)
+        self.assertFalse(LoginAttempt.objects.exists())
+        
+        with self.assertNumQueries(1):
+            self.audit.flush()
+        self.assertEqual(
+            list(LoginAttempt.objects.order_by('timestamp').values_list('username', 'success')),
+            [('victim', False), ('victim', True)],
+        )
 
 
 class InputValidatorTestCase(TestCase):
@@ -249,6 +344,9 @@ class SuspiciousActivityTestCase(TestCase):
             "' OR 1=1--",
             "admin'; DROP TABLE users--",
             "UNION SELECT * FROM passwords",
+            "x' OR 'a'='a",
+            "admin'/*",
+            "1; DROP TABLE users",
         ]
         
         for injection in sql_injections:
@@ -261,6 +359,12 @@ class SuspiciousActivityTestCase(TestCase):
             "John Doe",
             "user@example.com",
             "1234567890",
+            "drop cloth",
+            "Please update my order",
+            "giao truoc 5 gio -- goi",
+            "Select a color from the chart, or delete it",
+            "Good paint; update: it peeled after a week",
+            "the 'update' button",
         ]
         
         for safe_input in safe_inputs:
@@ -290,3 +394,63 @@ class SuspiciousActivityTestCase(TestCase):
         for safe_input in safe_inputs:
             result = SuspiciousActivityDetector.detect_xss(safe_input)
             self.assertFalse(result, f"Safe input triggered XSS: {safe_input}")
+
+
+
+class ThreatScanTestCase(TestCase):
+    """Test the combined threat scanner and its middleware"""
+    
+    def setUp(self):
+        self.audit = AuditLogBuffer(SuspiciousActivity, batch_size=100, flush_seconds=3600)
+        logins = AuditLogBuffer(LoginAttempt, batch_size=100, flush_seconds=3600)
+        patcher = mock.patch(
+            'store.security.get_audit_buffer',
+            side_effect=lambda model: self.audit if model is SuspiciousActivity else logins,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_scan_reports_kind_and_fragment(self):
+        """Test one scan finds either kind of probe"""
+        self.assertEqual(scan_for_threats("1' OR 1=1"), ('sql_injection', 'OR 1=1'))
+        self.assertEqual(scan_for_threats('<a href="JavaScript:run()">'), ('xss', 'JavaScript:'))
+        self.assertIsNone(scan_for_threats('son chong tham mau xanh, sort=price_asc'))
+    
+    def test_clean_text_skips_the_pattern(self):
+        """Test everyday words containing 'or' are rejected by the keyword prefilter"""
+        with mock.patch('store.security._THREATS') as threats:
+            self.assertIsNone(scan_for_threats('color for the front door, sort by price, order 2'))
+        threats.search.assert_not_called()
+    
+    def test_scan_length_is_capped(self):
+        """Test text past the limit is not scanned"""
+        text = 'a' * 100 + '<script>alert(1)</script>'
+        self.assertIsNone(scan_for_threats(text, limit=100))
+        self.assertEqual(scan_for_threats(text, limit=200)[0], 'xss')
+    
+    def test_middleware_records_hits_through_buffer(self):
+        """Test suspicious query strings are queued, not written per request"""
+        self.client.get('/search/', {'q': "paint' UNION SELECT password FROM auth_user"})
+        self.client.get('/search/', {'q': 'son chong tham'})
+        
+        self.assertEqual(len(self.audit), 1)
+        self.assertFalse(SuspiciousActivity.objects.exists())
+        self.audit.flush()
+        activity = SuspiciousActivity.objects.get()
+        self.assertEqual((activity.activity_type, activity.ip_address), ('sql_injection', '127.0.0.1'))
+        self.assertIn('/search/', activity.description)
+    
+    def test_middleware_ignores_everyday_text(self):
+        """Test ordinary product, search and review text records nothing"""
+        self.client.get('/search/', {'q': 'drop cloth', 'sort': 'price_asc'})
+        self.client.get('/search/', {'q': 'select exterior paint for doors or windows'})
+        self.client.post('/store/cart/', {
+            'name': 'Drop Cloth 2x3m', 'description': 'Please update my order -- deliver before 5pm',
+            'note': 'giao truoc 5 gio -- goi', 'review': "It's the best primer; don't skip it",
+        })
+        self.assertEqual(len(self.audit), 0)
+    
+    def test_middleware_skips_password_fields(self):
+        """Test password fields are neither scanned nor recorded"""
+        self.client.post('/login/', {'username': 'someone', 'password': "x' OR 1=1--"})
+        self.assertEqual(len(self.audit), 0)
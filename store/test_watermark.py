@@ -0,0 +1,220 @@
+import shutil
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from PIL import Image
+
+from store.cache import get_catalog_version
+from store.image_pipeline import process_image, run_pipeline
+from store.models import Brand, Category, Product
+from store.templatetags.watermark_extras import (
+    watermarked, watermarked_srcset, watermarked_thumb
+)
+from store import watermark
+from store.watermark import watermark_product_image
+from store.watermark_manifest import WatermarkManifest, get_manifest, reset_manifest
+
+
+def png_bytes(size=(120, 80), color=(200, 30, 30, 255)):
+    buf = BytesIO()
+    Image.new('RGBA', size, color).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+class MediaTestMixin:
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_manifest()
+        self.addCleanup(reset_manifest)
+
+        brand = Brand.objects.create(name='TestBrand')
+        category = Category.objects.create(name='TestCat')
+        self.product = Product.objects.create(
+            name='Test Paint', brand=brand, category=category, price=100,
+        )
+        self.product.image.save('sample.png', ContentFile(png_bytes()), save=True)
+
+
+class WatermarkManifestTests(MediaTestMixin, TestCase):
+    def test_watermark_records_manifest_entry(self):
+        saved = watermark_product_image(self.product)
+
+        entry = get_manifest().get(self.product.image.name)
+        self.assertEqual(entry['name'], saved)
+        self.assertEqual((entry['width'], entry['height']), (120, 80))
+        self.assertEqual(len(entry['sha1']), 40)
+        # persisted for other processes
+        reset_manifest()
+        self.assertEqual(get_manifest().get(self.product.image.name)['name'], saved)
+
+    def test_manifest_update_bumps_catalog_version(self):
+        before = get_catalog_version()
+        with mock.patch('store.cache.time.time', return_value=before + 10), \
+                self.captureOnCommitCallbacks(execute=True):
+            watermark_product_image(self.product)
+
+        self.assertNotEqual(get_catalog_version(), before)
+
+    def test_writers_in_other_processes_are_merged(self):
+        web, worker = WatermarkManifest(), WatermarkManifest()
+        web.entries()
+        worker.entries()
+
+        web.record('a.png', 'a_wm.png', 1, 1, 'x' * 40)
+        worker.record('b.png', 'b_wm.png', 1, 1, 'y' * 40)
+
+        self.assertEqual(sorted(WatermarkManifest().entries()), ['a.png', 'b.png'])
+
+    def test_unchanged_entry_keeps_catalog_version(self):
+        manifest = get_manifest()
+        with mock.patch('store.watermark_manifest.bump_catalog_version_on_commit') as bump:
+            manifest.record('a.png', 'a_wm.png', 1, 1, 'x' * 40)
+            manifest.record('a.png', 'a_wm.png', 1, 1, 'x' * 40)
+            manifest.discard('missing.png')
+        bump.assert_called_once_with()
+
+    def test_rewatermarking_keeps_stable_name(self):
+        first = watermark_product_image(self.product)
+        second = watermark_product_image(self.product)
+
+        self.assertEqual(first, second)
+        self.assertTrue(first.endswith('_wm.png'))
+
+    def test_filter_resolves_without_storage_io(self):
+        saved = watermark_product_image(self.product)
+        get_manifest().entries()
+
+        with mock.patch.object(default_storage, 'exists') as exists, \
+                mock.patch.object(default_storage, 'open') as open_:
+            for _ in range(12):
+                url = watermarked(self.product.image)
+
+        exists.assert_not_called()
+        open_.assert_not_called()
+        self.assertEqual(url, default_storage.url(saved))
+
+    def test_filter_falls_back_to_original(self):
+        self.assertEqual(watermarked(self.product.image), self.product.image.url)
+
+    def test_build_manifest_command_picks_up_existing_files(self):
+        base = self.product.image.name.rsplit('.', 1)[0]
+        default_storage.save(f'{base}_wm.png', ContentFile(png_bytes((60, 40))))
+
+        out = StringIO()
+        call_command('build_watermark_manifest', stdout=out)
+
+        self.assertIn('Recorded 1 watermarked images', out.getvalue())
+        entry = get_manifest().get(self.product.image.name)
+        self.assertEqual((entry['width'], entry['height']), (60, 40))
+
+
+class ImagePipelineTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.product.image.save('large.png', ContentFile(png_bytes((1000, 800))), save=True)
+        self.name = self.product.image.name
+
+    def test_pipeline_writes_variants_and_manifest(self):
+        report = run_pipeline(workers=1, widths=[300, 600, 1200])
+
+        self.assertEqual(report, {'processed': 1, 'skipped': 0, 'errors': []})
+        entry = get_manifest().get(self.name)
+        # 1200 would upscale a 1000px source, so it is skipped
+        self.assertEqual(sorted(entry['variants']), ['300', '600'])
+        thumb = entry['variants']['300']
+        self.assertEqual(thumb['height'], 240)
+        for fmt, pil_format in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+            with default_storage.open(thumb[fmt], 'rb') as fh:
+                image = Image.open(fh)
+                self.assertEqual((image.format, image.size), (pil_format, (300, 240)))
+        self.assertTrue(default_storage.exists(entry['name']))
+
+    def test_unchanged_images_are_skipped(self):
+        run_pipeline(workers=1, widths=[300])
+        self.assertEqual(run_pipeline(workers=1, widths=[300])['skipped'], 1)
+        # a different variant spec reprocesses
+        self.assertEqual(run_pipeline(workers=1, widths=[300, 600])['processed'], 1)
+
+    def test_changed_content_is_reprocessed(self):
+        run_pipeline(workers=1, widths=[300])
+        with open(self.product.image.path, 'wb') as fh:
+            fh.write(png_bytes((1000, 800), color=(0, 0, 255, 255)))
+
+        self.assertEqual(run_pipeline(workers=1, widths=[300])['processed'], 1)
+
+    def test_records_made_during_a_run_survive(self):
+        def save_during_run(job):
+            WatermarkManifest().record('other.png', 'other_wm.png', 1, 1, 'x' * 40)
+            return process_image(job)
+
+        with mock.patch('store.image_pipeline.process_image', side_effect=save_during_run):
+            run_pipeline(workers=1, widths=[300])
+
+        reset_manifest()
+        self.assertEqual(sorted(get_manifest().entries()), sorted([self.name, 'other.png']))
+
+    def test_process_pool(self):
+        report = run_pipeline(workers=2, widths=[300])
+
+        self.assertEqual(report['processed'], 1)
+        self.assertIn('300', get_manifest().get(self.name)['variants'])
+
+    def test_thumbnail_filters(self):
+        run_pipeline(workers=1, widths=[300, 600])
+        variants = get_manifest().get(self.name)['variants']
+
+        self.assertEqual(watermarked_thumb(self.product.image, 300), default_storage.url(variants['300']['jpeg']))
+        self.assertEqual(watermarked_thumb(self.product.image, 400), default_storage.url(variants['600']['jpeg']))
+        self.assertEqual(
+            watermarked_srcset(self.product.image, 'webp'),
+            f"{default_storage.url(variants['300']['webp'])} 300w, {default_storage.url(variants['600']['webp'])} 600w",
+        )
+
+    def test_command(self):
+        out = StringIO()
+        call_command('process_product_images', '--workers', '1', '--widths', '300', stdout=out)
+
+        self.assertIn('Processed 1 images, skipped 0 unchanged, 0 failed', out.getvalue())
+
+
+class WatermarkResourceCacheTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.logo = f'{self.tmp}/logo.png'
+        Image.new('RGBA', (200, 100), (0, 0, 0, 255)).save(self.logo)
+        watermark.clear_resource_cache()
+        self.addCleanup(watermark.clear_resource_cache)
+
+    def sample(self, name, width):
+        path = f'{self.tmp}/{name}'
+        Image.new('RGB', (width, 500), (10, 20, 30)).save(path)
+        return path
+
+    def test_logo_loaded_once_and_scaled_per_bucket(self):
+        paths = [self.sample(f'{i}.png', width) for i, width in enumerate((800, 805, 810, 1600))]
+
+        with mock.patch('store.watermark._open_image', wraps=watermark._open_image) as open_image:
+            for path in paths:
+                self.assertIsNotNone(watermark.render_watermark(path, path, self.logo))
+
+        # 4 sources + the logo once
+        self.assertEqual(open_image.call_count, 5)
+        # 800-810px share a bucket; 1600px gets its own
+        self.assertEqual(watermark._scaled_logo.cache_info().currsize, 2)
+
+    def test_logo_width_tracks_scale_ratio(self):
+        self.assertEqual(watermark.logo_bucket_width(800), 144)
+        self.assertEqual(watermark.logo_bucket_width(10), watermark.LOGO_WIDTH_BUCKET)
+
+    def test_fonts_cached(self):
+        self.assertIs(watermark.get_font(28), watermark.get_font(28))
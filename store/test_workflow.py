@@ -19,7 +19,8 @@ class CompleteWorkflowTest(TestCase):
             price=50.00,
             unit_type=Product.UNIT_LIT,
             volume=5,
-            is_active=True
+            is_active=True,
+            stock_quantity=20,
         )
     
     def test_complete_user_journey(self):
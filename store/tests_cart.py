@@ -1,7 +1,11 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import User
 from django.test import TestCase, Client
 from django.urls import reverse
 
-from .models import Brand, Category, Product, Order
+from .cart import DatabaseCart
+from .models import Brand, Cart, CartItem, Category, Product, Order, OrderItem
 
 
 class CartCheckoutTests(TestCase):
@@ -11,7 +15,7 @@ class CartCheckoutTests(TestCase):
         self.category = Category.objects.create(name='TestCat')
         self.product = Product.objects.create(
             name='Test Paint', brand=self.brand, category=self.category,
-            price=100.00, unit_type=Product.UNIT_LIT, volume=5, is_active=True
+            price=100.00, unit_type=Product.UNIT_LIT, volume=5, is_active=True, stock_quantity=20,
         )
 
     def test_add_to_cart_session(self):
@@ -83,3 +87,161 @@ class CartCheckoutTests(TestCase):
         order = Order.objects.latest('id')
         self.assertEqual(order.payment_method, 'cod')
         self.assertEqual(order.payment_status, 'pending')
+
+
+class PersistentCartTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('shopper', password='pass12345')
+        self.brand = Brand.objects.create(name='TestBrand')
+        self.paint = Product.objects.create(name='Paint', brand=self.brand, price=Decimal('100.00'), volume=5)
+        self.primer = Product.objects.create(name='Primer', brand=self.brand, price=Decimal('40.00'), volume=1)
+
+    def assertTotals(self, count, subtotal):
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual(cart.item_count, count)
+        self.assertEqual(cart.subtotal, Decimal(subtotal))
+
+    def test_signed_in_cart_is_stored_with_running_totals(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('store:cart_add', args=[self.paint.pk]), {'quantity': 2})
+        self.client.post(reverse('store:cart_add', args=[self.paint.pk]), {'quantity': 1})
+        self.client.post(reverse('store:cart_add', args=[self.primer.pk]), {'quantity': 1})
+        self.assertTotals(4, '340.00')
+        self.assertNotIn('cart', self.client.session)
+
+        self.client.post(reverse('store:cart_update', args=[self.paint.pk]), {'quantity': 1})
+        self.assertTotals(2, '140.00')
+        self.client.post(reverse('store:cart_remove_ajax', args=[self.primer.pk]))
+        self.assertTotals(1, '100.00')
+        self.assertEqual(CartItem.objects.get().quantity, 1)
+
+    def test_login_merges_session_cart(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.paint, quantity=1)
+        session = self.client.session
+        session['cart'] = {str(self.paint.pk): 2, str(self.primer.pk): 1}
+        session.save()
+
+        self.client.login(username='shopper', password='pass12345')
+
+        self.assertNotIn('cart', self.client.session)
+        self.assertEqual(DatabaseCart(self.user).quantities(), {self.paint.pk: 3, self.primer.pk: 1})
+        self.assertTotals(4, '340.00')
+
+    def test_direct_item_changes_keep_totals(self):
+        cart = Cart.objects.create(user=self.user)
+        item = CartItem.objects.create(cart=cart, product=self.paint, quantity=2)
+        self.assertTotals(2, '200.00')
+        item.quantity = 5
+        item.save()
+        self.assertTotals(5, '500.00')
+        item.delete()
+        self.assertTotals(0, '0.00')
+
+    def test_totals_are_one_query(self):
+        DatabaseCart(self.user).add(self.paint, 2)
+        with self.assertNumQueries(1):
+            self.assertEqual(DatabaseCart(self.user).totals(), (2, Decimal('200.00')))
+
+    def test_full_cart_read_reprices_lines(self):
+        cart = DatabaseCart(self.user)
+        cart.add(self.paint, 2)
+        Product.objects.filter(pk=self.paint.pk).update(sale_price=Decimal('80.00'))
+
+        lines = cart.lines()
+
+        self.assertEqual(lines[0].subtotal, Decimal('160.00'))
+        self.assertTotals(2, '160.00')
+
+    def test_public_api_uses_signed_in_cart(self):
+        self.client.force_login(self.user)
+        response = self.client.post(
+            reverse('store:cart-add-item'), {'product_id': self.paint.pk, 'quantity': 2},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['total_items'], 2)
+        self.assertTotals(2, '200.00')
+        self.assertEqual(self.client.get(reverse('store:api_cart')).json()['total'], '200.00')
+
+
+    def test_public_api_needs_csrf_for_signed_in_cart(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(self.user)
+        payload = {'product_id': self.paint.pk, 'quantity': 2}
+        for name in ('store:cart-add-item', 'store:api_cart_add'):
+            response = client.post(reverse(name), payload, content_type='application/json')
+            self.assertEqual(response.status_code, 403)
+        self.assertFalse(CartItem.objects.exists())
+
+        token = 'a' * 32
+        client.cookies['csrftoken'] = token
+        response = client.post(
+            reverse('store:cart-add-item'), payload, content_type='application/json', HTTP_X_CSRFTOKEN=token,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTotals(2, '200.00')
+
+    def test_line_reads_the_live_price(self):
+        cart = DatabaseCart(self.user)
+        cart.add(self.paint, 2)
+        Product.objects.filter(pk=self.paint.pk).update(sale_price=Decimal('80.00'))
+
+        self.assertEqual(cart.line(self.paint.pk).subtotal, Decimal('160.00'))
+
+class OrderHistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='pass12345')
+        self.brand = Brand.objects.create(name='TestBrand')
+        self.product = Product.objects.create(
+            name='Paint', brand=self.brand, price=Decimal('100.00'), volume=5, stock_quantity=20,
+        )
+
+    def _order(self, quantity, user=None, full_name='buyer'):
+        order = Order.objects.create(user=user or self.user, full_name=full_name, phone='1', address='A')
+        OrderItem.objects.create(order=order, product=self.product, quantity=quantity, price=Decimal('100.00'))
+        return order
+
+    def test_checkout_stores_order_total(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('store:cart_add', args=[self.product.pk]), {'quantity': 3})
+        self.client.post(reverse('store:checkout'), {'name': 'Buyer', 'phone': '1', 'address': 'A'})
+
+        order = Order.objects.get()
+        self.assertEqual(order.user, self.user)
+        self.assertEqual(order.order_total, Decimal('300.00'))
+
+    def test_item_edits_refresh_order_total(self):
+        order = self._order(2)
+        item = order.items.get()
+        item.quantity = 4
+        item.save()
+        order.refresh_from_db()
+        self.assertEqual(order.order_total, Decimal('400.00'))
+
+        item.delete()
+        order.refresh_from_db()
+        self.assertEqual(order.order_total, Decimal('0.00'))
+
+    def test_history_is_paginated_with_db_totals(self):
+        for _ in range(25):
+            self._order(1)
+        self._order(2)
+        other = User.objects.create_user('someone', password='pass12345')
+        self._order(5, user=other, full_name='buyer lookalike')
+        self.client.force_login(self.user)
+
+        # session + user, summary aggregate, page of orders
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('store:order_history'))
+
+        self.assertEqual(response.context['order_count'], 26)
+        self.assertEqual(response.context['total_spent'], Decimal('2700.00'))
+        page = response.context['page_obj']
+        self.assertEqual(len(page.object_list), 20)
+        self.assertEqual(page.paginator.num_pages, 2)
+        self.assertEqual(page.object_list[0].order_total, Decimal('200.00'))
+        self.assertEqual(page.object_list[0].item_count, 1)
+
+        response = self.client.get(reverse('store:order_history'), {'page': 2})
+        self.assertEqual(len(response.context['page_obj'].object_list), 6)
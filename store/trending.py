@@ -0,0 +1,144 @@
+"""
+Trending - Exponentially time-decayed counters for searches and products
+Every event weighs exp(rate * t), with t measured from a fixed epoch, so old
+events never have to be re-decayed: ranking by the summed weight is ranking
+by the decayed count at any moment ("forward decay"). Scores are stored as
+the log of that sum, which keeps them small forever and lets one UPDATE add
+a batch of events. Top-K is an index scan on (kind, -score), cached briefly.
+"""
+from datetime import datetime, timezone as dt_timezone
+import math
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Exp, Greatest, Least, Ln
+from django.utils import timezone
+
+from .models import Product, TrendingScore
+from .tasks import BufferedWriter
+
+KIND_SEARCH = TrendingScore.KIND_SEARCH
+KIND_PRODUCT = TrendingScore.KIND_PRODUCT
+
+# Changing TRENDING_HALF_LIFE_HOURS rescales every stored score; run
+# `manage.py update_trending --rebuild` afterwards.
+EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+MAX_TOP_LIMIT = 50
+
+
+def _rate():
+    half_life = getattr(settings, 'TRENDING_HALF_LIFE_HOURS', 24)
+    return math.log(2) / (half_life * 3600)
+
+
+def log_weight(moment=None):
+    """log of the weight an event at `moment` adds to its key's score"""
+    return _rate() * ((moment or timezone.now()) - EPOCH).total_seconds()
+
+
+def _log_add(a, b):
+    if a is None:
+        return b
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+def add_event(increments, kind, key, moment=None, count=1):
+    """Fold `count` events into an {(kind, key): log weight} batch"""
+    weight = log_weight(moment) + math.log(count)
+    slot = (kind, str(key)[:255])
+    increments[slot] = _log_add(increments.get(slot), weight)
+    return increments
+
+
+def record_increments(increments):
+    """Add a batch to the stored scores: one UPDATE (or INSERT) per key"""
+    for (kind, key), weight in sorted(increments.items()):
+        weight = Value(weight, output_field=FloatField())
+        high, low = Greatest(F('score'), weight), Least(F('score'), weight)
+        rows = TrendingScore.objects.filter(kind=kind, key=key)
+        merged = {'score': high + Ln(Value(1.0) + Exp(low - high))}
+        if rows.update(**merged):
+            continue
+        try:
+            with transaction.atomic():
+                TrendingScore.objects.create(kind=kind, key=key, score=weight.value)
+        except IntegrityError:
+            # another writer created the row first
+            rows.update(**merged)
+
+
+class TrendingBuffer(BufferedWriter):
+    """Decayed score increments accumulated in process, so a page view costs no extra query"""
+    batch_size_setting = 'TRENDING_BATCH_SIZE'
+    flush_seconds_setting = 'TRENDING_FLUSH_SECONDS'
+    default_batch_size = 200
+
+    def new_batch(self):
+        return {}
+
+    def collect(self, batch, kind, key, moment=None):
+        add_event(batch, kind, key, moment)
+
+    def write(self, batch):
+        record_increments(batch)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_trending_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = TrendingBuffer()
+    return _buffer
+
+
+def record_product_view(product_id, moment=None):
+    get_trending_buffer().add(KIND_PRODUCT, product_id, moment)
+
+
+def _top(kind, limit):
+    now = log_weight()
+    return [
+        (key, round(math.exp(score - now), 2))
+        for key, score in TrendingScore.objects.filter(kind=kind).order_by('-score', 'key').values_list('key', 'score')[:limit]
+    ]
+
+
+def top(kind, limit=10):
+    """[(key, decayed count)] hottest first; cached for TRENDING_CACHE_SECONDS"""
+    limit = max(1, min(int(limit), MAX_TOP_LIMIT))
+    cache_key = f'trending:{kind}:{limit}'
+    result = cache.get(cache_key)
+    if result is None:
+        result = _top(kind, limit)
+        cache.set(cache_key, result, getattr(settings, 'TRENDING_CACHE_SECONDS', 60))
+    return result
+
+
+def trending_queries(limit=10):
+    """[{'query', 'score'}] searches with the most decayed volume"""
+    return [{'query': key, 'score': score} for key, score in top(KIND_SEARCH, limit)]
+
+
+def trending_products(limit=8):
+    """Active products with the most decayed views, hottest first"""
+    # over-fetch a little so deactivated products do not shorten the list
+    ranked = [int(key) for key, _score in top(KIND_PRODUCT, min(limit * 2, MAX_TOP_LIMIT)) if key.isdigit()]
+    products = Product.objects.filter(pk__in=ranked, is_active=True).select_related('brand', 'category').in_bulk()
+    return [products[pk] for pk in ranked if pk in products][:limit]
+
+
+def prune(min_count=None):
+    """Drop keys whose decayed count has faded below `min_count`"""
+    if min_count is None:
+        min_count = getattr(settings, 'TRENDING_MIN_COUNT', 0.01)
+    deleted, _ = TrendingScore.objects.filter(score__lt=log_weight() + math.log(min_count)).delete()
+    return deleted
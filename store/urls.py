@@ -62,6 +62,7 @@ urlpatterns = [
     path('orders/<int:order_id>/cancel/', order_views.order_cancel, name='order_cancel'),
     path('payments/stripe/create/', views.stripe_create_session, name='stripe_create'),
     path('payments/stripe/success/', views.stripe_success, name='stripe_success'),
+    path('payments/stripe/cancel/', views.stripe_cancel, name='stripe_cancel'),
     path('payments/stripe/webhook/', views.stripe_webhook, name='stripe_webhook'),
     path('contact/', views.contact_view, name='contact'),
     path('ajax/search_suggestions/', views.search_suggestions, name='search_suggestions'),
@@ -102,6 +103,7 @@ urlpatterns = [
     
     # Inventory URLs
     path('inventory/stock/update/<int:product_id>/', inventory_views.update_stock, name='update_stock'),
+    path('inventory/stock/import/', inventory_views.bulk_import_stock, name='bulk_import_stock'),
     path('inventory/stock/check/<int:product_id>/', inventory_views.check_stock, name='check_stock'),
     path('inventory/alerts/', inventory_views.low_stock_alert_view, name='low_stock_alerts'),
     path('inventory/pre-order/<int:product_id>/', inventory_views.pre_order_create, name='pre_order'),
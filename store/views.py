@@ -10,28 +10,45 @@ from django.core.mail import send_mail
 from django.conf import settings
 from django.db.models import Q, Count, Avg, Sum
 from django.contrib.auth.decorators import login_required
+from django.contrib import messages
+from django.db import IntegrityError, transaction
+from django.core.cache import cache
+from django.core import signing
 from django.utils import timezone
 from datetime import timedelta
+from decimal import Decimal
+import logging
 
 from .models import (
     Brand, Category, Product, Order, OrderItem,
     SearchQuery, ProductView, StockLevel,
     ProductViewAnalytics
 )
+from . import coupons
+from .cart import get_cart
+from .search_telemetry import log_search
+from .security import RateLimiter
+from .trending import trending_products as hottest_products
+from .visitors import unique_visitors
+from .inventory import InsufficientStock, commit_reservations, release_reservations, reserve_stock
+from .cache import CACHE_TIMEOUTS, get_catalog_version
+from .conditional import (
+    conditional_catalog_page, make_etag, not_modified, recommendations_epoch, set_validators, visitor_fingerprint
+)
+import hashlib
 import os
 import stripe
 from django.views.decorators.csrf import csrf_exempt
 import json
 
+logger = logging.getLogger(__name__)
+
+STRIPE_CANCEL_SALT = 'store.stripe_cancel'
+
 
 def get_client_ip(request):
-    """Get client IP address from request"""
-    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-    if x_forwarded_for:
-        ip = x_forwarded_for.split(',')[0]
-    else:
-        ip = request.META.get('REMOTE_ADDR')
-    return ip
+    """Get client IP address from request (see RateLimiter.get_client_ip)"""
+    return RateLimiter.get_client_ip(request)
 
 
 def home_view(request):
@@ -42,8 +59,9 @@ def home_view(request):
     brands = Brand.objects.all()[:8]
     new_products = Product.objects.filter(is_active=True).select_related('brand', 'category').order_by('-created_at')[:12]
     
-    # Get trending products (most viewed in last 7 days)
-    trending_products = Product.objects.filter(is_active=True).order_by('-view_count')[:8]
+    # Trending products from the decayed view scores; all-time views until
+    # there is recent traffic
+    trending_products = hottest_products(8) or Product.objects.filter(is_active=True).order_by('-view_count')[:8]
     featured_products = trending_products  # Use same data for featured
     
     template = 'store/home_redesign.html' if use_redesign else 'store/home.html'
@@ -56,6 +74,22 @@ def home_view(request):
     })
 
 
+def _search_count_key(request):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f"search:result_count:{get_catalog_version()}:{path}"
+
+
+def _log_revalidated_search(request):
+    # a 304 means the same results as the page the visitor already has
+    q = request.GET.get('q')
+    if q:
+        log_search(
+            q, user=request.user, session_key=request.session.session_key,
+            result_count=cache.get(_search_count_key(request), 0),
+        )
+
+
+@conditional_catalog_page(on_not_modified=_log_revalidated_search)
 def product_list(request):
     qs = Product.objects.filter(is_active=True).select_related('brand', 'category')
     
@@ -88,16 +122,6 @@ def product_list(request):
             Q(description__icontains=q) |
             Q(brand__name__icontains=q)
         )
-        # Track search query
-        # Note: SearchQuery model not implemented yet
-        # ip_address = get_client_ip(request)
-        # user = request.user if request.user.is_authenticated else None
-        # SearchQuery.objects.create(
-        #     query=q,
-        #     user=user,
-        #     results_count=qs.count(),
-        #     ip_address=ip_address
-        # )
     
     if min_price:
         try:
@@ -135,6 +159,9 @@ def product_list(request):
     elif sort_by == 'popular':
         # Most viewed products
         qs = qs.order_by('-view_count')
+    elif sort_by == 'rating':
+        # Stored review average, then the number of reviews behind it
+        qs = qs.order_by('-rating', '-review_count')
     else:  # newest
         qs = qs.order_by('-created_at')
 
@@ -166,6 +193,11 @@ def product_list(request):
     except EmptyPage:
         products_page = paginator.page(paginator.num_pages)
 
+    if q:
+        # buffered; the paginator has already counted the results
+        log_search(q, user=request.user, session_key=request.session.session_key, result_count=paginator.count)
+        cache.set(_search_count_key(request), paginator.count, CACHE_TIMEOUTS['search_results'])
+
     return render(request, 'store/product_list.html', {
         'products': products_page,
         'categories': categories,
@@ -210,6 +242,20 @@ def product_detail(request, pk):
     analytics.last_viewed = timezone.now()
     analytics.save()
     
+    # Views are tracked above even when the browser's copy is still fresh
+    # the recommendations window bounds how long a 304 can keep them
+    epoch = recommendations_epoch()
+    etag = make_etag('product', get_catalog_version(), p.pk, p.updated_at, epoch, visitor_fingerprint(request))
+    last_modified = max(p.updated_at, epoch)
+    if not len(messages.get_messages(request)):
+        cached = not_modified(request, etag, last_modified)
+        if cached is not None:
+            return set_validators(cached, etag, last_modified, 'catalog_page')
+    response = _render_product_detail(request, p)
+    return set_validators(response, etag, last_modified, 'catalog_page')
+
+
+def _render_product_detail(request, p):
     # Get recommendations (products viewed by users who viewed this product)
     # Get users who viewed this product
     viewers = ProductView.objects.filter(product=p).exclude(user__isnull=True).values_list('user', flat=True).distinct()
@@ -250,156 +296,97 @@ def product_detail(request, pk):
     })
 
 
-def _get_cart(request):
-    return request.session.setdefault('cart', {})
+def _is_json(request):
+    return request.content_type == 'application/json' or request.META.get('HTTP_CONTENT_TYPE', '').startswith('application/json')
+
+
+def _posted_quantity(request, default):
+    """Quantity from a fetch() JSON body or a form post; None if malformed"""
+    try:
+        if _is_json(request):
+            data = json.loads(request.body.decode('utf-8')) if request.body else {}
+            return int(data.get('quantity', default))
+        return int(request.POST.get('quantity', default))
+    except Exception:
+        return None
+
+
+def _cart_payload(request, lines):
+    """JSON summary of cart lines for the mini-cart and AJAX cart endpoints"""
+    items = []
+    for line in lines:
+        product = line.product
+        items.append({
+            'pk': product.pk,
+            'name': product.name,
+            'quantity': line.quantity,
+            'qty': line.quantity,
+            'price': float(line.unit_price),
+            'price_display': str(line.unit_price),
+            'subtotal': float(line.subtotal),
+            'image_url': request.build_absolute_uri(product.image.url) if product.image else None,
+        })
+    return {
+        'items': items,
+        'total': float(sum(line.subtotal for line in lines)),
+        'count': sum(line.quantity for line in lines),
+    }
 
 
 @require_POST
 def cart_add(request, pk):
     product = get_object_or_404(Product, pk=pk, is_active=True)
-    cart = _get_cart(request)
-    qty = 1
-    # support JSON body from fetch() as well as form-encoded POST
-    if request.content_type == 'application/json' or request.META.get('HTTP_CONTENT_TYPE', '').startswith('application/json'):
-        try:
-            data = json.loads(request.body.decode('utf-8')) if request.body else {}
-            qty = int(data.get('quantity', 1))
-        except Exception:
-            qty = 1
-    else:
-        try:
-            qty = int(request.POST.get('quantity', 1))
-        except Exception:
-            qty = 1
-    if str(pk) in cart:
-        cart[str(pk)] += qty
-    else:
-        cart[str(pk)] = qty
-    request.session.modified = True
+    cart = get_cart(request)
+    qty = _posted_quantity(request, 1)
+    cart.add(product, 1 if qty is None else qty)
     # If JSON request, return JSON summary
-    if request.content_type == 'application/json' or request.META.get('HTTP_CONTENT_TYPE', '').startswith('application/json'):
-        total = 0
-        count = 0
-        items = []
-        for pid, q in cart.items():
-            try:
-                p = Product.objects.get(pk=int(pid))
-            except Product.DoesNotExist:
-                continue
-            subtotal = float(p.price * q)
-            total += subtotal
-            count += q
-            items.append({'pk': p.pk, 'name': p.name, 'quantity': q, 'price': float(p.price), 'subtotal': subtotal, 'image_url': request.build_absolute_uri(p.image.url) if p.image else None})
-        return JsonResponse({'success': True, 'items': items, 'total': float(total), 'count': count})
+    if _is_json(request):
+        return JsonResponse({'success': True, **_cart_payload(request, cart.lines())})
     return redirect('store:cart_view')
 
 
 def cart_view(request):
-    cart = _get_cart(request)
-    items = []
-    total = 0
-    for pid, qty in cart.items():
-        try:
-            p = Product.objects.get(pk=int(pid))
-        except Product.DoesNotExist:
-            continue
-        subtotal = p.price * qty
-        total += subtotal
-        items.append({'product': p, 'qty': qty, 'subtotal': subtotal})
+    lines = get_cart(request).lines()
+    items = [{'product': line.product, 'qty': line.quantity, 'subtotal': line.subtotal} for line in lines]
+    total = sum(line.subtotal for line in lines)
     return render(request, 'store/cart.html', {'items': items, 'total': total})
 
 
 def cart_remove(request, pk):
-    cart = _get_cart(request)
-    cart.pop(str(pk), None)
-    request.session.modified = True
+    get_cart(request).remove(pk)
     return redirect('store:cart_view')
 
 
 @require_POST
 def cart_update(request, pk):
     """Update cart quantity for given product pk. If quantity <= 0, remove item."""
-    cart = _get_cart(request)
-    try:
-        qty = int(request.POST.get('quantity', 0))
-    except Exception:
-        qty = 0
-    if qty <= 0:
-        cart.pop(str(pk), None)
-    else:
-        cart[str(pk)] = qty
-    request.session.modified = True
+    qty = _posted_quantity(request, 0)
+    get_cart(request).set(pk, qty or 0)
     return redirect('store:cart_view')
 
 
 @require_POST
 def cart_update_ajax(request, pk):
     """AJAX endpoint: set quantity and return JSON with updated subtotal and total."""
-    cart = _get_cart(request)
-    # support JSON body from fetch() as well as form posts
-    qty = None
-    if request.content_type == 'application/json' or request.META.get('HTTP_CONTENT_TYPE', '').startswith('application/json'):
-        try:
-            data = json.loads(request.body.decode('utf-8')) if request.body else {}
-            qty = int(data.get('quantity', 0))
-        except Exception:
-            return JsonResponse({'error': 'invalid quantity'}, status=400)
-    else:
-        try:
-            qty = int(request.POST.get('quantity', 0))
-        except Exception:
-            return JsonResponse({'error': 'invalid quantity'}, status=400)
-
-    if qty <= 0:
-        cart.pop(str(pk), None)
-    else:
-        cart[str(pk)] = qty
-    request.session.modified = True
-
-    # compute new subtotal for this product and total for cart
-    subtotal = 0
-    total = 0
-    try:
-        p = Product.objects.get(pk=pk)
-        subtotal = p.price * cart.get(str(pk), 0)
-    except Product.DoesNotExist:
-        subtotal = 0
-
-    for pid, q in cart.items():
-        try:
-            prod = Product.objects.get(pk=int(pid))
-        except Product.DoesNotExist:
-            continue
-        total += prod.price * q
-
-    return JsonResponse({'pk': pk, 'quantity': cart.get(str(pk), 0), 'subtotal': subtotal, 'total': total})
+    qty = _posted_quantity(request, 0)
+    if qty is None:
+        return JsonResponse({'error': 'invalid quantity'}, status=400)
+
+    cart = get_cart(request)
+    cart.set(pk, qty)
+    line = cart.line(pk)
+    _count, total = cart.totals()
+    return JsonResponse({
+        'pk': pk,
+        'quantity': line.quantity if line else 0,
+        'subtotal': line.subtotal if line else 0,
+        'total': total,
+    })
 
 
 def cart_summary_ajax(request):
     """Return a small JSON summary of cart contents for mini-cart flyout."""
-    cart = _get_cart(request)
-    items = []
-    total = 0
-    count = 0
-    for pid, qty in cart.items():
-        try:
-            p = Product.objects.get(pk=int(pid))
-        except Product.DoesNotExist:
-            continue
-        subtotal = p.price * qty
-        total += subtotal
-        count += qty
-        items.append({
-            'pk': p.pk,
-            'name': p.name,
-            'quantity': qty,
-            'qty': qty,
-            'price': float(p.price),
-            'price_display': str(p.price),
-            'subtotal': float(subtotal),
-            'image_url': request.build_absolute_uri(p.image.url) if p.image else None,
-        })
-    return JsonResponse({'items': items, 'total': float(total), 'count': count})
+    return JsonResponse(_cart_payload(request, get_cart(request).lines()))
 
 
 @csrf_exempt
@@ -407,8 +394,7 @@ def cart_summary_ajax(request):
 @authentication_classes([])
 @permission_classes([AllowAny])
 def api_cart_add_public(request):
-    """Simple JSON API endpoint for adding items to the session cart (public)."""
-    """Public session-backed cart add endpoint (no tracing)."""
+    """Public JSON endpoint for adding items to the visitor's cart."""
     data = request.data or {}
     product_id = data.get('product_id')
     try:
@@ -428,101 +414,142 @@ def api_cart_add_public(request):
     if not request.session.session_key:
         request.session.create()
 
-    cart = request.session.get('cart', {})
-    product_key = str(product_id)
-    cart[product_key] = cart.get(product_key, 0) + quantity
-    request.session['cart'] = cart
-    request.session.modified = True
-
     return Response({
         'success': True,
         'product': {'id': product.pk, 'name': product.name},
-        'quantity': cart[product_key]
+        'quantity': get_cart(request).add(product, quantity),
     }, status=drf_status.HTTP_200_OK)
 
 
 @require_POST
 def cart_remove_ajax(request, pk):
     """AJAX remove endpoint: remove product from cart and return updated total."""
-    cart = _get_cart(request)
-    cart.pop(str(pk), None)
-    request.session.modified = True
+    cart = get_cart(request)
+    cart.remove(pk)
+    payload = _cart_payload(request, cart.lines())
+    return JsonResponse({'removed': pk, 'items': payload['items'], 'total': payload['total']})
 
-    total = 0
-    items = []
-    for pid, qty in cart.items():
-        try:
-            p = Product.objects.get(pk=int(pid))
-        except Product.DoesNotExist:
-            continue
-        subtotal = p.price * qty
-        total += subtotal
-        items.append({'pk': p.pk, 'name': p.name, 'qty': qty, 'price': p.price, 'subtotal': subtotal})
 
-    return JsonResponse({'removed': pk, 'items': items, 'total': total})
+def _coupon_rejected(request, error):
+    request.session.pop('applied_coupon', None)
+    messages.error(request, error.message)
+    return redirect('store:cart_view')
 
 
-def checkout_view(request):
-    cart = _get_cart(request)
-    if request.method == 'POST':
-        name = request.POST.get('name')
-        phone = request.POST.get('phone')
-        address = request.POST.get('address')
-        payment_method = request.POST.get('payment_method', Order.PAYMENT_METHOD_COD)
-        # Map legacy value to new COD identifier so existing clients continue to work
-        if payment_method == Order.PAYMENT_METHOD_OFFLINE:
-            payment_method = Order.PAYMENT_METHOD_COD
+def _out_of_stock(request, error):
+    name = Product.objects.filter(pk=error.product_id).values_list('name', flat=True).first()
+    messages.error(request, f'Sản phẩm "{name or error.product_id}" chỉ còn {error.available} trong kho.')
+    return redirect('store:cart_view')
+
+
+def _place_order(request, cart, payment_method, name='', phone='', address='', quote=None):
+    """
+    Create an order for the cart with its items and stock held
+
+    Order, items, stock reservation and coupon redemption succeed or fail
+    together; raises InsufficientStock or CouponError. Returns the order and
+    its items.
+    """
+    cart_quantities = cart.quantities()
+    products = Product.objects.in_bulk(list(cart_quantities))
+    with transaction.atomic():
         order = Order.objects.create(
             user=request.user if request.user.is_authenticated else None,
             full_name=name,
             phone=phone,
             address=address,
+            payment_method=payment_method,
         )
-        for pid, qty in cart.items():
-            try:
-                p = Product.objects.get(pk=int(pid))
-            except Product.DoesNotExist:
+        order_items = []
+        quantities = {}
+        for pid, qty in cart_quantities.items():
+            p = products.get(pid)
+            if p is None:
                 continue
-            OrderItem.objects.create(
+            order_items.append(OrderItem(
                 order=order,
                 product=p,
                 quantity=qty,
                 price=p.get_price(),
-            )
-        request.session.pop('cart', None)
-        request.session.modified = True
-        # record payment details (stubbed). In a real integration you would
-        # create a payment with Stripe/PayPal and update these fields
-        order.payment_method = payment_method
-        # for demo / local dev mark as paid when method is 'stripe' or 'paypal'
-        if payment_method in ('stripe', 'paypal'):
-            order.payment_status = 'paid'
-            order.payment_reference = f"{payment_method.upper()}-SIM-{order.id}"
-        else:
-            order.payment_status = 'pending'
-        order.save()
+            ))
+            quantities[p.pk] = quantities.get(p.pk, 0) + qty
+        OrderItem.objects.bulk_create(order_items)
+        subtotal = sum((it.price * it.quantity for it in order_items), Decimal('0'))
+        reserve_stock(order, quantities)
+        if quote is not None:
+            coupons.redeem(quote, request.user, request.session.session_key, order=order)
+            order.discount_amount = min(quote.discount, subtotal)
+        order.order_total = subtotal - order.discount_amount
+        # bulk-created items fire no signals, so the totals are stored here
+        Order.objects.filter(pk=order.pk).update(order_total=order.order_total, discount_amount=order.discount_amount)
+    return order, order_items
+
+
+def _session_quote(request, cart):
+    """Quote for the coupon applied to this session, or None; raises CouponError"""
+    applied_coupon = request.session.get('applied_coupon')
+    if not applied_coupon:
+        return None
+    # re-checked against the cart being ordered; redeemed with the order
+    return coupons.check(applied_coupon['code'], request.user, cart)
+
+
+def checkout_view(request):
+    cart = get_cart(request)
+    if request.method == 'POST':
+        name = request.POST.get('name')
+        phone = request.POST.get('phone')
+        address = request.POST.get('address')
+        payment_method = request.POST.get('payment_method', Order.PAYMENT_METHOD_COD)
+        # Map legacy value to new COD identifier so existing clients continue to work
+        if payment_method == Order.PAYMENT_METHOD_OFFLINE:
+            payment_method = Order.PAYMENT_METHOD_COD
+        try:
+            quote = _session_quote(request, cart)
+        except coupons.CouponError as e:
+            return _coupon_rejected(request, e)
+        try:
+            order, order_items = _place_order(request, cart, payment_method, name, phone, address, quote)
+        except InsufficientStock as e:
+            return _out_of_stock(request, e)
+        except coupons.CouponError as e:
+            return _coupon_rejected(request, e)
+        if payment_method == Order.PAYMENT_METHOD_STRIPE and _stripe_key():
+            # stock stays held until Stripe confirms the payment
+            return _start_stripe_checkout(order, order_items)
+        with transaction.atomic():
+            # record payment details (stubbed). In a real integration you would
+            # create a payment with Stripe/PayPal and update these fields
+            # for demo / local dev mark as paid when method is 'stripe' or 'paypal'
+            if payment_method in ('stripe', 'paypal'):
+                order.payment_status = 'paid'
+                order.payment_reference = f"{payment_method.upper()}-SIM-{order.id}"
+            else:
+                order.payment_status = 'pending'
+            order.save()
+            # Paid and COD orders keep their stock; only orders still
+            # waiting on an online payment stay held (and can expire)
+            if order.payment_status == 'paid' or payment_method == Order.PAYMENT_METHOD_COD:
+                commit_reservations(order)
+        cart.clear()
+        request.session.pop('applied_coupon', None)
         # send notification email (development: console backend)
         try:
             items_text = []
-            total = 0
-            for it in order.items.all():
+            for it in order_items:
                 items_text.append(f"{it.product.name} x{it.quantity} @{it.price}")
-                total += it.quantity * it.price
+            if order.discount_amount:
+                items_text.append(f"Discount: -{order.discount_amount}")
+            total = order.order_total
             subject = f'New Order #{order.id}'
             message = f'Order #{order.id}\nName: {order.full_name}\nPhone: {order.phone}\nAddress: {order.address}\nItems:\n' + "\n".join(items_text) + f'\nTotal: {total}'
             send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [settings.DEFAULT_FROM_EMAIL])
         except Exception:
             pass
         return redirect('store:checkout_success')
-    items = []
-    total = 0
-    for pid, qty in cart.items():
-        try:
-            p = Product.objects.get(pk=int(pid))
-        except Product.DoesNotExist:
-            continue
-        items.append({'product': p, 'qty': qty, 'subtotal': p.price * qty})
-        total += p.price * qty
+    lines = cart.lines()
+    items = [{'product': line.product, 'qty': line.quantity, 'subtotal': line.subtotal} for line in lines]
+    total = sum(line.subtotal for line in lines)
     return render(request, 'store/checkout.html', {'items': items, 'total': total})
 
 
@@ -530,91 +557,275 @@ def checkout_success(request):
     return render(request, 'store/checkout_success.html')
 
 
-def stripe_create_session(request):
-    cart = _get_cart(request)
-    if not cart:
-        return redirect('store:checkout')
-
+def _stripe_key():
     # read secret key from env
-    stripe_key = os.environ.get('STRIPE_SECRET_KEY')
-    if not stripe_key:
-        # Stripe not configured; fallback to checkout page
-        return redirect('store:checkout')
-    stripe.api_key = stripe_key
+    return os.environ.get('STRIPE_SECRET_KEY')
 
-    line_items = []
-    for pid, qty in cart.items():
+
+def _stripe_coupon(coupon_id, discount):
+    """
+    Id of the Stripe coupon taking `discount` off, one per (coupon, amount)
+
+    The id is derived from both, so each is created in Stripe once and later
+    checkouts only find it in the cache.
+    """
+    cents = int(discount * 100)
+    stripe_id = f"store-{coupon_id}-{cents}"
+    key = f'stripe:coupon:{stripe_id}'
+    if cache.get(key) is None:
         try:
-            p = Product.objects.get(pk=int(pid))
-        except Product.DoesNotExist:
-            continue
+            stripe.Coupon.create(id=stripe_id, amount_off=cents, currency='usd', duration='once')
+        except stripe.error.InvalidRequestError as e:
+            if e.code != 'resource_already_exists':
+                raise
+        cache.set(key, True, None)
+    return stripe_id
+
+
+def _start_stripe_checkout(order, order_items):
+    """
+    Open a Stripe Checkout session for a pending order and redirect to it
+
+    The order's stock is already held; the session expires with the hold
+    (Stripe allows no less than 30 minutes), and the order id travels with
+    the session so the success page and the webhook can find it. If Stripe cannot be reached the order is canceled again.
+    """
+    stripe.api_key = _stripe_key()
+    line_items = []
+    for item in order_items:
+        p = item.product
         line_items.append({
             'price_data': {
                 'currency': 'usd',
-                'product_data': {'name': p.name},
-                'unit_amount': int(p.price * 100),
+                'product_data': {
+                    'name': p.name,
+                    # lets stripe_success map lines back without name lookups
+                    'metadata': {'product_id': str(p.pk)},
+                },
+                'unit_amount': int(item.price * 100),
             },
-            'quantity': qty,
+            'quantity': item.quantity,
         })
 
+    hold_minutes = max(getattr(settings, 'STOCK_RESERVATION_TTL_MINUTES', 30), 30)
+    cancel_token = signing.dumps(order.pk, salt=STRIPE_CANCEL_SALT)
     domain = os.environ.get('SITE_URL', 'http://127.0.0.1:8000')
     try:
+        extra = {}
+        if order.discount_amount:
+            # the coupon redeemed with the order, as a Stripe discount
+            coupon_id = order.applied_coupons.values_list('coupon_id', flat=True).first()
+            extra['discounts'] = [{'coupon': _stripe_coupon(coupon_id, order.discount_amount)}]
         session = stripe.checkout.Session.create(
             payment_method_types=['card'],
             line_items=line_items,
             mode='payment',
+            client_reference_id=str(order.pk),
+            metadata={'order_id': str(order.pk)},
+            expires_at=int((timezone.now() + timedelta(minutes=hold_minutes)).timestamp()),
             success_url=f"{domain}/store/payments/stripe/success/?session_id={{CHECKOUT_SESSION_ID}}",
-            cancel_url=f"{domain}/store/checkout/",
+            cancel_url=f"{domain}/store/payments/stripe/cancel/?order={cancel_token}",
+            **extra,
         )
     except Exception:
+        logger.exception(f"Could not open a Stripe session for order {order.pk}")
+        _cancel_stripe_order(order.pk)
         return redirect('store:checkout')
 
+    # the session id identifies the order until the payment intent replaces it
+    Order.objects.filter(pk=order.pk).update(payment_reference=session.id)
     return redirect(session.url)
 
 
+def stripe_create_session(request):
+    cart = get_cart(request)
+    if cart.is_empty():
+        return redirect('store:checkout')
+
+    if not _stripe_key():
+        # Stripe not configured; fallback to checkout page
+        return redirect('store:checkout')
+
+    try:
+        quote = _session_quote(request, cart)
+        order, order_items = _place_order(request, cart, Order.PAYMENT_METHOD_STRIPE, quote=quote)
+    except InsufficientStock as e:
+        return _out_of_stock(request, e)
+    except coupons.CouponError as e:
+        return _coupon_rejected(request, e)
+    return _start_stripe_checkout(order, order_items)
+
+
+@transaction.atomic
+def _confirm_stripe_order(order_id, payment_reference, name=''):
+    """Mark a pending Stripe order paid and keep its stock; None if there is no such order"""
+    order = Order.objects.select_for_update().filter(pk=order_id, payment_method='stripe').first()
+    if order is None or order.payment_status == Order.PAYMENT_STATUS_PAID:
+        return order
+    order.payment_status = Order.PAYMENT_STATUS_PAID
+    order.payment_reference = payment_reference
+    if order.status == Order.STATUS_CANCELED:
+        # paid after the customer backed out: commit_reservations re-takes the stock
+        order.status = Order.STATUS_PENDING
+    if name and not order.full_name:
+        order.full_name = name
+    order.save()
+    commit_reservations(order)
+    return order
+
+
+@transaction.atomic
+def _cancel_stripe_order(order_id):
+    """Cancel an unpaid Stripe order and return its held stock; False if it was already paid"""
+    order = Order.objects.select_for_update().filter(pk=order_id, payment_method='stripe').first()
+    if order is None or order.payment_status == Order.PAYMENT_STATUS_PAID:
+        return False
+    if order.status != Order.STATUS_CANCELED:
+        order.status = Order.STATUS_CANCELED
+        order.save()
+    release_reservations(order.reservations.all())
+    coupons.release(order)
+    return True
+
+
+def _stripe_customer_name(sess):
+    try:
+        return sess['customer_details'].get('name') or ''
+    except Exception:
+        return ''
+
+
 def stripe_success(request):
     session_id = request.GET.get('session_id')
-    stripe_key = os.environ.get('STRIPE_SECRET_KEY')
+    stripe_key = _stripe_key()
     if not stripe_key or not session_id:
         return redirect('store:checkout_success')
+
+    # Refreshing the success URL is answered without calling Stripe again
+    order_key = f"stripe_session_order:{session_id}"
+    if cache.get(order_key):
+        return redirect('store:checkout_success')
+
     stripe.api_key = stripe_key
     try:
-        sess = stripe.checkout.Session.retrieve(session_id, expand=['line_items', 'payment_intent'])
+        sess = stripe.checkout.Session.retrieve(
+            session_id, expand=['line_items.data.price.product', 'payment_intent']
+        )
     except Exception:
         return redirect('store:checkout_success')
 
-    # create an order from session line items (best-effort)
+    payment_reference = _stripe_payment_reference(sess, session_id)
+    placed_id = _to_int(sess.get('client_reference_id'))
+    if placed_id is not None:
+        # the order and its held stock were created before the redirect
+        if sess.get('payment_status') != 'paid':
+            return redirect('store:checkout')
+        order = _confirm_stripe_order(placed_id, payment_reference, _stripe_customer_name(sess))
+        order_id = order.pk if order else None
+    else:
+        # sessions opened before orders were placed up front; the unique
+        # payment reference keeps concurrent requests to one order
+        order_id = _stripe_order_id(payment_reference)
+        if order_id is None:
+            buyer = request.user if request.user.is_authenticated else None
+            try:
+                order_id = _create_order_from_stripe_session(sess, payment_reference, buyer).pk
+            except IntegrityError:
+                order_id = _stripe_order_id(payment_reference)
+    if order_id is not None:
+        cache.set(order_key, order_id, CACHE_TIMEOUTS['checkout_session'])
+
+    get_cart(request).clear()
+    request.session.pop('applied_coupon', None)
+
+    return redirect('store:checkout_success')
+
+
+def stripe_cancel(request):
+    """Customer left Stripe Checkout: cancel the pending order and free its stock"""
+    try:
+        order_id = signing.loads(request.GET.get('order', ''), salt=STRIPE_CANCEL_SALT)
+    except signing.BadSignature:
+        return redirect('store:cart_view')
+
+    if _cancel_stripe_order(order_id):
+        reference = Order.objects.filter(pk=order_id).values_list('payment_reference', flat=True).first()
+        if reference and reference.startswith('cs_') and _stripe_key():
+            # so the abandoned session cannot be paid after its stock is gone
+            try:
+                stripe.api_key = _stripe_key()
+                stripe.checkout.Session.expire(reference)
+            except Exception:
+                logger.warning(f"Could not expire Stripe session {reference} for order {order_id}")
+        messages.info(request, 'Thanh toán đã bị hủy, giỏ hàng của bạn vẫn được giữ nguyên.')
+    return redirect('store:cart_view')
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _stripe_order_id(payment_reference):
+    return (
+        Order.objects.filter(payment_method='stripe', payment_reference=payment_reference)
+        .values_list('pk', flat=True).first()
+    )
+
+
+def _stripe_payment_reference(sess, session_id):
+    intent = sess.get('payment_intent')
+    if isinstance(intent, str):
+        return intent
+    try:
+        return intent['id']
+    except (KeyError, TypeError):
+        return session_id
+
+
+def _stripe_line_product_id(item):
+    """Product id from the line item's Stripe product metadata"""
+    try:
+        product = item['price']['product']
+        return _to_int(product['metadata']['product_id'])
+    except (KeyError, TypeError):
+        return None
+
+
+@transaction.atomic
+def _create_order_from_stripe_session(sess, payment_reference, user=None):
     try:
         name = sess['customer_details'].get('name') or 'Stripe Customer'
     except Exception:
         name = 'Stripe Customer'
-    order = Order.objects.create(full_name=name, phone='', address='')
-    for item in sess.get('line_items', {}).get('data', []):
-        prod_name = item['description']
-        qty = item['quantity']
-        # attempt to match product by name, else create a generic product entry
-        try:
-            p = Product.objects.filter(name__iexact=prod_name).first()
-        except Exception:
-            p = None
-        price = (item['price']['unit_amount'] / 100) if item.get('price') else 0
-        if p:
-            OrderItem.objects.create(order=order, product=p, quantity=qty, price=price)
-        else:
-            # create a placeholder product-like row by linking to first product
-            first = Product.objects.first()
-            if first:
-                OrderItem.objects.create(order=order, product=first, quantity=qty, price=price)
-    order.payment_method = 'stripe'
-    order.payment_status = 'paid'
-    order.payment_reference = sess.get('payment_intent') or session_id
-    order.save()
 
-    # clear cart
-    request.session.pop('cart', None)
-    request.session.modified = True
+    lines = sess.get('line_items', {}).get('data', [])
+    products = Product.objects.in_bulk(
+        [pid for pid in (_stripe_line_product_id(item) for item in lines) if pid is not None]
+    )
 
-    return redirect('store:checkout_success')
+    order = Order.objects.create(
+        user=user,
+        full_name=name,
+        phone='',
+        address='',
+        payment_method='stripe',
+        payment_status='paid',
+        payment_reference=payment_reference,
+    )
+    items = []
+    for item in lines:
+        p = products.get(_stripe_line_product_id(item))
+        if p is None:
+            logger.warning(f"Stripe payment {payment_reference}: line '{item.get('description')}' has no known product")
+            continue
+        price = (item['price']['unit_amount'] / 100) if item.get('price') else 0
+        items.append(OrderItem(order=order, product=p, quantity=item['quantity'], price=price))
+    OrderItem.objects.bulk_create(items)
+    Order.refresh_totals([order.pk])
+    return order
 
 
 @csrf_exempt
@@ -643,12 +854,19 @@ def stripe_webhook(request):
         pay_ref = session.get('payment_intent') or session.get('id')
         amount = session.get('amount_total', 0) / 100  # Convert from cents
         
-        # find orders with this payment_reference
-        orders = Order.objects.filter(payment_reference__icontains=pay_ref)
+        # orders placed before the redirect carry their id; older ones
+        # are matched by payment_reference
+        placed_id = _to_int(session.get('client_reference_id'))
+        if placed_id is not None:
+            placed = _confirm_stripe_order(placed_id, pay_ref, _stripe_customer_name(session))
+            orders = [placed] if placed else []
+        else:
+            orders = Order.objects.filter(payment_reference=pay_ref)
         for o in orders:
-            o.payment_status = 'paid'
-            o.payment_reference = pay_ref
-            o.save()
+            if placed_id is None:
+                o.payment_status = 'paid'
+                o.payment_reference = pay_ref
+                o.save()
             
             # Log the payment
             PaymentLog.objects.create(
@@ -660,6 +878,12 @@ def stripe_webhook(request):
                 raw_response=str(event)
             )
 
+    elif event['type'] == 'checkout.session.expired':
+        # the customer never paid: give the held stock back
+        placed_id = _to_int(event['data']['object'].get('client_reference_id'))
+        if placed_id is not None:
+            _cancel_stripe_order(placed_id)
+
     return JsonResponse({'status': 'received'})
 
 
@@ -707,14 +931,8 @@ def popular_searches(request):
 
 def trending_products(request):
     """Show trending products based on views and sales"""
-    # Get most viewed products in last 7 days
-    seven_days_ago = timezone.now() - timedelta(days=7)
-    most_viewed = Product.objects.filter(
-        is_active=True,
-        views__viewed_at__gte=seven_days_ago
-    ).annotate(
-        view_count=Count('views')
-    ).order_by('-view_count')[:12]
+    # Most viewed, with recent views counting the most (store.trending)
+    most_viewed = hottest_products(12)
     
     # Get best sellers
     best_sellers = Product.objects.filter(
@@ -849,9 +1067,7 @@ def admin_dashboard(request):
     total_views_today = ProductView.objects.filter(
         viewed_at__date=today
     ).count()
-    unique_visitors_today = ProductView.objects.filter(
-        viewed_at__date=today
-    ).values('ip_address').distinct().count()
+    unique_visitors_today = unique_visitors(today, today)
     
     orders_today = Order.objects.filter(created_at__date=today).count()
     conversion_rate = (orders_today / unique_visitors_today * 100) if unique_visitors_today > 0 else 0
@@ -0,0 +1,147 @@
+"""
+Visitor Counting - HyperLogLog distinct visitors per day and per product
+Product views are collected in process and merged into one sketch per day
+(store-wide and per product) plus a lifetime sketch per product behind
+ProductViewAnalytics.unique_views. A date range costs one sketch merge per
+day, with the error bounds documented in store.hll.
+"""
+import threading
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .hll import HyperLogLog
+from .models import ProductViewAnalytics, VisitorSketch
+from .tasks import BufferedWriter
+
+SITE = None  # product id of the store-wide sketches
+
+
+def visitor_key(session_key=None, user_id=None, ip_address=None):
+    """Who a view counts as: the session, else the account, else the address"""
+    if session_key:
+        return f'session:{session_key}'
+    if user_id:
+        return f'user:{user_id}'
+    if ip_address:
+        return f'ip:{ip_address}'
+    return None
+
+
+def _merge_row(queryset, create, sketch):
+    """Merge `sketch` into the locked row of `queryset`, creating it if missing"""
+    row = queryset.select_for_update().first()
+    if row is None:
+        try:
+            with transaction.atomic():
+                return create(sketch.to_bytes())
+        except IntegrityError:
+            # another writer created it first
+            row = queryset.select_for_update().get()
+    merged = HyperLogLog.from_bytes(row.registers).merge(sketch)
+    queryset.filter(pk=row.pk).update(registers=merged.to_bytes())
+    return merged
+
+
+def write_visitor_batch(batch):
+    """Merge {(day, product id or SITE): set of visitor keys} into the stored sketches"""
+    lifetime = {}
+    with transaction.atomic():
+        for (day, product_id), keys in sorted(batch.items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+            sketch = HyperLogLog().update(keys)
+            _merge_row(
+                VisitorSketch.objects.filter(date=day, product_id=product_id),
+                lambda registers: VisitorSketch.objects.create(date=day, product_id=product_id, registers=registers),
+                sketch,
+            )
+            if product_id is not SITE:
+                lifetime.setdefault(product_id, HyperLogLog()).merge(sketch)
+
+        for product_id, sketch in sorted(lifetime.items()):
+            analytics, _ = ProductViewAnalytics.objects.select_for_update().get_or_create(product_id=product_id)
+            merged = HyperLogLog.from_bytes(analytics.visitor_sketch).merge(sketch)
+            ProductViewAnalytics.objects.filter(pk=analytics.pk).update(
+                visitor_sketch=merged.to_bytes(), unique_views=merged.count(),
+            )
+
+
+class VisitorSketchBuffer(BufferedWriter):
+    """(day, product) -> visitors seen since the last flush"""
+    batch_size_setting = 'VISITOR_SKETCH_BATCH_SIZE'
+    flush_seconds_setting = 'VISITOR_SKETCH_FLUSH_SECONDS'
+    default_batch_size = 500
+    default_flush_seconds = 60
+
+    def new_batch(self):
+        return {}
+
+    def collect(self, batch, day, product_id, visitor):
+        batch.setdefault((day, product_id), set()).add(visitor)
+        batch.setdefault((day, SITE), set()).add(visitor)
+
+    def write(self, batch):
+        write_visitor_batch(batch)
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_visitor_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = VisitorSketchBuffer()
+    return _buffer
+
+
+def record_view(view):
+    """Count a ProductView towards the day's and the product's visitors"""
+    visitor = visitor_key(view.session_key, view.user_id, view.ip_address)
+    if visitor is not None:
+        get_visitor_buffer().add(timezone.localtime(view.viewed_at).date(), view.product_id, visitor)
+
+
+def day_sketches(day, views):
+    """
+    {product id or SITE: sketch} of `day`'s visitors
+
+    The stored sketches are merged with the visitor keys of `views` (that
+    day's ProductView rows), so views whose batch was never flushed count
+    too and every view counts under visitor_key, as the live sketches do.
+    """
+    sketches = {}
+    for product_id, registers in VisitorSketch.objects.filter(date=day).values_list('product_id', 'registers'):
+        sketches[product_id] = HyperLogLog.from_bytes(registers)
+    rows = views.values_list('product_id', 'session_key', 'user_id', 'ip_address').order_by()
+    for product_id, session_key, user_id, ip_address in rows.iterator():
+        visitor = visitor_key(session_key, user_id, ip_address)
+        if visitor is not None:
+            sketches.setdefault(product_id, HyperLogLog()).add(visitor)
+            sketches.setdefault(SITE, HyperLogLog()).add(visitor)
+    return sketches
+
+
+def _merged(sketches):
+    merged = HyperLogLog()
+    for registers in sketches:
+        merged.merge(HyperLogLog.from_bytes(registers))
+    return merged
+
+
+def unique_visitors(start_date, end_date=None):
+    """Distinct visitors from start_date through end_date (default today)"""
+    end_date = end_date or timezone.localdate()
+    sketches = VisitorSketch.objects.filter(product__isnull=True, date__range=(start_date, end_date))
+    return _merged(sketches.values_list('registers', flat=True).iterator()).count()
+
+
+def product_unique_visitors(product_ids, start_date, end_date=None):
+    """{product_id: distinct visitors} from start_date through end_date"""
+    end_date = end_date or timezone.localdate()
+    by_product = {}
+    sketches = VisitorSketch.objects.filter(product_id__in=product_ids, date__range=(start_date, end_date))
+    for product_id, registers in sketches.values_list('product_id', 'registers').iterator():
+        by_product.setdefault(product_id, []).append(registers)
+    return {product_id: _merged(registers).count() for product_id, registers in by_product.items()}
@@ -1,3 +1,5 @@
+from functools import lru_cache
+import hashlib
 import os
 from io import BytesIO
 
@@ -5,6 +7,16 @@ from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
 
+from .watermark_manifest import get_manifest
+
+
+def file_sha1(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
 def _open_image(path):
     from PIL import Image
@@ -12,15 +24,64 @@ def _open_image(path):
     return Image.open(path).convert("RGBA")
 
 
+# Logo widths are rounded to this many pixels so images of similar size share
+# one pre-scaled logo instead of resizing it for every image
+LOGO_WIDTH_BUCKET = 16
+
+
+def _resample_filter():
+    from PIL import Image
+
+    try:
+        return Image.Resampling.LANCZOS
+    except Exception:
+        try:
+            return Image.LANCZOS
+        except Exception:
+            return Image.NEAREST
+
+
+@lru_cache(maxsize=4)
+def _load_logo(logo_path):
+    return _open_image(logo_path)
+
+
+@lru_cache(maxsize=64)
+def _scaled_logo(logo_path, width):
+    logo = _load_logo(logo_path)
+    ratio = width / float(logo.width)
+    return logo.resize((width, max(1, int(logo.height * ratio))), resample=_resample_filter())
+
+
+def logo_bucket_width(image_width, scale_ratio=0.18):
+    max_w = int(image_width * scale_ratio)
+    return max(LOGO_WIDTH_BUCKET, int(round(max_w / LOGO_WIDTH_BUCKET)) * LOGO_WIDTH_BUCKET)
+
+
+@lru_cache(maxsize=32)
+def get_font(size, name='arial.ttf'):
+    """TrueType font at `size`, falling back to Pillow's default; loaded once per process"""
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype(name, size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+def clear_resource_cache():
+    """Drop cached logos and fonts (e.g. after replacing static/images/logo.png)"""
+    _load_logo.cache_clear()
+    _scaled_logo.cache_clear()
+    get_font.cache_clear()
+
+
 def _draw_text_watermark(base_img, text="Paint Store", opacity=160, margin=12):
-    from PIL import ImageDraw, ImageFont
+    from PIL import ImageDraw
 
     img = base_img.copy()
     draw = ImageDraw.Draw(img)
-    try:
-        font = ImageFont.truetype("arial.ttf", max(14, img.width // 20))
-    except Exception:
-        font = ImageFont.load_default()
+    font = get_font(max(14, img.width // 20))
 
     # compute text size compatibly across Pillow versions
     try:
@@ -45,21 +106,8 @@ def _draw_text_watermark(base_img, text="Paint Store", opacity=160, margin=12):
 
 
 def _apply_logo_overlay(base_img, logo_path, scale_ratio=0.18, margin=12):
-    from PIL import Image
-
-    logo = _open_image(logo_path)
-    # resize logo to be a fraction of base image width
-    max_w = int(base_img.width * scale_ratio)
-    ratio = max_w / float(logo.width)
-    new_size = (max_w, int(logo.height * ratio))
-    try:
-        resample = Image.Resampling.LANCZOS
-    except Exception:
-        try:
-            resample = Image.LANCZOS
-        except Exception:
-            resample = Image.NEAREST
-    logo = logo.resize(new_size, resample=resample)
+    # logo scaled to roughly a fraction of base image width (cached per bucket)
+    logo = _scaled_logo(logo_path, logo_bucket_width(base_img.width, scale_ratio))
 
     # position bottom-right
     x = base_img.width - logo.width - margin
@@ -70,67 +118,53 @@ def _apply_logo_overlay(base_img, logo_path, scale_ratio=0.18, margin=12):
     return base
 
 
-def watermark_product_image(instance, field_name='image'):
-    """Apply watermark to the image file attached to `instance.<field_name>`.
-
-    Returns the new storage name if created, otherwise None.
-    """
-    field = getattr(instance, field_name, None)
-    if not field:
-        return None
+def _svg_placeholder(name):
+    from PIL import Image, ImageDraw
 
+    w, h = 800, 800
+    base = Image.new('RGBA', (w, h), (255, 255, 255, 255))
+    draw = ImageDraw.Draw(base)
+    font = get_font(28)
+    title = os.path.splitext(os.path.basename(name))[0]
+    text = title.replace('_', ' ').title()
     try:
-        # use storage path if available
-        path = field.path
+        bbox = draw.textbbox((0, 0), text, font=font)
+        tw, th = bbox[2] - bbox[0], bbox[3] - bbox[1]
     except Exception:
-        # fallback: build path from MEDIA_ROOT
-        name = getattr(field, 'name', None)
-        if not name:
-            return None
-        path = os.path.join(settings.MEDIA_ROOT, name)
+        try:
+            bbox = font.getbbox(text)
+            tw, th = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        except Exception:
+            mask = font.getmask(text)
+            tw, th = mask.size
+    draw.text(((w - tw) // 2, (h - th) // 2), text, fill=(80, 80, 80), font=font)
+    return base
 
-    # prefer checking the actual filesystem path (storage may not reflect immediate disk state)
-    if not os.path.exists(path):
-        return None
 
+def default_logo_path():
+    return os.path.join(settings.BASE_DIR, 'static', 'images', 'logo.png')
+
+
+def render_watermark(path, name, logo_path=None):
+    """Return the watermarked RGBA image for the file at `path`, or None.
+
+    `name` is the storage name (used to detect SVGs and title placeholders).
+    Pure Pillow work, so it can run in a worker process.
+    """
     # open base image for raster formats; SVGs handled below
-    base = None
     try:
         base = _open_image(path)
     except Exception:
         # if original is SVG, create a raster placeholder and continue
-        base_name, ext = os.path.splitext(field.name)
-        if ext.lower() == '.svg':
-            from PIL import Image, ImageDraw, ImageFont
-
-            w, h = 800, 800
-            base = Image.new('RGBA', (w, h), (255, 255, 255, 255))
-            draw = ImageDraw.Draw(base)
-            try:
-                font = ImageFont.truetype('arial.ttf', 28)
-            except Exception:
-                font = ImageFont.load_default()
-            title = os.path.splitext(os.path.basename(field.name))[0]
-            text = title.replace('_', ' ').title()
-            try:
-                bbox = draw.textbbox((0, 0), text, font=font)
-                tw, th = bbox[2] - bbox[0], bbox[3] - bbox[1]
-            except Exception:
-                try:
-                    bbox = font.getbbox(text)
-                    tw, th = bbox[2] - bbox[0], bbox[3] - bbox[1]
-                except Exception:
-                    mask = font.getmask(text)
-                    tw, th = mask.size
-            draw.text(((w - tw) // 2, (h - th) // 2), text, fill=(80, 80, 80), font=font)
-        else:
+        _base_name, ext = os.path.splitext(name)
+        if ext.lower() != '.svg':
             return None
+        base = _svg_placeholder(name)
 
     # try to find a logo PNG in static files
-    static_logo = os.path.join(settings.BASE_DIR, 'static', 'images', 'logo.png')
     try:
-        if os.path.exists(static_logo):
-            result = _apply_logo_overlay(base, static_logo)
+        if logo_path and os.path.exists(logo_path):
+            result = _apply_logo_overlay(base, logo_path)
         else:
             # fallback draw text
             result = _draw_text_watermark(base, text="Paint Store")
@@ -139,15 +173,81 @@ def watermark_product_image(instance, field_name='image'):
         print('watermark: error applying overlay:', repr(exc))
         return None
 
-    # save new file with _wm.png suffix (always PNG to preserve alpha/transparency)
-    base_name, _ext = os.path.splitext(field.name)
-    new_name = f"{base_name}_wm.png"
-
     # ensure result is RGBA so PNG can include transparency
     try:
         result = result.convert('RGBA')
     except Exception:
         pass
+    return result
+
+
+VARIANT_FORMATS = {
+    'webp': {'format': 'WEBP', 'ext': 'webp', 'options': {'quality': 80, 'method': 4}},
+    'jpeg': {'format': 'JPEG', 'ext': 'jpg', 'options': {'quality': 82, 'optimize': True, 'progressive': True}},
+}
+
+
+def encode_variants(image, base_name, widths, formats):
+    """Downscale `image` to each width and encode it in each format.
+
+    Widths at or above the source width are skipped (no upscaling).
+    Returns ({width: {'height': h, fmt: storage_name}}, {storage_name: bytes}).
+    """
+    from PIL import Image
+
+    variants, files = {}, {}
+    for width in sorted(set(widths)):
+        if width >= image.width:
+            continue
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), resample=_resample_filter())
+        # flatten onto white: JPEG has no alpha and WebP stays smaller without it
+        flat = Image.new('RGB', resized.size, (255, 255, 255))
+        flat.paste(resized, mask=resized.getchannel('A'))
+        variant = {'height': height}
+        for fmt in formats:
+            spec = VARIANT_FORMATS[fmt]
+            buf = BytesIO()
+            flat.save(buf, format=spec['format'], **spec['options'])
+            name = f"{base_name}_wm_{width}.{spec['ext']}"
+            files[name] = buf.getvalue()
+            variant[fmt] = name
+        variants[str(width)] = variant
+    return variants, files
+
+
+def watermark_product_image(instance, field_name='image'):
+    """Apply watermark to the image file attached to `instance.<field_name>`.
+
+    The result is recorded in the watermark manifest (see
+    `store.watermark_manifest`), which is what the `watermarked` template
+    filter reads. Returns the new storage name if created, otherwise None.
+    """
+    field = getattr(instance, field_name, None)
+    if not field:
+        return None
+
+    try:
+        # use storage path if available
+        path = field.path
+    except Exception:
+        # fallback: build path from MEDIA_ROOT
+        name = getattr(field, 'name', None)
+        if not name:
+            return None
+        path = os.path.join(settings.MEDIA_ROOT, name)
+
+    # prefer checking the actual filesystem path (storage may not reflect immediate disk state)
+    if not os.path.exists(path):
+        return None
+
+    result = render_watermark(path, field.name, default_logo_path())
+    if result is None:
+        return None
+
+    # save new file with _wm.png suffix (always PNG to preserve alpha/transparency)
+    base_name, _ext = os.path.splitext(field.name)
+    new_name = f"{base_name}_wm.png"
 
     buf = BytesIO()
     try:
@@ -159,10 +259,22 @@ def watermark_product_image(instance, field_name='image'):
     buf.seek(0)
     content = ContentFile(buf.read())
 
-    # store via default_storage to MEDIA_ROOT
+    # store via default_storage to MEDIA_ROOT; drop the previous variant first
+    # so the name stays stable instead of gaining a random suffix
+    manifest = get_manifest()
     try:
+        if default_storage.exists(new_name):
+            default_storage.delete(new_name)
         saved_name = default_storage.save(new_name, content)
-        return saved_name
     except Exception as exc:
         print('watermark: storage save failed:', repr(exc))
         return None
+
+    previous = manifest.get(field.name)
+    if previous and previous['name'] != saved_name:
+        try:
+            default_storage.delete(previous['name'])
+        except Exception:
+            pass
+    manifest.record(field.name, saved_name, result.width, result.height, file_sha1(path))
+    return saved_name
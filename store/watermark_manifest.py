@@ -0,0 +1,167 @@
+"""
+Watermark Manifest - Original image -> watermarked variant map
+Persisted as JSON in media storage and held in memory per process, so
+templates resolve watermarked URLs without touching storage. Writers
+re-read and merge the file under a lock shared across processes.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: writers are serialized within a process only
+    fcntl = None
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from .cache import bump_catalog_version_on_commit
+
+logger = logging.getLogger(__name__)
+
+
+class WatermarkManifest:
+    """
+    Map of original image name -> {'name', 'width', 'height', 'sha1'}
+
+    `name` is the storage name of the watermarked PNG and `sha1` the hash
+    of the original file it was generated from. Reads are served from
+    memory; the file is re-read at most every WATERMARK_MANIFEST_RELOAD
+    seconds to pick up entries written by other processes.
+    """
+
+    def __init__(self, name=None, storage=None):
+        self.name = name or getattr(settings, 'WATERMARK_MANIFEST_NAME', 'watermarks/manifest.json')
+        self.storage = storage or default_storage
+        self._entries = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with self.storage.open(self.name, 'rb') as fh:
+                data = json.loads(fh.read().decode('utf-8'))
+        except FileNotFoundError:
+            data = {}
+        except Exception as e:
+            logger.warning(f"Could not read watermark manifest {self.name}: {e}")
+            data = {}
+        return data.get('images', {}) if isinstance(data, dict) else {}
+
+    def entries(self):
+        reload_after = getattr(settings, 'WATERMARK_MANIFEST_RELOAD', 300)
+        if self._entries is None or time.monotonic() - self._loaded_at > reload_after:
+            with self._lock:
+                if self._entries is None or time.monotonic() - self._loaded_at > reload_after:
+                    self._entries = self._load()
+                    self._loaded_at = time.monotonic()
+        return self._entries
+
+    def get(self, original_name):
+        return self.entries().get(original_name)
+
+    def _path(self):
+        try:
+            return self.storage.path(self.name)
+        except NotImplementedError:
+            return None
+
+    @contextmanager
+    def _locked(self):
+        """Serialize writers: threads with the lock, processes with flock on a sidecar file"""
+        with self._lock:
+            path = self._path()
+            if fcntl is None or path is None:
+                yield
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.lock", 'a') as fh:
+                fcntl.flock(fh, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def update(self, changes=None, removed=()):
+        """
+        Merge `changes` into the manifest and drop the `removed` names
+
+        The latest file is re-read under the cross-process lock, so entries
+        other writers added meanwhile are kept. Nothing is written, and the
+        catalog version is left alone, unless an entry actually changed.
+        Returns whether one did.
+        """
+        with self._locked():
+            entries = self._load()
+            before = dict(entries)
+            entries.update(changes or {})
+            for name in removed:
+                entries.pop(name, None)
+            changed = entries != before
+            if changed:
+                self._write(entries)
+            self._entries = entries
+            self._loaded_at = time.monotonic()
+        if changed:
+            # catalog pages embed the watermarked URLs, so their 304s must end
+            bump_catalog_version_on_commit()
+        return changed
+
+    def record(self, original_name, watermarked_name, width, height, sha1, **extra):
+        """Add or replace an entry and persist the manifest"""
+        entry = {'name': watermarked_name, 'width': width, 'height': height, 'sha1': sha1, **extra}
+        self.update({original_name: entry})
+        return entry
+
+    def discard(self, original_name):
+        self.update(removed=[original_name])
+
+    def replace(self, entries):
+        """Overwrite the whole manifest (used by rebuilds)"""
+        with self._locked():
+            changed = self._load() != entries
+            if changed:
+                self._write(entries)
+            self._entries = dict(entries)
+            self._loaded_at = time.monotonic()
+        if changed:
+            bump_catalog_version_on_commit()
+
+    def _write(self, entries):
+        body = json.dumps({'version': 1, 'images': entries}, indent=1, sort_keys=True).encode('utf-8')
+        path = self._path()
+        if path:
+            # local storage: write-and-rename so readers never see a partial file
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as fh:
+                fh.write(body)
+            os.replace(tmp, path)
+        else:
+            if self.storage.exists(self.name):
+                self.storage.delete(self.name)
+            self.storage.save(self.name, ContentFile(body))
+
+    def invalidate(self):
+        self._entries = None
+
+
+_manifest = None
+
+
+def get_manifest():
+    """Process-wide manifest instance"""
+    global _manifest
+    if _manifest is None:
+        _manifest = WatermarkManifest()
+    return _manifest
+
+
+def reset_manifest():
+    global _manifest
+    _manifest = None
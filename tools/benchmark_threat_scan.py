@@ -0,0 +1,84 @@
+"""Measure request threat scanning on realistic query strings and form fields.
+
+Compares the old approach (each detector walks its pattern list and runs
+one re.search per pattern, so a value is scanned seven times) with the
+single precompiled alternation behind ThreatScanMiddleware.
+
+Usage:
+    python tools/benchmark_threat_scan.py [--repeat 2000]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce.settings')
+django.setup()
+
+from store.security import THREAT_PATTERNS, scan_for_threats
+
+
+# The middleware scans field values joined with NUL, never the raw query string
+PAYLOADS = {
+    'search query': 'son chong tham ngoai troi mau xanh 18 lit',
+    'search (en)': 'exterior waterproof paint for wood doors, navy color',
+    'product filter': '\x00'.join(['3', '7', '100000', '2500000', 'price_asc', '4']),
+    'filter (en)': '\x00'.join(['interior', 'color', 'newest', 'order', '2']),
+    'checkout form': '\x00'.join([
+        'Nguyen Van An', '0912345678', 'an.nguyen@example.com',
+        '123 Le Loi, Phuong Ben Nghe, Quan 1, TP. Ho Chi Minh',
+        'Giao hang gio hanh chinh, goi truoc 15 phut', 'cod',
+    ]),
+    'checkout (en)': '\x00'.join([
+        'Jordan Taylor', '0912345678', 'jordan@example.com', '42 Harbor Road, Apt 5, Portland OR',
+        'Please call before delivery, or leave it at the door', 'cod',
+    ]),
+    'review text': ('Son phu rat deu, mau len dung nhu hinh, mui nhe. ' * 12).strip(),
+    'review (en)': ('Great coverage for the price, the color matched the sample and it dried before '
+                    'the second coat. Would order more for the porch. ' * 6).strip(),
+    'sql probe': "1' OR 1=1-- ",
+    'xss probe': '<img src=x onerror=alert(document.cookie)>',
+}
+
+
+def legacy_scan(text):
+    """Per-call pattern lists, one pass per pattern (the previous detector)"""
+    for kind, patterns in THREAT_PATTERNS.items():
+        for pattern in patterns:
+            match = re.search(pattern, text, re.IGNORECASE)
+            if match:
+                return kind, match.group()
+    return None
+
+
+def run(scan, text, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        scan(text)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f'{args.repeat} scans per payload (microseconds per scan)')
+    print(f'{"payload":>15} {"chars":>6} {"legacy":>8} {"single":>8} {"speedup":>8}')
+    total_legacy = total_single = 0.0
+    for label, text in PAYLOADS.items():
+        assert legacy_scan(text) == scan_for_threats(text) or label.endswith('probe'), label
+        legacy = run(legacy_scan, text, args.repeat)
+        single = run(scan_for_threats, text, args.repeat)
+        total_legacy += legacy
+        total_single += single
+        print(f'{label:>15} {len(text):>6} {legacy:>8.2f} {single:>8.2f} {legacy / single:>7.2f}x')
+    print(f'{"all":>15} {"":>6} {total_legacy:>8.2f} {total_single:>8.2f} {total_legacy / total_single:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
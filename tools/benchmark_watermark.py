@@ -0,0 +1,71 @@
+"""Measure per-image watermark throughput on a directory of sample images.
+
+Compares a cold run (logo/font cache cleared before every image, i.e. the
+old reopen-and-rescale behaviour) with the cached resources.
+
+Usage:
+    python tools/benchmark_watermark.py media/products [--repeat 3] [--logo static/images/logo.png]
+"""
+import argparse
+import os
+import sys
+import time
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce.settings')
+django.setup()
+
+from store.watermark import clear_resource_cache, default_logo_path, render_watermark
+
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp', '.gif', '.bmp', '.svg'}
+
+
+def sample_images(directory):
+    return sorted(
+        os.path.join(directory, f) for f in os.listdir(directory)
+        if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS and '_wm' not in f
+    )
+
+
+def run(paths, logo_path, repeat, cold):
+    clear_resource_cache()
+    rendered = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for path in paths:
+            if cold:
+                clear_resource_cache()
+            if render_watermark(path, os.path.basename(path), logo_path) is not None:
+                rendered += 1
+    elapsed = time.perf_counter() - start
+    return rendered, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--logo', default=default_logo_path())
+    args = parser.parse_args()
+
+    paths = sample_images(args.directory)
+    if not paths:
+        print('No sample images found in', args.directory)
+        return
+
+    print(f'{len(paths)} images x {args.repeat} passes, logo: {args.logo}')
+    results = {}
+    for label, cold in (('uncached', True), ('cached', False)):
+        rendered, elapsed = run(paths, args.logo, args.repeat, cold)
+        per_image = elapsed / max(rendered, 1) * 1000
+        results[label] = per_image
+        print(f'{label:>9}: {rendered} images in {elapsed:.2f}s '
+              f'({per_image:.1f} ms/image, {rendered / elapsed:.1f} images/s)')
+    print(f'speedup: {results["uncached"] / results["cached"]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()